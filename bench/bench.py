@@ -0,0 +1,461 @@
+
+# Prof Tallman
+# Reproducible CPU benchmarks for the hot paths in the cv and modules code.
+#
+# The scripts print their own `time.time()` measurements, but those numbers
+# depend on the camera, the image files, the GPIO wiring, and whatever else
+# the Raspberry Pi happened to be doing. They can't be compared from one
+# commit to the next. This suite runs the same work every time, entirely
+# offline, and saves the results as JSON:
+#
+#   shrink_to_fit   --> cv2util.shrink_to_fit on 1080p and 12 MP frames
+#   resizer         --> cv2util.Resizer on a 1080p frame into a reused array
+#   imdecode_fit    --> cv2util.imdecode_fit on a 12 MP JPEG held in memory
+#   yolo_detect     --> yolo.detect_persons on a 640x480 frame
+#   yolo_decode     --> yolo.decode_yolo_outputs by itself
+#   haar_detect     --> HAAR detectMultiScale on a 640x480 grayscale frame
+#   hog_detect      --> HOG detectMultiScale on a 320x240 grayscale frame
+#   dht11_read      --> DHT11._read_sensor decoding a recorded 40-bit signal
+#   dht11_bits      --> DHT11._bits_to_bytes on 40 bits
+#   lcd_text        --> LCD1602.text writing one full line
+#
+# No camera or GPIO is needed. The images are synthetic scenes drawn from a
+# fixed random seed, and the device classes talk to a fake RPi.GPIO (see
+# fake_gpio.py) with the `sleep` calls turned off so that only the Python
+# work is measured. If the YOLOv3 files are not in the cv directory, a fake
+# network that returns YOLO-shaped outputs stands in for the DNN so that the
+# blob and decode steps around it are still measured. The results record
+# which one was used.
+#
+# Each benchmark runs its function enough times to fill --min-time seconds,
+# repeats that --repeat times, and reports the median time per call. OpenCV
+# is limited to one thread by default because the thread count changes the
+# results more than most code changes do.
+#
+# Example:
+#   python bench.py run --output before.json
+#   (make some changes)
+#   python bench.py run --output after.json
+#   python bench.py compare before.json after.json --tolerance 0.10
+#
+# References:
+#  - https://docs.python.org/3/library/timeit.html
+#  - https://pyperf.readthedocs.io/en/latest/system.html
+
+import numpy as np
+import statistics
+import subprocess
+import platform
+import argparse
+import fnmatch
+import json
+import time
+import cv2
+import sys
+import os
+
+import fake_gpio
+fake_gpio.install()
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CV_DIR = os.path.join(REPO_DIR, 'cv')
+MODULES_DIR = os.path.join(REPO_DIR, 'modules')
+sys.path.insert(0, CV_DIR)
+sys.path.insert(0, MODULES_DIR)
+
+import cv2util
+import yolo
+import haar
+import hog
+import dht11
+import lcd16x2
+
+# The device classes sleep to meet their hardware's timing, which would swamp
+# the Python work that we want to measure
+dht11.sleep = lambda seconds: None
+lcd16x2.sleep = lambda seconds: None
+
+# Bump this when a benchmark changes what it measures so that old results are
+# not compared against new ones by mistake
+SUITE_VERSION = 2
+
+
+def make_scene(width, height, seed=0):
+    """
+    Draws a deterministic BGR test image: a gradient background covered with
+    random rectangles and circles plus a little sensor noise. Real detectors
+    do much more work on an image with edges than on flat noise.
+    """
+
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(40, 200, width, dtype=np.float32)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = ramp[np.newaxis, :, np.newaxis].astype(np.uint8)
+    scale = max(width, height) / 640
+    for i in range(60):
+        color = [int(c) for c in rng.integers(0, 256, 3)]
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(10, 80) * scale)
+        if i % 2 == 0:
+            cv2.rectangle(img, (x, y), (x + size, y + 2 * size), color, -1)
+        else:
+            cv2.circle(img, (x, y), size // 2, color, -1)
+    noise = rng.normal(0, 6, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+class SyntheticYoloNet:
+    """
+    Stands in for the YOLOv3 DNN when its files are not available. Returns
+    three output layers with the same shapes that YOLOv3 produces for the
+    blob size, filled with fixed random values where only a few rows have a
+    high objectness score. A batch gets the same rows for every image.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.blob_size = None
+        self.batch_size = 1
+        self._outputs = {}
+
+    def setInput(self, blob):
+        self.batch_size = blob.shape[0]
+        self.blob_size = blob.shape[2:]
+
+    def forward(self, layers):
+        if self.blob_size not in self._outputs:
+            rng = np.random.default_rng(self.seed)
+            blob_h, blob_w = self.blob_size
+            outputs = []
+            for stride in (32, 16, 8):
+                rows = (blob_h // stride) * (blob_w // stride) * 3
+                layer = rng.random((rows, 85), dtype=np.float32)
+                layer[:, 2:4] *= 0.3
+                layer[:, 4] **= 8
+                layer[:, 5:] **= 4
+                outputs.append(layer)
+            self._outputs[self.blob_size] = tuple(outputs)
+        outputs = self._outputs[self.blob_size]
+        if self.batch_size > 1:
+            outputs = tuple(np.tile(layer, (self.batch_size, 1)) for layer in outputs)
+        return outputs
+
+
+def load_yolo(synthetic=False):
+    """
+    Loads the YOLOv3 DNN from the cv directory if its files are there (and
+    `synthetic` is False). Returns the (dnn_object, name) pair, where name is
+    'yolov3' or 'synthetic'.
+    """
+
+    files = ['coco.names', 'yolov3.cfg', 'yolov3.weights']
+    if not synthetic and all(os.path.exists(os.path.join(CV_DIR, f)) for f in files):
+        cwd = os.getcwd()
+        os.chdir(CV_DIR)
+        try:
+            dnn_classifier, dnn_layers, label_names = yolo.load_yolo_deep_neural_network()
+        finally:
+            os.chdir(cwd)
+        return (dnn_classifier, dnn_layers), 'yolov3'
+    return (SyntheticYoloNet(), ['yolo_82', 'yolo_94', 'yolo_106']), 'synthetic'
+
+
+def dht11_signal(data, low=50, zero=27, one=70, jitter=3, seed=0):
+    """
+    Builds the levels that a DHT11 sends for 5 data bytes, one sample per
+    microsecond: the 80us LOW/HIGH response, then a 50us LOW marker followed
+    by a short (0) or long (1) HIGH for each of the 40 bits, then a final LOW
+    marker before the line goes quiet.
+    """
+
+    rng = np.random.default_rng(seed)
+    levels = [1] * 10 + [0] * 80 + [1] * 80
+    for byte in data:
+        for pos in range(7, -1, -1):
+            bit = (byte >> pos) & 1
+            levels += [0] * (low + int(rng.integers(-jitter, jitter + 1)))
+            levels += [1] * ((one if bit else zero) + int(rng.integers(-jitter, jitter + 1)))
+    levels += [0] * low + [1]
+    return levels
+
+
+def make_dht11():
+    """
+    Creates a DHT11 object without running its constructor, which would time
+    the fake GPIO and try to read the sensor.
+    """
+
+    sensor = dht11.DHT11.__new__(dht11.DHT11)
+    sensor._dht11_pin = 26
+    sensor._wait_period_seconds = None
+    sensor._last_read_time = None
+    sensor._last_temperature = None
+    sensor._last_humidity = None
+    sensor._wait_cycles = 150
+    return sensor
+
+
+# Each setup function prepares one benchmark and returns a tuple of the
+# function to time (called with no arguments) and a dictionary describing
+# what it does. The images are created here, outside of the timed function.
+
+def setup_shrink_1080p(args):
+    frame = make_scene(1920, 1080)
+    return lambda: cv2util.shrink_to_fit(frame, (640, 480)), {'input': '1920x1080', 'bbox': '640x480'}
+
+
+def setup_shrink_12mp(args):
+    frame = make_scene(4056, 3040)
+    return lambda: cv2util.shrink_to_fit(frame, (640, 480)), {'input': '4056x3040', 'bbox': '640x480'}
+
+
+def setup_resizer_1080p(args):
+    frame = make_scene(1920, 1080)
+    resizer = cv2util.Resizer((640, 480), frame.shape)
+    small = resizer.empty()
+    return lambda: resizer(frame, dst=small), {'input': '1920x1080', 'bbox': '640x480'}
+
+
+def setup_imdecode_fit_12mp(args):
+    ok, data = cv2.imencode('.jpg', make_scene(4056, 3040))
+    data = data.tobytes()
+    return lambda: cv2util.imdecode_fit(data, (640, 480)), {'input': '4056x3040 JPEG', 'bbox': '640x480'}
+
+
+def setup_yolo_detect(args):
+    img = make_scene(640, 480)
+    dnn_object, model = load_yolo(args.synthetic_yolo)
+    def run():
+        return yolo.detect_persons(img, dnn_object, 0.90, 0.3)
+    return run, {'input': '640x480', 'blob_size': yolo.BLOB_SIZE[0], 'model': model}
+
+
+def setup_yolo_decode(args):
+    net = SyntheticYoloNet()
+    net.setInput(np.zeros((1, 3) + yolo.BLOB_SIZE, dtype=np.float32))
+    outputs = net.forward(None)
+    rows = sum(len(layer) for layer in outputs)
+    def run():
+        return yolo.decode_yolo_outputs(outputs, 640, 480, 0.5, 0.3)
+    return run, {'rows': rows, 'confidence': 0.5, 'model': 'synthetic'}
+
+
+def setup_haar_detect(args):
+    gray = cv2.cvtColor(make_scene(640, 480), cv2.COLOR_BGR2GRAY)
+    haar_faces = haar.load_haar_cascade(os.path.join(CV_DIR, 'haarcascade_frontalface_default.xml'))
+    return lambda: haar.detect_faces(gray, haar_faces), {'input': '640x480', 'scale_factor': 1.1, 'min_neighbors': 4}
+
+
+def setup_hog_detect(args):
+    gray = cv2.cvtColor(make_scene(320, 240), cv2.COLOR_BGR2GRAY)
+    hog_people = hog.load_hog_people_detector()
+    return lambda: hog.detect_people(gray, hog_people), {'input': '320x240', 'win_stride': 1, 'scale': 1.1}
+
+
+def setup_dht11_read(args):
+    sensor = make_dht11()
+    signal = dht11_signal([45, 0, 23, 4, 72])
+
+    # Check that the recorded signal really decodes so that we are not
+    #   timing the early return for a bad reading
+    fake_gpio.play_signal(signal)
+    sensor._read_sensor()
+    if sensor._last_temperature != 23.4 or sensor._last_humidity != 45.0:
+        raise RuntimeError('DHT11 benchmark signal did not decode')
+
+    def run():
+        fake_gpio.play_signal(signal)
+        sensor._read_sensor()
+    return run, {'samples': len(signal), 'wait_cycles': sensor._wait_cycles}
+
+
+def setup_dht11_bits(args):
+    sensor = make_dht11()
+    bits = [(byte >> pos) & 1 for byte in [45, 0, 23, 4, 72] for pos in range(7, -1, -1)]
+    return lambda: sensor._bits_to_bytes(bits), {'bits': len(bits)}
+
+
+def setup_lcd_text(args):
+    lcd = lcd16x2.LCD1602(5, 6, 17, 27, 23, 22)
+    return lambda: lcd.text('pi@raspberrypi', 1), {'chars': lcd16x2.LCD1602._LCD_WIDTH}
+
+
+BENCHMARKS = {
+    'shrink_to_fit.1080p': setup_shrink_1080p,
+    'shrink_to_fit.12mp': setup_shrink_12mp,
+    'resizer.1080p': setup_resizer_1080p,
+    'imdecode_fit.12mp': setup_imdecode_fit_12mp,
+    'yolo_detect': setup_yolo_detect,
+    'yolo_decode': setup_yolo_decode,
+    'haar_detect': setup_haar_detect,
+    'hog_detect': setup_hog_detect,
+    'dht11_read': setup_dht11_read,
+    'dht11_bits': setup_dht11_bits,
+    'lcd_text': setup_lcd_text,
+}
+
+
+def time_function(function, repeat=7, min_time=0.2):
+    """
+    Times a function the way timeit does. The function is called once to warm
+    up, then enough times per run to fill `min_time` seconds, for `repeat`
+    runs. Returns the number of calls per run and a list with the mean
+    seconds per call for each run.
+    """
+
+    time_start = time.perf_counter()
+    function()
+    once = time.perf_counter() - time_start
+    number = max(1, int(min_time / max(once, 1e-9)))
+
+    runs = []
+    for r in range(repeat):
+        time_start = time.perf_counter()
+        for i in range(number):
+            function()
+        runs.append((time.perf_counter() - time_start) / number)
+    return number, runs
+
+
+def summarize(number, runs):
+    """ Converts the run times into the statistics saved in the results. """
+    ms = [1000 * seconds for seconds in runs]
+    return {
+        'number': number,
+        'repeat': len(ms),
+        'median_ms': statistics.median(ms),
+        'mean_ms': statistics.mean(ms),
+        'min_ms': min(ms),
+        'max_ms': max(ms),
+        'stdev_ms': statistics.stdev(ms) if len(ms) > 1 else 0.0,
+    }
+
+
+def git_commit():
+    """ Returns the current git commit and whether the tree has changes. """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def environment(args):
+    """ Describes the machine and libraries that the results came from. """
+    commit, dirty = git_commit()
+    return {
+        'suite_version': SUITE_VERSION,
+        'commit': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'opencv_threads': cv2.getNumThreads(),
+        'repeat': args.repeat,
+        'min_time': args.min_time,
+    }
+
+
+def run(args):
+    cv2.setNumThreads(args.threads)
+    names = [name for name in BENCHMARKS
+             if not args.only or any(fnmatch.fnmatch(name, p) for p in args.only.split(','))]
+    results = {'environment': environment(args), 'benchmarks': {}}
+
+    for name in names:
+        function, params = BENCHMARKS[name](args)
+        number, runs = time_function(function, args.repeat, args.min_time)
+        result = summarize(number, runs)
+        result['params'] = params
+        results['benchmarks'][name] = result
+        print(f"{name:22} {result['median_ms']:10.3f} ms  "
+              f"(+/- {result['stdev_ms']:.3f}, {number} x {args.repeat})", file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare(args):
+    """
+    Compares two result files and reports each benchmark's change in median
+    time. Returns 1 if any benchmark got slower by more than the tolerance.
+    """
+
+    with open(args.old, 'r') as f:
+        old = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+
+    # Results from different machines or library versions are not comparable,
+    #   so point that out rather than blaming the code
+    for key in ('suite_version', 'machine', 'cpu_count', 'python', 'numpy', 'opencv', 'opencv_threads'):
+        if old['environment'].get(key) != new['environment'].get(key):
+            print(f"Warning: {key} differs ({old['environment'].get(key)} vs "
+                  f"{new['environment'].get(key)})", file=sys.stderr)
+
+    regressions = 0
+    print(f"{'benchmark':22} {'old ms':>10} {'new ms':>10} {'change':>8}")
+    for name, new_result in new['benchmarks'].items():
+        old_result = old['benchmarks'].get(name)
+        if old_result is None:
+            print(f"{name:22} {'':>10} {new_result['median_ms']:10.3f}      new")
+            continue
+        change = new_result['median_ms'] / old_result['median_ms'] - 1
+        flag = ''
+        if old_result.get('params') != new_result.get('params'):
+            flag = '  (params changed)'
+        elif change > args.tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:22} {old_result['median_ms']:10.3f} {new_result['median_ms']:10.3f} "
+              f"{100*change:+7.1f}%{flag}")
+
+    if regressions:
+        print(f"{regressions} benchmarks slower by more than {100*args.tolerance:.0f}%", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU benchmarks for the cv and modules code')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_cmd = commands.add_parser('run', help='run the benchmarks')
+    run_cmd.add_argument('--output', metavar='FILE', help='save the results to a JSON file (default: stdout)')
+    run_cmd.add_argument('--only', metavar='PATTERNS',
+                         help='comma separated benchmark names to run (wildcards allowed)')
+    run_cmd.add_argument('--repeat', type=int, default=7, help='runs per benchmark (default: 7)')
+    run_cmd.add_argument('--min-time', type=float, default=0.2,
+                         help='minimum seconds per run (default: 0.2)')
+    run_cmd.add_argument('--threads', type=int, default=1,
+                         help='value for cv2.setNumThreads (default: 1)')
+    run_cmd.add_argument('--synthetic-yolo', action='store_true',
+                         help='use the fake YOLO network even if the model files exist')
+
+    compare_cmd = commands.add_parser('compare', help='compare two result files')
+    compare_cmd.add_argument('old', help='results from the earlier commit')
+    compare_cmd.add_argument('new', help='results from the later commit')
+    compare_cmd.add_argument('--tolerance', type=float, default=0.10,
+                             help='allowed slowdown before a benchmark is flagged (default: 0.10)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+
+# Prof Tallman
+# Fake RPi.GPIO module for running the device classes without a Raspberry Pi.
+#
+# The helper classes in the modules directory talk to their devices through
+# RPi.GPIO, which only installs (and only works) on a Raspberry Pi. This fake
+# has the same functions and constants but no hardware behind it:
+#
+#   output --> remembers the last value written to each pin and counts writes
+#   input  --> plays back a recorded signal, one level per call, and then holds
+#              the last level forever (like a sensor that has gone quiet)
+#
+# Call `install()` before importing a module that uses RPi.GPIO so that its
+# `import RPi.GPIO as GPIO` finds this module instead of the real one.
+#
+#   import fake_gpio
+#   fake_gpio.install()
+#   import dht11
+
+import types
+import sys
+
+BCM = 11
+BOARD = 10
+IN = 1
+OUT = 0
+HIGH = 1
+LOW = 0
+PUD_UP = 22
+PUD_DOWN = 21
+PUD_OFF = 20
+
+_pins = {}
+_signal = []
+_position = 0
+output_count = 0
+input_count = 0
+
+
+def setmode(mode):
+    pass
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=None):
+    if initial is not None:
+        _pins[pin] = initial
+
+
+def output(pin, value):
+    global output_count
+    _pins[pin] = value
+    output_count += 1
+
+
+def input(pin):
+    global _position, input_count
+    input_count += 1
+    if _position < len(_signal):
+        _position += 1
+        return _signal[_position - 1]
+    return _signal[-1] if _signal else _pins.get(pin, HIGH)
+
+
+def cleanup(pins=None):
+    _pins.clear()
+
+
+def play_signal(levels):
+    """
+    Sets the levels that `input` returns, one per call, starting from the
+    beginning of the list.
+    """
+    global _signal, _position
+    _signal = list(levels)
+    _position = 0
+
+
+def reset_counts():
+    global output_count, input_count
+    output_count = 0
+    input_count = 0
+
+
+def install():
+    """
+    Registers this module as RPi.GPIO. Returns the module.
+    """
+    module = sys.modules[__name__]
+    package = sys.modules.get('RPi') or types.ModuleType('RPi')
+    package.GPIO = module
+    sys.modules['RPi'] = package
+    sys.modules['RPi.GPIO'] = module
+    return module
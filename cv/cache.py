@@ -0,0 +1,190 @@
+
+# Prof Tallman
+# On-disk cache of detection results for repeated directory runs.
+#
+# Capture folders tend to grow over time: a camera adds new photos every day
+# and the detector is run over the whole folder again. Without a cache, every
+# old image is decoded and run through the detector again, even though the
+# answer is going to be exactly the same as yesterday.
+#
+# The cache key is a SHA-256 hash of the image file's contents combined with
+# the identity of the detector: its name, its parameters (blob size, score
+# thresholds, etc.), and the model files it loaded. Renaming or copying an
+# image still hits the cache, but editing the image, changing a parameter, or
+# swapping the model files produces a new key. Model files are identified by
+# their path, size, and modification time rather than by hashing them, since
+# hashing the 240 MB YOLOv3 weights on every run would defeat the purpose.
+#
+# Each result is a small JSON file stored under a subdirectory named after the
+# first two characters of its key. The cache has a size limit; when it grows
+# past the limit, the least recently used results are deleted until the cache
+# is back under 90% of the limit. A cache hit updates the result file's
+# modification time so that it counts as recently used.
+#
+# References:
+#  - https://docs.python.org/3/library/hashlib.html
+#  - https://en.wikipedia.org/wiki/Cache_replacement_policies#LRU
+
+import threading
+import hashlib
+import json
+import os
+
+
+class ResultCache:
+    """
+    Size-bounded, content-addressed cache of detection results. Safe to use
+    from several threads at once.
+    """
+
+    def __init__(self, cache_dir, identity, max_bytes=256 * 1024 * 1024):
+        """
+        Opens (or creates) a cache directory.
+
+        Args:
+         - cache_dir: directory that holds the cached results
+         - identity: JSON-compatible value describing the detector and its
+           parameters, usually made with `detector_identity`
+         - max_bytes: size limit for the cache, or None for no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self.identity = identity
+        identity_text = json.dumps(identity, sort_keys=True)
+        self._identity = hashlib.sha256(identity_text.encode()).digest()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for mtime, size, path in self._entries())
+
+    def __str__(self):
+        return (f"ResultCache in '{self.cache_dir}' holding "
+                f"{self._total_bytes / 1024:.1f} KB")
+
+    def key(self, data):
+        """ Returns the cache key for the raw bytes of an image file. """
+        h = hashlib.sha256(self._identity)
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key, data_size=0):
+        """
+        Returns the cached result for a key, or None if there is no result.
+        `data_size` is the size of the image file and is only used for the
+        bytes saved statistic.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                result = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            result = None
+        self.count(result is not None, data_size)
+        return result
+
+    def count(self, hit, data_size=0):
+        """
+        Adds a lookup to the statistics. Used by `get`, and by the main
+        process to total up the lookups done by worker processes.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += data_size
+            else:
+                self.misses += 1
+
+    def put(self, key, result):
+        """
+        Saves a result. The file is written under a temporary name and then
+        renamed so that other readers never see a half-written result.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        text = json.dumps(result)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += len(text)
+            over_limit = self.max_bytes is not None and self._total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _entries(self):
+        """ Yields (mtime, size, path) for every result in the cache. """
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self):
+        """
+        Deletes the least recently used results until the cache is under 90%
+        of its size limit. The cache directory is rescanned so that results
+        written by other processes are counted too.
+        """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for mtime, size, path in entries)
+            target = 0.9 * self.max_bytes
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evicted += 1
+            self._total_bytes = total
+
+    def stats(self):
+        """ Returns the cache statistics as a dictionary. """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'evicted': self.evicted,
+                'cache_bytes': self._total_bytes,
+            }
+
+
+def detector_identity(name, params, model_files=()):
+    """
+    Describes a detector for the cache key: its name, its parameters, and
+    the path, size, and modification time of each model file it loads.
+    """
+    files = []
+    for filename in model_files:
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            files.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+        else:
+            files.append([os.path.abspath(filename), None, None])
+    return {'detector': name, 'params': params, 'model_files': files}
+
+
+def print_stats(stats, file=None):
+    """ Prints the statistics returned by `ResultCache.stats`. """
+    print(f"Cache: {stats['hits']} hits, {stats['misses']} misses "
+          f"({100*stats['hit_rate']:.1f}% hit rate), "
+          f"{stats['bytes_saved'] / (1024*1024):.1f} MB of images skipped, "
+          f"{stats['evicted']} results evicted, "
+          f"{stats['cache_bytes'] / 1024:.1f} KB on disk", file=file)
@@ -0,0 +1,184 @@
+
+# Prof Tallman
+# Reads a camera on its own thread and keeps only the newest frame.
+#
+# A live loop that captures a frame, runs a detector on it, and shows it adds
+# all of those times together, and it always works on a frame that was taken
+# before the detector started. Worse, the camera keeps taking frames while the
+# detector runs, and its driver queues them up, so a slow detector falls
+# further and further behind what is actually in front of the camera.
+#
+# FrameGrabber moves the capture onto its own thread. The thread reads frames
+# as fast as the camera delivers them and keeps only the newest one (a double
+# buffer: the newest frame, and the one being captured). Frames that the loop
+# was too busy to take are dropped and counted. The loop asks for the newest
+# frame whenever it is ready for one, so what it shows is never older than one
+# detector run.
+#
+#   grabber = camera.FrameGrabber(camera.videocapture_reader(webcam))
+#   with grabber:
+#       while True:
+#           frame = grabber.read()      # newest frame, waits for a new one
+#           ...
+#   grabber.print_stats()
+#
+# The reader is any function that returns the next frame, or None when the
+# camera fails. A "frame" can be anything, such as the (gray, color) pair
+# from the Picamera2 lores reader. The reader is handed a spare frame that it
+# may capture into (a frame that was dropped, so nobody else is using it) to
+# save allocating a new one.
+#
+# References:
+#  - https://docs.python.org/3/library/threading.html#condition-objects
+#  - https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
+
+import threading
+import time
+import sys
+
+
+def videocapture_reader(capture):
+    """ Returns a reader for FrameGrabber that reads from a cv2.VideoCapture. """
+    def read(spare):
+        ok, frame = capture.read(spare)
+        return frame if ok else None
+    return read
+
+
+def picamera_reader(picam, stream='main'):
+    """ Returns a reader for FrameGrabber that reads from a started Picamera2. """
+    def read(spare):
+        return picam.capture_array(stream)
+    return read
+
+
+def configure_lores(picam, size=(640, 480)):
+    """
+    Configures a Picamera2 for the lores reader: a `size` YUV420 lores stream
+    for the detector and a color (XRGB8888) main stream of the same size for
+    display. Call this before `picam.start()`.
+    """
+    config = picam.create_video_configuration(main={'size': size, 'format': 'XRGB8888'},
+                                              lores={'size': size, 'format': 'YUV420'})
+    picam.configure(config)
+
+
+def picamera_lores_reader(picam, size=(640, 480), with_main=True):
+    """
+    Returns a reader for FrameGrabber that reads a Picamera2 set up by
+    `configure_lores`. Each frame is a tuple of (gray, color):
+
+     - gray: the Y (brightness) plane of the lores stream. YUV420 stores the
+       full resolution Y plane first, followed by the quarter resolution U
+       and V planes, so the Y plane is a slice of the captured array (a
+       NumPy view, not a copy) and it is already the grayscale image that
+       the HAAR cascade wants: no color conversion and no resize.
+     - color: the main stream, for drawing on and showing in a window, or
+       None when `with_main` is False so it is never copied out at all
+    """
+    width, height = size
+    def read(spare):
+        if with_main:
+            (color, yuv), metadata = picam.capture_arrays(['main', 'lores'])
+        else:
+            color, yuv = None, picam.capture_array('lores')
+        return yuv[:height, :width], color
+    return read
+
+
+class FrameGrabber:
+    """
+    Captures frames on a background thread and hands out only the newest
+    one. Start it with `start()` or by using it as a context manager.
+    """
+
+    def __init__(self, reader, name='capture'):
+        """
+        Args:
+         - reader: function that takes a spare frame (or None) and returns
+           the next frame from the camera, or None if the camera failed
+         - name: name of the capture thread
+        """
+        self.reader = reader
+        self.captured = 0       # frames read from the camera
+        self.delivered = 0      # frames handed out by `read`
+        self.dropped = 0        # frames replaced by a newer one before `read`
+        self.failed = False
+        self._latest = None
+        self._latest_time = 0.0
+        self._taken = True
+        self._age_seconds = 0.0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the capture thread. The camera itself is left open. """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        spare = None
+        try:
+            while not self._stopped:
+                frame = self.reader(spare)
+                if frame is None:
+                    self.failed = True
+                    break
+                with self._cond:
+
+                    # The old frame was never handed out, so nobody else is
+                    #   using it and the camera can capture into it next time
+                    spare = None
+                    if not self._taken:
+                        self.dropped += 1
+                        spare = self._latest
+                    self._latest = frame
+                    self._latest_time = time.perf_counter()
+                    self._taken = False
+                    self.captured += 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Returns the newest frame that has not been handed out yet, waiting
+        for the camera if there isn't one. Returns None once the camera has
+        failed or the grabber has been stopped (or after `timeout` seconds).
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self._taken or self._stopped, timeout):
+                return None
+            if self._taken:
+                return None
+            self._taken = True
+            self.delivered += 1
+            self._age_seconds += time.perf_counter() - self._latest_time
+            return self._latest
+
+    @property
+    def mean_age(self):
+        """ Average time (seconds) that a frame waited before `read` took it. """
+        return self._age_seconds / self.delivered if self.delivered else 0.0
+
+    def print_stats(self, file=sys.stderr):
+        print(f'Captured {self.captured} frames, processed {self.delivered}, '
+              f'dropped {self.dropped} stale frames', file=file)
+        print(f'  => frames waited {1000 * self.mean_age:.1f}ms on average before processing',
+              file=file)
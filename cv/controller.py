@@ -1,5 +1,6 @@
 
 import cv2
+import camera
 
 
 def cv2TextBoxWithBackground(img, text,
@@ -21,6 +22,7 @@ def cv2TextBoxWithBackground(img, text,
 
 
 if __name__ == '__main__':
+    grabber = None
     try:
 
         # Open the default webcam--Raspberry Pi devices should use picamera2 library
@@ -46,11 +48,17 @@ if __name__ == '__main__':
         #   <ESC>:  quit
         #   WSAD:   forward, reverse, left, right
         #   [ or ]: pan camera left or right
+        # The webcam is read on its own thread that keeps only the newest
+        # frame (see camera.py), so the feed never lags behind the camera
+        grabber = camera.FrameGrabber(camera.videocapture_reader(webcam)).start()
         cv2.namedWindow("Video Feed")
         frame_count = 0
         message = None
         while True:
-            ret, frame = webcam.read() 
+            frame = grabber.read(timeout=2.0)
+            if frame is None:
+                print("Error reading webcam")
+                exit()
             frame = cv2.resize(frame, (width, height))
             key_code = cv2.waitKey(1)
             if key_code == -1:
@@ -82,5 +90,8 @@ if __name__ == '__main__':
         
     finally:
         print("Releasing all OpenCV resources")
+        if grabber is not None:
+            grabber.stop()
+            grabber.print_stats()
         cv2.destroyAllWindows()
         webcam.release()
@@ -1,4 +1,12 @@
+import concurrent.futures
+import numpy as np
+import threading
+import queue
+import io
+import time
 import cv2
+import os
+import profiler
 
 # Adopted from https://medium.com/@mh_yip/opencv-detect-whether-a-window-is-closed-or-close-by-press-x-button-ee51616f7088
 # Thanks to David C. for Aspect Ratio workaround to Rasberry Pi cv2 bug:
@@ -23,12 +31,670 @@ def wait_for_window_to_close(window_title):
 def shrink_to_fit(img, bbox=(640,480)):
     """
     Shrinks an image to fit in a bounding box while preserving aspect ratio.
+    Works on grayscale, BGR, and BGRA images. The resize plan for each bbox
+    and image shape is worked out once and then reused (see Resizer).
     """
 
-    bbox_width, bbox_height = bbox
-    height, width, channels = img.shape
-    factor = min(bbox_width / width, bbox_height / height)
-    if factor < 1:
-        return cv2.resize(img, (0,0), fx=factor, fy=factor)
+    bbox = tuple(bbox)
+    resizer = _shrink_resizers.get(bbox)
+    if resizer is None:
+        resizer = _shrink_resizers.setdefault(bbox, Resizer(bbox))
+    return resizer(img)
+
+def draw_target(img, box, color=(0, 255, 204), thickness=2):
+    """
+    Draws a bounding box with a small crosshair at its center. The image is
+    modified in place. Returns the (x, y) coordinates of the center.
+    """
+
+    x, y, w, h = box
+    ctr_x = x + w // 2
+    ctr_y = y + h // 2
+    cv2.rectangle(img, (x, y), (x+w, y+h), color, thickness)
+    cv2.line(img, (ctr_x-5, ctr_y), (ctr_x+5, ctr_y), color, 2)
+    cv2.line(img, (ctr_x, ctr_y-5), (ctr_x, ctr_y+5), color, 2)
+    return ctr_x, ctr_y
+
+
+class Resizer:
+    """
+    Shrinks images to fit in a bounding box, like shrink_to_fit, but works
+    out the resize "plan" (output size and interpolation) once per input
+    shape instead of on every call. Frames from a camera all have the same
+    shape, so after the first frame a resize is a dictionary lookup and one
+    call to cv2.resize. Pass `dst` to have the result written into your own
+    array instead of a new one:
+
+      resizer = Resizer((640, 480), frame.shape)
+      small = resizer.empty()           # allocate the destination once
+      while True:
+          resizer(camera.capture_array(), dst=small)
+
+    Shrinking uses INTER_AREA, which averages all the pixels that land on
+    each output pixel. The default (INTER_LINEAR) only looks at the 4
+    nearest pixels, which makes thin edges flicker and fall apart (aliasing)
+    when an image is shrunk by more than half. It costs more time on very
+    large images, so pass `interpolation=cv2.INTER_LINEAR` if speed matters
+    more than quality.
+
+    Works on grayscale (2D or one channel), BGR, and BGRA images of uint8 or
+    any other type that cv2.resize accepts. Images that already fit are
+    returned as they are (or copied into `dst`).
+    """
+
+    # Most input shapes to remember; a directory of mixed photos has a few
+    MAX_PLANS = 64
+
+    def __init__(self, bbox=(640, 480), input_shape=None, interpolation=cv2.INTER_AREA):
+        """
+        Args:
+         - bbox: (width, height) box that the images are shrunk to fit in
+         - input_shape: shape of the frames, e.g. `frame.shape`, to plan for
+           ahead of time (optional; other shapes are planned when they come)
+         - interpolation: cv2 interpolation flag for shrinking
+        """
+        self.bbox = tuple(bbox)
+        self.interpolation = interpolation
+        self._plans = {}
+        if input_shape is not None:
+            self.plan(input_shape)
+
+    def plan(self, input_shape):
+        """
+        Returns the output (width, height) for an input shape, or None if the
+        image already fits in the box.
+        """
+        shape = tuple(input_shape)
+        try:
+            return self._plans[shape]
+        except KeyError:
+            pass
+        if len(shape) == 3 and shape[2] not in (1, 3, 4):
+            raise ValueError(f'Resizer needs 1, 3, or 4 channels, not {shape[2]}')
+        if len(shape) not in (2, 3):
+            raise ValueError(f'Resizer needs a 2D or 3D image, not shape {shape}')
+
+        height, width = shape[:2]
+        bbox_width, bbox_height = self.bbox
+        factor = min(bbox_width / width, bbox_height / height)
+        size = None
+        if factor < 1:
+            size = (max(1, round(width * factor)), max(1, round(height * factor)))
+        if len(self._plans) >= self.MAX_PLANS:
+            self._plans.clear()
+        self._plans[shape] = size
+        return size
+
+    def output_shape(self, input_shape):
+        """ Returns the shape of the image that an input shape is resized to. """
+        size = self.plan(input_shape)
+        if size is None:
+            return tuple(input_shape)
+        return (size[1], size[0]) + tuple(input_shape[2:])
+
+    def empty(self, input_shape=None, dtype=np.uint8):
+        """
+        Allocates a destination array for `__call__`. The input shape can be
+        left out if it was given to the constructor and it is the only one.
+        """
+        if input_shape is None:
+            input_shape = next(iter(self._plans))
+        return np.empty(self.output_shape(input_shape), dtype=dtype)
+
+    def __call__(self, img, dst=None):
+        """
+        Shrinks an image to fit in the box. If `dst` is given, it must have
+        the shape from `output_shape` and the same type as `img`; the result
+        is written into it and it is returned.
+        """
+        size = self.plan(img.shape)
+        if size is None:
+            if dst is None:
+                return img
+            np.copyto(dst, img)
+            return dst
+
+        # cv2.resize drops the channel axis of a (h, w, 1) image, so resize
+        #   the 2D view of it and its destination instead
+        if img.ndim == 3 and img.shape[2] == 1:
+            out = dst if dst is not None else np.empty(self.output_shape(img.shape), img.dtype)
+            with profiler.stage('resize'):
+                cv2.resize(img[:, :, 0], size, dst=out[:, :, 0], interpolation=self.interpolation)
+            return out
+        with profiler.stage('resize'):
+            return cv2.resize(img, size, dst=dst, interpolation=self.interpolation)
+
+
+# Resizers for shrink_to_fit by bounding box
+_shrink_resizers = {}
+
+
+# libjpeg can decode a JPEG at 1/2, 1/4, or 1/8 of its size by skipping most
+# of the work of its inverse DCT, which is much faster than decoding all 12 MP
+# of a camera photo and then throwing most of the pixels away. OpenCV exposes
+# this through the IMREAD_REDUCED_* flags. Other formats (PNG, BMP, ...) are
+# always decoded at full size, so they are read normally.
+_REDUCED_COLOR = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                      4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def _exif_orientation(segment):
+    """
+    Returns the EXIF orientation (1-8) from the body of a JPEG APP1 segment,
+    1 if the segment has none, or None if it can't be read.
+    """
+    if not segment.startswith(b'Exif\x00\x00'):
+        return 1
+    tiff = segment[6:]
+    byteorder = {b'II': 'little', b'MM': 'big'}.get(tiff[:2])
+    if byteorder is None or len(tiff) < 8:
+        return None
+    offset = int.from_bytes(tiff[4:8], byteorder)
+    count = int.from_bytes(tiff[offset:offset+2], byteorder)
+    for i in range(count):
+        entry = tiff[offset+2+12*i:offset+14+12*i]
+        if len(entry) < 12:
+            return None
+        if int.from_bytes(entry[:2], byteorder) == 0x0112:
+            orientation = int.from_bytes(entry[8:10], byteorder)
+            return orientation if 1 <= orientation <= 8 else None
+    return 1
+
+
+def jpeg_size(f):
+    """
+    Reads the size of a JPEG image from its header, without decoding it, from
+    an open binary file. Returns (width, height) as the image will look
+    after cv2.imread applies its EXIF orientation (so a photo taken with the
+    camera on its side has its width and height swapped), or None if the
+    file is not a JPEG or its header can't be read.
+    """
+    if f.read(2) != b'\xff\xd8':
+        return None
+    orientation = 1
+    while True:
+        if f.read(1) != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            continue
+        if marker in (0xd9, 0xda):
+            return None
+        length = int.from_bytes(f.read(2), 'big') - 2
+        if length < 0:
+            return None
+
+        # Start Of Frame segments (except DHT, JPG, and DAC, which share the
+        #   range) hold the precision, height, and width
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            header = f.read(5)
+            if len(header) < 5 or orientation is None:
+                return None
+            height = int.from_bytes(header[1:3], 'big')
+            width = int.from_bytes(header[3:5], 'big')
+            if width == 0 or height == 0:
+                return None
+            return (height, width) if orientation >= 5 else (width, height)
+        if marker == 0xe1 and orientation == 1:
+            orientation = _exif_orientation(f.read(length))
+        else:
+            f.seek(length, 1)
+
+
+def reduced_imread_flag(size, bbox, grayscale=False):
+    """
+    Returns the cv2.imread flag that decodes an image of `size` (width,
+    height) at the smallest scale (1/8, 1/4, 1/2, or full) that is still at
+    least as big as shrink_to_fit would make it.
+    """
+    flags = _REDUCED_GRAYSCALE if grayscale else _REDUCED_COLOR
+    width, height = size
+    resizer = _shrink_resizers.get(tuple(bbox)) or Resizer(bbox)
+    out_size = resizer.plan((height, width))
+    if out_size is None:
+        return flags[1]
+    out_width, out_height = out_size
+    for scale in (8, 4, 2):
+        # libjpeg rounds the scaled size up
+        if -(-width // scale) >= out_width and -(-height // scale) >= out_height:
+            return flags[scale]
+    return flags[1]
+
+
+def imread_fit(filename, bbox=(640, 480), grayscale=False):
+    """
+    Reads an image file and shrinks it to fit in a bounding box, like
+    cv2.imread followed by shrink_to_fit, but JPEGs are decoded at a reduced
+    size when that is still big enough. Returns None if the file can't be
+    read, just like cv2.imread.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            size = jpeg_size(f)
+    except OSError:
+        return None
+    if size is None:
+        flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    else:
+        flag = reduced_imread_flag(size, bbox, grayscale)
+    with profiler.stage('imread'):
+        img = cv2.imread(filename, flag)
+    if img is None:
+        return None
+    return shrink_to_fit(img, bbox)
+
+
+def imdecode_fit(data, bbox=(640, 480), grayscale=False):
+    """ Same as imread_fit for an image file that is already in memory. """
+    size = jpeg_size(io.BytesIO(data))
+    if size is None:
+        flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
     else:
-        return img
\ No newline at end of file
+        flag = reduced_imread_flag(size, bbox, grayscale)
+    with profiler.stage('imread'):
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        return None
+    return shrink_to_fit(img, bbox)
+
+
+class PreprocessContext:
+    """
+    Reusable buffers for preprocessing a stream of frames that all have the
+    same shape, such as the frames from a camera. Every frame is written into
+    the same preallocated arrays instead of allocating new ones, which keeps
+    the memory allocator and the CPU cache from churning at high frame rates.
+
+    The context owns three buffers:
+     - resized: destination for shrinking a frame to fit the bounding box
+     - canvas: letterbox canvas that holds the frame, scaled to fit the DNN
+       blob without stretching, with black borders around it
+     - blob: normalized float32 blob with shape (1, 3, height, width)
+    """
+
+    def __init__(self, input_shape, bbox=(640, 480), blob_size=(224, 224)):
+        """
+        Args:
+         - input_shape: shape of the frames, e.g. `frame.shape`
+         - bbox: frames are shrunk to fit in this box by `shrink`
+         - blob_size: (width, height) of the DNN blob made by `make_blob`
+        """
+
+        # Same output size that shrink_to_fit calculates, computed once
+        height, width = input_shape[:2]
+        self.input_shape = tuple(input_shape)
+        self.resizer = Resizer(bbox, input_shape)
+        size = self.resizer.plan(input_shape)
+        if size is not None:
+            self.size = size
+            self.resized = self.resizer.empty()
+        else:
+            self.size = (width, height)
+            self.resized = None
+        self.gray = np.empty((self.size[1], self.size[0]), dtype=np.uint8)
+
+        # Letterbox geometry for the shrunken frames. The frame is scaled to
+        #   fit inside the blob and centered, so the objects keep their shape
+        #   instead of being stretched to a square.
+
+        blob_width, blob_height = blob_size
+        scale = min(blob_width / self.size[0], blob_height / self.size[1])
+        inner_width = round(self.size[0] * scale)
+        inner_height = round(self.size[1] * scale)
+        pad_x = (blob_width - inner_width) // 2
+        pad_y = (blob_height - inner_height) // 2
+        self.blob_size = blob_size
+        self.letterbox = (blob_width, blob_height, scale, pad_x, pad_y)
+        self.canvas = np.zeros((blob_height, blob_width, 3), dtype=np.uint8)
+        self._canvas_inner = self.canvas[pad_y:pad_y+inner_height, pad_x:pad_x+inner_width]
+        self.blob = np.empty((1, 3, blob_height, blob_width), dtype=np.float32)
+
+        # The blob is RGB in planar (channel first) order, while OpenCV images
+        #   are BGR with the channels interleaved. This view of the canvas
+        #   swaps the channels and puts them first without copying anything.
+        self._canvas_planar_rgb = self.canvas[:, :, ::-1].transpose(2, 0, 1)
+
+    def shrink(self, img):
+        """
+        Shrinks a frame to fit in the bounding box, just like shrink_to_fit,
+        but writes the result into the `resized` buffer. The returned image
+        is overwritten by the next call.
+        """
+        if self.resized is None:
+            return img
+        return self.resizer(img, dst=self.resized)
+
+    def to_gray(self, img):
+        """ Converts a shrunken BGR frame to grayscale in the `gray` buffer. """
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+    def make_blob(self, img):
+        """
+        Letterboxes a shrunken BGR frame into the canvas and then fills the
+        blob with its RGB values scaled to 0.0 - 1.0 (the same values that
+        cv2.dnn.blobFromImage(img, 1/255.0, size, swapRB=True) produces, but
+        without stretching the frame). Returns the blob.
+        """
+        cv2.resize(img, (self._canvas_inner.shape[1], self._canvas_inner.shape[0]),
+                   dst=self._canvas_inner)
+        np.multiply(self._canvas_planar_rgb, np.float32(1/255.0), out=self.blob[0])
+        return self.blob
+
+
+class AsyncImageWriter:
+    """
+    Background pool of threads that encode images and save them to a
+    directory. PNG and JPEG encoding is slow compared to drawing a few boxes,
+    so handing the encode to another thread lets the caller move on to the
+    next image right away. OpenCV releases the Python GIL while it encodes,
+    so the writer threads run in parallel with the caller.
+
+    At most `queue_size` images wait to be written. When the queue is full,
+    `write` blocks until a writer thread finishes an image, which keeps a
+    slow SD card from filling up memory.
+
+    The writer keeps a reference to each image until it has been saved, so
+    the caller must not modify (or reuse the buffer of) an image after
+    handing it to `write`.
+
+    With `workers=0` there are no threads and `write` saves the image before
+    it returns, which is what a worker process wants since it could exit
+    before a background thread finishes.
+    """
+
+    def __init__(self, output_dir, workers=2, queue_size=8, ext='.png', params=None):
+        """
+        Args:
+         - output_dir: directory for the images (created if needed)
+         - workers: number of encoding threads, or 0 to write immediately
+         - queue_size: max number of images waiting to be written
+         - ext: file extension, which picks the encoder ('.png', '.jpg', ...)
+         - params: encoder parameters for cv2.imwrite, such as
+           [cv2.IMWRITE_JPEG_QUALITY, 90]
+        """
+        self.output_dir = output_dir
+        self.ext = ext
+        self.params = params or []
+        self.written = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pool = None
+        if workers > 0:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def path(self, name):
+        """ Returns the file that `write(name, img)` saves to. """
+        return os.path.join(self.output_dir, f'{name}{self.ext}')
+
+    def write(self, name, img):
+        """
+        Queues an image to be saved as `name` plus the extension. The name
+        may include subdirectories, which are created as needed. Returns the
+        path of the file, which exists once the writer gets to it.
+        """
+        self._slots.acquire()
+        out_file = self.path(name)
+        if os.path.dirname(name):
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        if self._pool is None:
+            self._write(out_file, img)
+            return out_file
+        try:
+            self._pool.submit(self._write, out_file, img)
+        except Exception:
+            self._slots.release()
+            raise
+        return out_file
+
+    def _write(self, out_file, img):
+        time_start = time.perf_counter()
+        try:
+            with profiler.stage('encode'):
+                ok = cv2.imwrite(out_file, img, self.params)
+        except cv2.error:
+            ok = False
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.busy_seconds += time.perf_counter() - time_start
+            if ok:
+                self.written += 1
+            else:
+                self.errors += 1
+
+    def close(self):
+        """ Waits for the queued images to be written and stops the threads. """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+
+class DisplayManager:
+    """
+    Non-blocking results viewer. One GUI thread owns the window and the
+    OpenCV event loop (namedWindow, imshow, and waitKey all happen there),
+    and the caller hands it images through a queue with `show`. The images
+    are shrunk to thumbnails and tiled into a single mosaic window, a page
+    at a time, so the detector keeps running while the operator pages
+    through the results:
+
+      n, <SPACE>, <RIGHT>  --> next page
+      p, b, <LEFT>         --> previous page
+      f, <END>             --> follow the newest page again
+      q, <ESC>             --> close the window
+
+    The window follows the newest page as results arrive until the operator
+    pages back, and picks up following again from the last page.
+
+    Only the thumbnails are kept, and only the most recent `max_images` of
+    them, so a long run does not fill up the Pi's memory. The caller must
+    not modify an image after handing it to `show` until the GUI thread
+    has made its thumbnail.
+    """
+
+    # Key codes from cv2.waitKeyEx for the arrow keys differ by GUI backend
+    #   (GTK, Qt, Windows), so every known code is listed
+    KEYS_NEXT = {ord('n'), ord(' '), 65363, 2555904}
+    KEYS_PREV = {ord('p'), ord('b'), 65361, 2424832}
+    KEYS_FOLLOW = {ord('f'), 65367, 2293760}
+    KEYS_QUIT = {ord('q'), 27}
+
+    def __init__(self, title='Results', grid=(3, 2), cell_size=(256, 192),
+                 queue_size=16, max_images=300, start=True):
+        """
+        Args:
+         - title: title of the window
+         - grid: (columns, rows) of thumbnails on each page
+         - cell_size: (width, height) of each thumbnail in pixels
+         - queue_size: max number of images waiting for the GUI thread
+         - max_images: number of thumbnails to keep for paging back
+         - start: open the window right away (False is only useful for
+           calling `add` and `render` without a display)
+        """
+        self.title = title
+        self.grid = grid
+        self.cell_size = cell_size
+        self.max_images = max_images
+        self.page = 0
+        self.follow = True
+        self.dropped = 0
+        self.shown = 0
+        self._cells = []
+        self._first = 0     # number of the oldest thumbnail still kept
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def closed(self):
+        """ True once the operator has closed the window. """
+        return self._closed.is_set()
+
+    @property
+    def per_page(self):
+        return self.grid[0] * self.grid[1]
+
+    @property
+    def pages(self):
+        return max(1, -(-len(self._cells) // self.per_page))
+
+    def show(self, caption, img, block=True):
+        """
+        Queues an image for the mosaic with a caption underneath it. With
+        `block=False` the image is dropped (and counted in `dropped`) when
+        the GUI thread has fallen behind. Returns False if the image was not
+        queued, including after the window has been closed.
+        """
+        if self.closed:
+            return False
+        try:
+            self._queue.put((caption, img), block=block, timeout=1.0 if block else None)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def add(self, caption, img):
+        """ Adds a thumbnail of an image to the mosaic (GUI thread only). """
+        cell_w, cell_h = self.cell_size
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        height, width = img.shape[:2]
+        factor = min(cell_w / width, cell_h / height)
+        size = (max(1, int(width * factor)), max(1, int(height * factor)))
+        thumb = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        self._cells.append((caption, thumb))
+        self.shown += 1
+
+        # Forget the oldest page once there are too many thumbnails, so the
+        #   page numbers of the thumbnails that are kept do not shift
+        if len(self._cells) > self.max_images:
+            del self._cells[:self.per_page]
+            self._first += self.per_page
+            self.page = max(0, self.page - 1)
+        if self.follow:
+            self.page = self.pages - 1
+
+    def render(self, page=None):
+        """ Returns the mosaic image for a page (the current page by default). """
+        cols, rows = self.grid
+        cell_w, cell_h = self.cell_size
+        caption_h = 18
+        footer_h = 22
+        page = self.page if page is None else page
+
+        mosaic = np.zeros((rows * (cell_h + caption_h) + footer_h, cols * cell_w, 3), dtype=np.uint8)
+        start = page * self.per_page
+        for n, (caption, thumb) in enumerate(self._cells[start:start + self.per_page]):
+            x = (n % cols) * cell_w
+            y = (n // cols) * (cell_h + caption_h)
+            th, tw = thumb.shape[:2]
+            ox = x + (cell_w - tw) // 2
+            oy = y + (cell_h - th) // 2
+            mosaic[oy:oy+th, ox:ox+tw] = thumb
+            cv2.putText(mosaic, caption[:cell_w // 8], (x + 4, y + cell_h + caption_h - 5),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+        count = len(self._cells[start:start + self.per_page])
+        first = self._first + start + 1
+        status = (f'page {page+1}/{self.pages}  images {first}-{first+count-1} of {self.shown}'
+                  if count else 'waiting for results...')
+        if self.follow:
+            status += '  (following)'
+        status += '  [n]ext [p]rev [f]ollow [q]uit'
+        cv2.putText(mosaic, status, (4, mosaic.shape[0] - 7),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 204), 1, cv2.LINE_AA)
+        return mosaic
+
+    def handle_key(self, key):
+        """
+        Changes the page for a key code from cv2.waitKeyEx. Returns True if
+        the mosaic needs to be redrawn. Quit keys are handled by the caller.
+        """
+        if key in self.KEYS_NEXT:
+            self.page = min(self.page + 1, self.pages - 1)
+            self.follow = self.page == self.pages - 1
+        elif key in self.KEYS_PREV:
+            self.page = max(self.page - 1, 0)
+            self.follow = False
+        elif key in self.KEYS_FOLLOW:
+            self.page = self.pages - 1
+            self.follow = True
+        else:
+            return False
+        return True
+
+    def _window_open(self):
+        # Same checks as wait_for_window_to_close, including the aspect
+        #   ratio workaround for the Raspberry Pi
+        visible = cv2.getWindowProperty(self.title, cv2.WND_PROP_VISIBLE)
+        aratio = cv2.getWindowProperty(self.title, cv2.WND_PROP_ASPECT_RATIO)
+        return visible != 0.0 and aratio >= 0
+
+    def _run(self):
+        try:
+            cv2.namedWindow(self.title, cv2.WINDOW_AUTOSIZE)
+            cv2.imshow(self.title, self.render())
+            cv2.moveWindow(self.title, 50, 50)
+            while not self._stop.is_set():
+
+                # Take everything that has arrived, but redraw only once
+                dirty = False
+                while True:
+                    try:
+                        caption, img = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.add(caption, img)
+                    dirty = True
+
+                key = cv2.waitKeyEx(30)
+                if key in self.KEYS_QUIT:
+                    break
+                if key != -1:
+                    dirty |= self.handle_key(key)
+                if not self._window_open():
+                    break
+                if dirty:
+                    cv2.imshow(self.title, self.render())
+            cv2.destroyWindow(self.title)
+        except cv2.error:
+            pass
+        finally:
+            self._closed.set()
+
+    def wait(self):
+        """ Blocks until the operator closes the window. """
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        """ Closes the window (if it is still open) and stops the GUI thread. """
+        self._stop.set()
+        self.wait()
@@ -0,0 +1,319 @@
+
+# Prof Tallman
+# Streaming walker for directories (and trees of directories) of images.
+#
+# A camera that saves a photo every few seconds fills a folder with tens of
+# thousands of files per day, usually organized into one subdirectory per day
+# or per hour. Listing the whole tree before the detector starts wastes time
+# and memory, and mixed in with the photos there are usually a few files that
+# are not images at all (notes, labels, half-written uploads).
+#
+# `walk_images` is a generator: it hands out image files one at a time while
+# it is still scanning, so the detector can start on the first image right
+# away. Each directory is read with os.scandir, which gets the file type from
+# the directory listing without a separate stat() call for every file. Files
+# are filtered by their extension and then by their first few bytes (their
+# "magic number"), so a text file named photo.jpg is still skipped. The files
+# in each directory are sorted by name so that every run sees the same order.
+#
+# The optional manifest is a small SQLite database that remembers the size and
+# modification time of every file it has seen, and the modification time of
+# every directory. On the next run:
+#
+#   - A file whose size and mtime have not changed does not need its magic
+#     bytes checked again
+#   - With new_only=True, only files that are new (or changed) since the last
+#     run are handed out
+#   - With new_only=True, a directory whose mtime has not changed can not have
+#     gained or lost any files, so it is not listed at all; its subdirectories
+#     come from the manifest instead. On a capture tree with millions of old
+#     files, only the few directories that were written to are scanned.
+#
+# A file only counts as seen once the program is done with it: the walk hands
+# the file out, and the program calls `manifest.done(path)` after its result
+# has been saved. A directory's mtime is only saved once every file that was
+# handed out from it is done. A run that is interrupted part way through
+# therefore picks up the files it never got to on the next new_only run.
+#
+# Note that editing a file in place does not change its directory's mtime, so
+# new_only mode does not notice an edited file in an otherwise unchanged
+# directory. Capture trees only ever gain files, so that is fine here.
+#
+# References:
+#  - https://peps.python.org/pep-0471/ (os.scandir)
+#  - https://en.wikipedia.org/wiki/List_of_file_signatures
+#  - https://docs.python.org/3/library/sqlite3.html
+
+import threading
+import argparse
+import sqlite3
+import os
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.pgm', '.ppm')
+
+# How many manifest changes to save up before writing them to disk
+_COMMIT_EVERY = 1000
+
+
+def image_kind(path):
+    """
+    Identifies an image file by its first few bytes. Returns 'jpeg', 'png',
+    'bmp', 'tiff', 'webp', or 'pnm', or None if it is not a known image.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+    except OSError:
+        return None
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head.startswith(b'II*\x00') or head.startswith(b'MM\x00*'):
+        return 'tiff'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:2] in (b'P5', b'P6'):
+        return 'pnm'
+    return None
+
+
+class Manifest:
+    """
+    SQLite database of the files and directories seen by earlier walks. Use
+    it as a context manager, or call `close()`, so that the last changes are
+    saved. The walk may run on a different thread (the pipeline's feeder
+    thread) than the one that calls `done`, so every method takes a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                         '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, kind TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS dirs '
+                         '(path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)')
+        self._changes = 0
+        self._lock = threading.RLock()
+        self._pending = {}      # file handed out --> (directory, size, mtime_ns, kind)
+        self._open_dirs = {}    # directory --> [parent, mtime_ns, files pending, listed]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def get_file(self, path):
+        """ Returns the (size, mtime_ns, kind) saved for a file, or None. """
+        with self._lock:
+            return self._db.execute('SELECT size, mtime_ns, kind FROM files WHERE path = ?',
+                                    (path,)).fetchone()
+
+    def put_file(self, path, size, mtime_ns, kind):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                             (path, size, mtime_ns, kind))
+            self._changed()
+
+    def get_dir(self, path):
+        """ Returns the mtime_ns saved for a directory, or None. """
+        with self._lock:
+            row = self._db.execute('SELECT mtime_ns FROM dirs WHERE path = ?',
+                                   (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_dir(self, path, parent, mtime_ns):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                             (path, parent, mtime_ns))
+            self._changed()
+
+    def add_subdir(self, path, parent):
+        """ Records a subdirectory that has not been scanned yet. """
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)', (path, parent))
+            self._changed()
+
+    def subdirs(self, path):
+        """ Returns the saved subdirectories of a directory, sorted by name. """
+        with self._lock:
+            rows = self._db.execute('SELECT path FROM dirs WHERE parent = ?',
+                                    (path,)).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def open_dir(self, path, parent, mtime_ns):
+        """ Starts handing out the files of a directory (called by the walk). """
+        with self._lock:
+            self._open_dirs[path] = [parent, mtime_ns, 0, False]
+
+    def hand_out(self, path, directory, size, mtime_ns, kind):
+        """ Remembers a file that the walk handed out but that is not done yet. """
+        with self._lock:
+            self._pending[path] = (directory, size, mtime_ns, kind)
+            self._open_dirs[directory][2] += 1
+
+    def close_dir(self, path):
+        """ Marks the end of a directory's files (called by the walk). """
+        with self._lock:
+            self._open_dirs[path][3] = True
+            self._finish_dir(path)
+
+    def done(self, path):
+        """
+        Records a file that was handed out by the walk as seen, once its
+        result has been saved. Paths that the walk did not hand out (such as
+        a single image file named on the command line) are ignored.
+        """
+        with self._lock:
+            item = self._pending.pop(path, None)
+            if item is None:
+                return
+            directory, size, mtime_ns, kind = item
+            self.put_file(path, size, mtime_ns, kind)
+            self._open_dirs[directory][2] -= 1
+            self._finish_dir(directory)
+
+    def _finish_dir(self, path):
+        """ Saves a directory's mtime once it is listed and all its files are done. """
+        parent, mtime_ns, pending, listed = self._open_dirs[path]
+        if listed and pending == 0:
+            del self._open_dirs[path]
+            self.put_dir(path, parent, mtime_ns)
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= _COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._changes = 0
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._db.close()
+
+
+def walk_images(root, recursive=True, extensions=IMAGE_EXTENSIONS, check_magic=True,
+                manifest=None, new_only=False):
+    """
+    Generates the image files under a directory, sorted by name within each
+    directory and with the files of a directory before its subdirectories.
+
+    Args:
+     - root: directory to scan
+     - recursive: also scan subdirectories (symbolic links to directories
+       are not followed, so a link loop can not trap the walk)
+     - extensions: lowercase file extensions that count as images
+     - check_magic: skip files whose first bytes are not a known image format
+     - manifest: optional Manifest that remembers what earlier walks saw
+     - new_only: with a manifest, only generate files that are new or have
+       changed since the last walk
+
+    With a manifest, the caller must call `manifest.done(path)` for each file
+    once its result has been saved. Only then is the file recorded as seen,
+    so in new_only mode a file is handed out again by the next walk if the
+    program quit before it was done.
+    """
+
+    # The manifest keys each directory by its path, and a subdirectory by
+    #   the path of its parent, so 'cap/' and 'cap' must be the same key
+    root = os.path.normpath(root)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+
+        # An unchanged directory has the same entries as last time, so in
+        #   new_only mode it holds nothing new and only its subdirectories
+        #   need a look
+        try:
+            dir_mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        if new_only and manifest is not None and manifest.get_dir(directory) == dir_mtime:
+            if recursive:
+                stack.extend(reversed(manifest.subdirs(directory)))
+            continue
+
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        if manifest is not None:
+            manifest.open_dir(directory, os.path.dirname(directory) if directory != root else None,
+                              dir_mtime)
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+
+            # Files that have not changed since the last walk keep the kind
+            #   that was saved for them, which saves opening the file
+            kind = 'unchecked'
+            if manifest is not None:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                saved = manifest.get_file(entry.path)
+                unchanged = saved is not None and saved[:2] == (stat.st_size, stat.st_mtime_ns)
+                if unchanged and new_only:
+                    continue
+                if unchanged:
+                    kind = saved[2]
+                elif check_magic:
+                    kind = image_kind(entry.path)
+
+                # Files that are not images are done as soon as they are
+                #   checked, but images are only done once the caller says so
+                if kind is None:
+                    manifest.put_file(entry.path, stat.st_size, stat.st_mtime_ns, kind)
+                else:
+                    manifest.hand_out(entry.path, directory, stat.st_size,
+                                      stat.st_mtime_ns, kind)
+            elif check_magic:
+                kind = image_kind(entry.path)
+
+            if kind is not None:
+                yield entry.path
+
+        if manifest is not None:
+            for subdir in subdirs:
+                manifest.add_subdir(subdir, directory)
+            manifest.close_dir(directory)
+        if recursive:
+            stack.extend(reversed(subdirs))
+
+    if manifest is not None:
+        manifest.commit()
+
+
+def add_arguments(parser):
+    """ Adds the command line options for finding image files to a parser. """
+    group = parser.add_argument_group('image files')
+    group.add_argument('--recursive', action=argparse.BooleanOptionalAction, default=True,
+                       help='also look for images in subdirectories (default: yes)')
+    group.add_argument('--manifest', metavar='FILE',
+                       help='remember the files that were seen in this database')
+    group.add_argument('--new-only', action='store_true',
+                       help='with --manifest, only process images added since the last run')
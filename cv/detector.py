@@ -0,0 +1,310 @@
+
+# Prof Tallman
+# Common engine interface for the object detectors.
+#
+# yolo.py, haar.py, and hog.py all do the same things in the same order: parse
+# the command line, list the image files, shrink each image, detect objects,
+# time it, and draw boxes. The only real difference between them is the model.
+# YOLO is a Deep Neural Network loaded from three files, HAAR is a Cascade
+# Classifier loaded from one XML file, and HOG is a descriptor built into
+# OpenCV. Each model is also called in its own way.
+#
+# The Detector class hides those differences behind one small interface:
+#
+#   detector = YoloDetector(confidence=0.8)   # or HaarDetector, HogDetector
+#   detector.load()                           # load the model (slow)
+#   results = detector.detect([img1, img2])   # one list of objects per image
+#   detector.close()                          # free the model
+#
+# Every object is a tuple of (label, score, [x, y, w, h]). The score is None
+# when the model does not produce one (HAAR).
+#
+# Anything that works with a Detector, such as the headless pipeline, video
+# files, the result cache, tiling, and tracker.py, works with every backend. Each script
+# defines its own backend class next to the functions that it wraps, and this
+# module finds them by name with `create`.
+#
+# A detector that has not been loaded yet is just its parameters, so it can be
+# sent to worker processes, which then call `load()` for themselves.
+
+import importlib
+import argparse
+import time
+import cv2
+import sys
+import os
+import cv2util
+import pipeline
+import dataset
+import cache
+import video
+import profiler
+
+
+# Backend classes by name, as (module, class) so that a backend's module is
+# only imported when that backend is used
+BACKENDS = {
+    'yolo': ('yolo', 'YoloDetector'),
+    'haar': ('haar', 'HaarDetector'),
+    'hog': ('hog', 'HogDetector'),
+}
+
+
+class Detector:
+    """
+    Base class for the detector backends. Subclasses set `name`, `title`, and
+    `noun` and implement `_load`, `_detect`, and (optionally) the command
+    line methods `add_arguments` and `from_args`.
+    """
+
+    name = 'detector'
+    title = 'Object Detector'
+    noun = 'objects'
+
+    # Draw a crosshair at the center of each box in addition to the box
+    crosshairs = False
+
+    def __init__(self, **params):
+        self.params = params
+        self.model = None
+
+    def __str__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        params = ', '.join(f'{k}={v}' for k, v in self.params.items())
+        return f"{type(self).__name__}({params}) {state}"
+
+    def __enter__(self):
+        return self.load()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        # Models can not be pickled, so a detector sent to another process
+        # travels without its model and is loaded again on the other side
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    @property
+    def model_files(self):
+        """ List of files that the model is loaded from. """
+        return []
+
+    def load(self):
+        """ Loads the model, if it is not already loaded. Returns self. """
+        if self.model is None:
+            self.model = self._load()
+        return self
+
+    def close(self):
+        """ Releases the model. """
+        self.model = None
+
+    def detect(self, frames):
+        """
+        Detects objects in a list of images (BGR or grayscale). Returns a list
+        with one list of (label, score, [x, y, w, h]) objects per image.
+        """
+        if self.model is None:
+            self.load()
+        with profiler.stage(f'{self.name}.detect'):
+            return self._detect(frames)
+
+    def detect_tiles(self, tiles):
+        """
+        Detects objects in the tiles of a larger image (see tiling.py). Same
+        as `detect` unless the backend needs different settings for tiles.
+        """
+        return self.detect(tiles)
+
+    def identity(self):
+        """ Describes the detector for the result cache. """
+        return cache.detector_identity(self.name, self.params, self.model_files)
+
+    def annotate(self, img, objects):
+        """ Draws the objects onto the image. The image is modified in place. """
+        neon = (0, 255, 204)
+        for label, score, (x, y, w, h) in objects:
+            if self.crosshairs:
+                cv2util.draw_target(img, (x, y, w, h), neon)
+            else:
+                cv2.rectangle(img, (x, y), (x+w, y+h), neon, 2)
+
+    def describe(self, obj):
+        """ Returns a line of text that describes one object for the console. """
+        label, score, (x, y, w, h) = obj
+        ctr_x = x + w // 2
+        ctr_y = y + h // 2
+        if score is None:
+            return f'  => {label} ({ctr_x}, {ctr_y}) bbox {x},{y}->{x+w},{y+h}'
+        return f'  => {label}: {100*score:.1f} at ({x},{y})->({x+w},{y+h})'
+
+    @classmethod
+    def add_arguments(cls, parser):
+        """ Adds the backend's parameters to an argparse parser. """
+        pass
+
+    @classmethod
+    def from_args(cls, args):
+        """ Creates the backend from the parameters added by `add_arguments`. """
+        return cls()
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _detect(self, frames):
+        raise NotImplementedError
+
+
+def create(name, **params):
+    """ Creates a detector backend by name: 'yolo', 'haar', or 'hog'. """
+    module_name, class_name = BACKENDS[name]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(**params)
+
+
+def list_image_files(file_arg, recursive=True, manifest=None, new_only=False):
+    """
+    Returns the image files named by a command line argument, which can be an
+    image file or a directory that contains images. A directory is scanned
+    by a generator (see dataset.py), so the files come out while the scan is
+    still running.
+    """
+    if os.path.isfile(file_arg):
+        return [file_arg]
+    return dataset.walk_images(file_arg, recursive, manifest=manifest, new_only=new_only)
+
+
+def has_display():
+    """ Returns False on a Linux computer without a desktop to open windows on. """
+    if not sys.platform.startswith('linux'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def main(detector_class, description, bbox=(640, 480)):
+    """
+    Command line program shared by yolo.py, haar.py, and hog.py. Runs the
+    detector over an image file or a directory of images, either showing the
+    results in a GUI window or through the headless pipeline.
+    """
+
+    # Command line parameters must be an image file or a dir containing images
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('file', help='an image file, a directory of images, or a video file')
+    detector_class.add_arguments(parser.add_argument_group(f'{detector_class.name} parameters'))
+    dataset.add_arguments(parser)
+    pipeline.add_arguments(parser)
+    video.add_arguments(parser)
+    add_display_arguments(parser)
+    profiler.add_arguments(parser)
+    args = parser.parse_args()
+
+    file_arg = args.file
+    if not os.path.exists(file_arg):
+        print(f"Error: '{file_arg}' does not exist")
+        exit()
+
+    detector = detector_class.from_args(args)
+    for filename in detector.model_files:
+        if not os.path.exists(filename):
+            print(f"Error: '{filename}' does not exist")
+            return
+
+    # Video files are always processed without a window (see video.py)
+
+    if args.profile and args.workers > 0:
+        print("Warning: --profile only times the main process, not the --workers")
+    if os.path.isfile(file_arg) and video.is_video_file(file_arg):
+        with profiler.session(args):
+            video.run_from_args(args, file_arg, detector, bbox)
+        return
+    if args.new_only and not args.manifest:
+        print("Error: --new-only needs a --manifest file")
+        exit()
+    manifest = dataset.Manifest(args.manifest) if args.manifest else None
+    image_files = list_image_files(file_arg, args.recursive, manifest, args.new_only)
+    try:
+        with profiler.session(args):
+            run_images(args, image_files, detector, bbox, manifest)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+def run_images(args, image_files, detector, bbox, manifest=None):
+    """
+    Runs the detector over the image files, headless or in a window. Each
+    file is marked done in the manifest (if any) once its result is out.
+    """
+    done = manifest.done if manifest is not None else None
+
+    # Headless mode overlaps image decoding and encoding with the detector
+    # and never opens a window. The model is loaded by the pipeline (or by
+    # each of its worker processes). Saving the images (--output) only makes
+    # sense without a human at the keyboard, and a Pi without a desktop has
+    # nowhere to open a window, so both of those run headless too.
+
+    if args.headless or args.workers > 0 or args.output or not has_display():
+        pipeline.run_from_args(args, image_files, detector, bbox, done)
+        return
+
+    time_start = time.time()
+    detector.load()
+    time_end = time.time()
+    duration = time_end - time_start
+    print(f'{detector.title} load time {duration:.3f}s')
+
+    # Run through each image file one a time:
+    #  1. Resize image to 640x480 and detect the objects in the image
+    #  2. Print the results to the console window
+    #  3. Draw the bounding boxes and hand the image to the results window
+    # The results window runs on its own thread (see cv2util.DisplayManager)
+    # and tiles the images into pages of thumbnails, so the detector keeps
+    # going while the user pages back and forth through the results. Once
+    # every image is done the window stays open until the user closes it.
+
+    with detector, cv2util.DisplayManager(detector.title, args.mosaic, args.mosaic_cell) as display:
+        for filename in image_files:
+            if display.closed:
+                print("Results window closed... Quitting Program")
+                break
+
+            time_start = time.time()
+            img = cv2util.imread_fit(filename, bbox)
+            if img is None:
+                print(f"Error: cv2 could not open image file '{filename}'")
+                if done is not None:
+                    done(filename)
+                continue
+            objects = detector.detect([img])[0]
+            time_end = time.time()
+            duration = time_end - time_start
+
+            print(f'{filename}: detected {len(objects)} {detector.noun} in {duration:.3f}s')
+            for obj in objects:
+                print(detector.describe(obj))
+            with profiler.stage('annotate'):
+                detector.annotate(img, objects)
+            display.show(f'{os.path.basename(filename)}: {len(objects)}', img)
+            if done is not None:
+                done(filename)
+
+        if not display.closed:
+            print(f'Done with {display.shown} images; close the results window to quit')
+        display.wait()
+
+
+def add_display_arguments(parser):
+    """ Adds the command line options for the results window to a parser. """
+    group = parser.add_argument_group('results window')
+    group.add_argument('--mosaic', type=pipeline.size_arg, default=(3, 2), metavar='COLSxROWS',
+                       help='number of thumbnails on each page of results (default: 3x2)')
+    group.add_argument('--mosaic-cell', type=pipeline.size_arg, default=(256, 192), metavar='WxH',
+                       help='size of each thumbnail (default: 256x192)')
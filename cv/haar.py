@@ -7,75 +7,98 @@
 #  - https://github.com/automaticdai/rpi-object-detection/tree/master
 #  - https://docs.opencv.org/3.4/db/d28/tutorial_cascade_classifier.html
 
-import time
 import cv2
-import sys
-import os
-import cv2util
+import detector
+import nms
+import profiler
 
-def main():
 
-    # Load a pre-trained model to detect faces in an image
-
-    haar_weights_file = 'haarcascade_frontalface_default.xml'
-    if os.path.exists(haar_weights_file):
-        time_start = time.time()
-        haar_faces = cv2.CascadeClassifier(haar_weights_file)
-        time_end = time.time()
-        duration = time_end - time_start
-        print(f"HAAR Frontal Face (default) load time {duration:.3f}s")
-    else:
-        print(f"Error: '{haar_weights_file}' does not exist")
-        return
-
-    # Command line parameters must be an image file or a dir containing images
-
-    if len(sys.argv) < 2:
-        print(f"Error: missing filename")
-        print(f"Usage: python {sys.argv[0]} <file>")
-        exit()
-    file_arg = sys.argv[1]
-    if not os.path.exists(file_arg):
-        print(f"Error: '{file_arg}' does not exist")
-        exit()
-    if os.path.isfile(file_arg):
-        image_files = [file_arg]
-    else:
-        image_files = [f"{file_arg}/{name}" for name in os.listdir(file_arg)]
-
-    # Pass each image file to the HAAR classifier for **SPEED**:
-    #  1. Resize image to 640x480 and convert to grayscale
-    #  2. Detect faces
-    #  3. Draw the image with bounding boxes in a GUI window
-    #  4. Wait for the current GUI window to close
-
-    for filename in image_files:
-    
-        time_start = time.time()
-        img = cv2.imread(filename)
-        if img is None:
-            print(f"Error: cv2 could not open image file '{filename}'")
-            continue
-        img = cv2util.shrink_to_fit(img, (640, 480))
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = haar_faces.detectMultiScale(gray, 1.1, 4)
-        time_end = time.time()
-        duration = time_end - time_start
-
-        neon = (0, 255, 204)
-        print(f'{filename}: detected {len(faces)} faces in {duration:.3f}s')
-        for (x, y, w, h) in faces:
-            ctr_x = x + w // 2
-            ctr_y = y + h // 2
-            cv2.rectangle(img, (x, y), (x+w, y+h), neon, 2)
-            cv2.line(img, (ctr_x-5, ctr_y), (ctr_x+5, ctr_y), neon, 2)
-            cv2.line(img, (ctr_x, ctr_y-5), (ctr_x, ctr_y+5), neon, 2)
-            print(f'  => ({ctr_x}, {ctr_y}) bbox {x},{y}->{x+w},{y+h}')
-
-        cv2.namedWindow(filename)
-        cv2.imshow(filename, img)
-        cv2.moveWindow(filename, 50, 50)
-        cv2util.wait_for_window_to_close(filename)
+def load_haar_cascade(weights_file='haarcascade_frontalface_default.xml'):
+    """
+    Loads a pre-trained HAAR Cascade Classifier from its XML weights file.
+    """
+
+    return cv2.CascadeClassifier(weights_file)
+
+
+def detect_faces(img, haar_faces, scale_factor=1.1, min_neighbors=4,
+                 nms_threshold=0.3, min_size=None, max_size=None):
+    """
+    Detects faces in a BGR or grayscale image with a HAAR Cascade Classifier.
+    Overlapping faces are removed with Non-Maxima Suppression (see nms.py),
+    keeping the largest; pass `nms_threshold=None` to keep them all.
+
+    `min_size` and `max_size` are (width, height) limits on the faces to look
+    for. The cascade skips the pyramid levels outside of them, so a narrow
+    band of sizes is much faster to search than the default (any size).
+
+    Returns a list of objects, each defined as a tuple:
+      0. Label, which is always 'face'
+      1. Confidence score, which is always None for the HAAR classifier
+      2. Bounding box for the face
+    """
+
+    with profiler.stage('haar.gray'):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with profiler.stage('haar.cascade'):
+        faces = haar_faces.detectMultiScale(gray, scale_factor, min_neighbors,
+                                            minSize=min_size or (0, 0),
+                                            maxSize=max_size or (0, 0))
+    objects = [('face', None, [int(v) for v in box]) for box in faces]
+    if nms_threshold is None:
+        return objects
+    with profiler.stage('haar.nms'):
+        return nms.suppress(objects, nms_threshold)
+
+
+class HaarDetector(detector.Detector):
+    """
+    Detector engine backend for a HAAR Cascade Classifier. The model is the
+    cv2.CascadeClassifier loaded from the weights file.
+    """
+
+    name = 'haar'
+    title = 'HAAR Frontal Face (default)'
+    noun = 'faces'
+    crosshairs = True
+
+    def __init__(self, weights_file='haarcascade_frontalface_default.xml',
+                 scale_factor=1.1, min_neighbors=4, nms_threshold=0.3, min_size=None):
+        super().__init__(weights_file=weights_file, scale_factor=scale_factor,
+                         min_neighbors=min_neighbors, nms_threshold=nms_threshold,
+                         min_size=min_size)
+
+    @property
+    def model_files(self):
+        return [self.params['weights_file']]
+
+    def _load(self):
+        return load_haar_cascade(self.params['weights_file'])
+
+    def _detect(self, frames):
+        p = self.params
+        return [detect_faces(img, self.model, p['scale_factor'], p['min_neighbors'],
+                             p['nms_threshold'], p['min_size'])
+                for img in frames]
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument('--weights', default='haarcascade_frontalface_default.xml',
+                            help='HAAR Cascade XML weights file')
+        parser.add_argument('--scale-factor', type=float, default=1.1,
+                            help='image pyramid scale factor (default: 1.1)')
+        parser.add_argument('--min-neighbors', type=int, default=4,
+                            help='neighbors needed to keep a face (default: 4)')
+        parser.add_argument('--nms-threshold', type=float, default=0.3,
+                            help='Non-Maxima Suppression threshold (default: 0.3)')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.weights, args.scale_factor, args.min_neighbors, args.nms_threshold)
+
+
+def main():
+    detector.main(HaarDetector, 'HAAR facial detection')
 
 
 if __name__ == '__main__':
@@ -9,73 +9,90 @@
 #  - https://debuggercafe.com/opencv-hog-for-accurate-and-fast-person-detection/
 
 
-import time
+import numpy as np
 import cv2
-import sys
-import os
-import cv2util
+import detector
+import nms
+import profiler
 
-def main():
 
-    # Load a pre-trained model to detect faces in an image
+def load_hog_people_detector():
+    """
+    Creates a HOG Descriptor that uses OpenCV's pre-trained people detector.
+    """
 
-    time_start = time.time()
     hog_coeffs = cv2.HOGDescriptor_getDefaultPeopleDetector()
     #hog_coeffs = cv2.HOGDescriptor_getDaimlerPeopleDetector()
     hog_people = cv2.HOGDescriptor()
     hog_people.setSVMDetector(hog_coeffs)
-    time_end = time.time()
-    duration = time_end - time_start
-    print(f"HOG People Detector load time {duration:.3f}s")
-
-    # Command line parameters must be an image file or a dir containing images
-
-    if len(sys.argv) < 2:
-        print(f"Error: missing filename")
-        print(f"Usage: python {sys.argv[0]} <file>")
-        exit()
-    file_arg = sys.argv[1]
-    if not os.path.exists(file_arg):
-        print(f"Error: '{file_arg}' does not exist")
-        exit()
-    if os.path.isfile(file_arg):
-        image_files = [file_arg]
-    else:
-        image_files = [f"{file_arg}/{name}" for name in os.listdir(file_arg)]
-
-    # Pass each image file to the HAAR classifier for **SPEED**:
-    #  1. Resize image to 640x480 and convert to grayscale
-    #  2. Detect faces
-    #  3. Draw the image with bounding boxes in a GUI window
-    #  4. Wait for the current GUI window to close
-
-    for filename in image_files:
-    
-        time_start = time.time()
-        img = cv2.imread(filename)
-        if img is None:
-            print(f"Error: cv2 could not open image file '{filename}'")
-            continue
-        img = cv2util.shrink_to_fit(img, (640, 480))
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        boxes, weights = hog_people.detectMultiScale(gray, winStride=(1,1), scale = 1.1)
-        time_end = time.time()
-        duration = time_end - time_start
-
-        neon = (0, 255, 204)
-        print(f'{filename}: detected {len(boxes)} faces in {duration:.3f}s')
-        for (x, y, w, h) in boxes:
-            ctr_x = x + w // 2
-            ctr_y = y + h // 2
-            cv2.rectangle(img, (x, y), (x+w, y+h), neon, 2)
-            cv2.line(img, (ctr_x-5, ctr_y), (ctr_x+5, ctr_y), neon, 2)
-            cv2.line(img, (ctr_x, ctr_y-5), (ctr_x, ctr_y+5), neon, 2)
-            print(f'  => ({ctr_x}, {ctr_y}) bbox {x},{y}->{x+w},{y+h}')
-
-        cv2.namedWindow(filename)
-        cv2.imshow(filename, img)
-        cv2.moveWindow(filename, 50, 50)
-        cv2util.wait_for_window_to_close(filename)
+    return hog_people
+
+
+def detect_people(img, hog_people, win_stride=(1,1), scale=1.1, nms_threshold=0.3):
+    """
+    Detects people in a BGR or grayscale image with a HOG Descriptor and its
+    SVM. The sliding window finds most people several times, so overlapping
+    boxes are removed with Non-Maxima Suppression (see nms.py); pass
+    `nms_threshold=None` to keep them all.
+
+    Returns a list of objects, each defined as a tuple:
+      0. Label, which is always 'person'
+      1. SVM weight, a confidence score for the detection
+      2. Bounding box for the person
+    """
+
+    with profiler.stage('hog.gray'):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with profiler.stage('hog.svm'):
+        boxes, weights = hog_people.detectMultiScale(gray, winStride=win_stride, scale=scale)
+    objects = [('person', float(weight), [int(v) for v in box])
+               for box, weight in zip(boxes, np.ravel(weights))]
+    if nms_threshold is None:
+        return objects
+    with profiler.stage('hog.nms'):
+        return nms.suppress(objects, nms_threshold)
+
+
+class HogDetector(detector.Detector):
+    """
+    Detector engine backend for the HOG people detector. The model is the
+    cv2.HOGDescriptor with OpenCV's default people SVM.
+    """
+
+    name = 'hog'
+    title = 'HOG People Detector'
+    noun = 'people'
+    crosshairs = True
+
+    def __init__(self, win_stride=(1,1), scale=1.1, nms_threshold=0.3):
+        super().__init__(svm='default_people', win_stride=tuple(win_stride), scale=scale,
+                         nms_threshold=nms_threshold)
+
+    def _load(self):
+        return load_hog_people_detector()
+
+    def _detect(self, frames):
+        p = self.params
+        return [detect_people(img, self.model, p['win_stride'], p['scale'],
+                              p['nms_threshold'])
+                for img in frames]
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument('--win-stride', type=int, default=1, metavar='N',
+                            help='sliding window step in pixels (default: 1)')
+        parser.add_argument('--scale', type=float, default=1.1,
+                            help='image pyramid scale factor (default: 1.1)')
+        parser.add_argument('--nms-threshold', type=float, default=0.3,
+                            help='Non-Maxima Suppression threshold (default: 0.3)')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls((args.win_stride, args.win_stride), args.scale, args.nms_threshold)
+
+
+def main():
+    detector.main(HogDetector, 'HOG people detection')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,317 @@
+
+# Prof Tallman
+# Registry of the object detection models that yolo.py can load.
+#
+# The full YOLOv3 network is accurate but it is also huge: 240 MB of weights
+# and several seconds per image on a Raspberry Pi 4. Smaller networks give up
+# some accuracy for a lot of speed, and OpenCV's DNN module can load several
+# kinds of them through the same `cv2.dnn.readNet` call:
+#
+#   yolov3       --> Darknet config + weights, the original model (slow)
+#   yolov3-tiny  --> Darknet config + weights, about 20x less work than yolov3
+#   yolov5n/s    --> ONNX files exported from the Ultralytics YOLOv5 repo
+#   yolov8n      --> ONNX file exported from the Ultralytics YOLOv8 package
+#
+# Each model lists its files, its default blob size, the layout of its output
+# layer, and its published COCO accuracy (mAP at IoU 0.5) at the blob sizes it
+# was published for, which is only used to rank the models against each
+# other. A smaller blob is faster but less accurate, so the ranking uses the
+# accuracy at the blob size the model will actually run at. The ONNX models produce their
+# outputs in a different layout than Darknet, so `to_darknet_rows` converts
+# them into the Darknet layout that yolo.decode_yolo_outputs understands.
+#
+# OpenCV can also run the network on different backends and targets, such as
+# OpenCL on a GPU or the Intel Inference Engine on a Neural Compute Stick.
+# Which ones actually work depends on how OpenCV was built.
+#
+# Finally, `select_model` times every model that is installed, at the blob
+# size it will run at, and picks the most accurate one that runs within a
+# latency budget, so the same command
+# line can pick yolov3 on a desktop and yolov3-tiny on a Pi.
+#
+# References:
+#  - https://docs.opencv.org/4.x/d6/d0f/group__dnn.html
+#  - https://pjreddie.com/darknet/yolo/
+#  - https://github.com/ultralytics/yolov5/releases
+#  - https://docs.ultralytics.com/modes/export/
+
+import numpy as np
+import statistics
+import time
+import cv2
+import sys
+import os
+
+
+# Output layouts:
+#   darknet --> rows of [cx, cy, w, h, objectness, 80 class scores], with the
+#               box as fractions of the image and the class scores already
+#               multiplied by the objectness
+#   yolov5  --> (1, rows, 85) like darknet but with the box in blob pixels and
+#               the class scores not yet multiplied by the objectness
+#   yolov8  --> (1, 84, rows) with [cx, cy, w, h, 80 class scores] in blob
+#               pixels and no objectness score at all
+
+MODELS = {
+    'yolov3': {
+        'config': 'yolov3.cfg',
+        'weights': 'yolov3.weights',
+        'labels': 'coco.names',
+        'layout': 'darknet',
+        'blob_size': (224, 224),
+        'fixed_size': False,
+        'accuracy': {320: 51.5, 416: 55.3, 608: 57.9},
+    },
+    'yolov3-tiny': {
+        'config': 'yolov3-tiny.cfg',
+        'weights': 'yolov3-tiny.weights',
+        'labels': 'coco.names',
+        'layout': 'darknet',
+        'blob_size': (416, 416),
+        'fixed_size': False,
+        'accuracy': {416: 33.1},
+    },
+    'yolov5n': {
+        'config': None,
+        'weights': 'yolov5n.onnx',
+        'labels': 'coco.names',
+        'layout': 'yolov5',
+        'blob_size': (640, 640),
+        'fixed_size': True,
+        'accuracy': {640: 45.7},
+    },
+    'yolov5s': {
+        'config': None,
+        'weights': 'yolov5s.onnx',
+        'labels': 'coco.names',
+        'layout': 'yolov5',
+        'blob_size': (640, 640),
+        'fixed_size': True,
+        'accuracy': {640: 56.8},
+    },
+    'yolov8n': {
+        'config': None,
+        'weights': 'yolov8n.onnx',
+        'labels': 'coco.names',
+        'layout': 'yolov8',
+        'blob_size': (640, 640),
+        'fixed_size': True,
+        'accuracy': {640: 52.6},
+    },
+}
+
+# DNN backends and targets by name. Not every OpenCV build has every one of
+# these, so the names are looked up when they are used.
+BACKENDS = {
+    'default': 'DNN_BACKEND_DEFAULT',
+    'opencv': 'DNN_BACKEND_OPENCV',
+    'inference-engine': 'DNN_BACKEND_INFERENCE_ENGINE',
+    'vulkan': 'DNN_BACKEND_VKCOM',
+    'cuda': 'DNN_BACKEND_CUDA',
+    'timvx': 'DNN_BACKEND_TIMVX',
+}
+TARGETS = {
+    'cpu': 'DNN_TARGET_CPU',
+    'opencl': 'DNN_TARGET_OPENCL',
+    'opencl-fp16': 'DNN_TARGET_OPENCL_FP16',
+    'myriad': 'DNN_TARGET_MYRIAD',
+    'vulkan': 'DNN_TARGET_VULKAN',
+    'cuda': 'DNN_TARGET_CUDA',
+    'cuda-fp16': 'DNN_TARGET_CUDA_FP16',
+    'npu': 'DNN_TARGET_NPU',
+}
+
+
+def register(name, weights, labels='coco.names', config=None, layout='darknet',
+             blob_size=(416, 416), fixed_size=False, accuracy=0.0):
+    """
+    Adds a model to the registry, such as a custom Darknet or ONNX network
+    that was trained on your own images. See MODELS for the meaning of each
+    field. `accuracy` is either one mAP at `blob_size` or a dictionary of
+    {blob width: mAP}.
+    """
+    if not isinstance(accuracy, dict):
+        accuracy = {blob_size[0]: accuracy}
+    MODELS[name] = {
+        'config': config,
+        'weights': weights,
+        'labels': labels,
+        'layout': layout,
+        'blob_size': tuple(blob_size),
+        'fixed_size': fixed_size,
+        'accuracy': accuracy,
+    }
+
+
+def model_files(name, model_dir='.'):
+    """ Returns the list of files that a model is loaded from. """
+    spec = MODELS[name]
+    names = [spec['labels'], spec['config'], spec['weights']]
+    return [os.path.join(model_dir, f) for f in names if f is not None]
+
+
+def installed_models(model_dir='.'):
+    """ Returns the names of the models whose files are all present. """
+    return [name for name in MODELS
+            if all(os.path.exists(f) for f in model_files(name, model_dir))]
+
+
+def _dnn_constant(table, name, kind):
+    if name not in table or not hasattr(cv2.dnn, table[name]):
+        raise ValueError(f"DNN {kind} '{name}' is not available in this OpenCV build")
+    return getattr(cv2.dnn, table[name])
+
+
+def load_model(name='yolov3', model_dir='.', backend='default', target='cpu', threads=None):
+    """
+    Loads a model from the registry with cv2.dnn.readNet.
+
+    Args:
+     - name: name of the model in MODELS
+     - model_dir: directory that holds the model's files
+     - backend: name of the DNN backend (see BACKENDS)
+     - target: name of the DNN target device (see TARGETS)
+     - threads: value for cv2.setNumThreads, or None for OpenCV's default
+
+    Returns a tuple containing 3 objects:
+      0. The DNN object
+      1. List of the DNN's output layers by name
+      2. List of the classification labels
+    """
+
+    if name not in MODELS:
+        raise ValueError(f"Unknown model '{name}' (choose from {', '.join(MODELS)})")
+    spec = MODELS[name]
+    if threads is not None:
+        cv2.setNumThreads(threads)
+
+    with open(os.path.join(model_dir, spec['labels']), 'r') as f:
+        dnn_labels = [line.strip('\n') for line in f]
+
+    weights_path = os.path.join(model_dir, spec['weights'])
+    if spec['config'] is None:
+        dnn_object = cv2.dnn.readNet(weights_path)
+    else:
+        dnn_object = cv2.dnn.readNet(weights_path, os.path.join(model_dir, spec['config']))
+    dnn_object.setPreferableBackend(_dnn_constant(BACKENDS, backend, 'backend'))
+    dnn_object.setPreferableTarget(_dnn_constant(TARGETS, target, 'target'))
+    dnn_layers = dnn_object.getUnconnectedOutLayersNames()
+
+    return (dnn_object, dnn_layers, dnn_labels)
+
+
+def to_darknet_rows(outputs, layout, blob_size):
+    """
+    Converts the output layers of a model into the Darknet layout that
+    yolo.decode_yolo_outputs expects. Returns a list of 2D arrays.
+    """
+
+    if layout == 'darknet':
+        return outputs
+
+    blob_w, blob_h = blob_size
+    rows = outputs[0]
+    if layout == 'yolov8':
+        # (1, 84, N) --> (N, 84), then add an objectness column that is the
+        #   best class score so that the columns line up with Darknet's
+        rows = rows.reshape(rows.shape[-2], rows.shape[-1]).T
+        class_scores = rows[:, 4:]
+        objectness = class_scores.max(axis=1, keepdims=True)
+        rows = np.hstack([rows[:, :4], objectness, class_scores])
+    else:
+        rows = rows.reshape(-1, rows.shape[-1]).copy()
+        rows[:, 5:] *= rows[:, 4:5]
+
+    rows[:, :4] /= np.array([blob_w, blob_h, blob_w, blob_h], dtype=rows.dtype)
+    return [rows]
+
+
+def effective_blob_size(name, blob_size=None):
+    """
+    Returns the blob size that a model runs at: `blob_size` if one was asked
+    for, otherwise the model's default. Fixed size models (most ONNX files)
+    always run at their own size.
+    """
+    spec = MODELS[name]
+    if blob_size is None or spec['fixed_size']:
+        return spec['blob_size']
+    return tuple(blob_size)
+
+
+def accuracy_at(name, blob_size):
+    """
+    Returns a model's COCO mAP at a blob size. Between the sizes it was
+    published for, the mAP is interpolated in a straight line, and the line
+    through the nearest two is extended to smaller sizes (larger sizes keep
+    the best published value). A model published at one size keeps its one
+    number.
+    """
+    points = sorted(MODELS[name]['accuracy'].items())
+    if len(points) == 1:
+        return points[0][1]
+    size = blob_size[0]
+    for (size0, map0), (size1, map1) in zip(points, points[1:]):
+        if size <= size1:
+            break
+    value = map0 + (map1 - map0) * (size - size0) / (size1 - size0)
+    return max(0.0, min(value, max(map for size, map in points)))
+
+
+def time_model(name, model_dir='.', backend='default', target='cpu', threads=None,
+               runs=5, frame_size=(640, 480), blob_size=None):
+    """
+    Loads a model and times its forward pass on a blank frame at the blob
+    size it would run at (see `effective_blob_size`). The first pass is not
+    counted since OpenCV sets up the network lazily.
+
+    Returns the median forward time in milliseconds.
+    """
+
+    dnn_object, dnn_layers, dnn_labels = load_model(name, model_dir, backend, target, threads)
+    frame = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+    blob_size = effective_blob_size(name, blob_size)
+    blob = cv2.dnn.blobFromImage(frame, 1/255.0, blob_size, swapRB=True, crop=False)
+
+    times = []
+    for i in range(runs + 1):
+        time_start = time.perf_counter()
+        dnn_object.setInput(blob)
+        dnn_object.forward(dnn_layers)
+        times.append(1000 * (time.perf_counter() - time_start))
+    return statistics.median(times[1:])
+
+
+def select_model(budget_ms, model_dir='.', backend='default', target='cpu',
+                 threads=None, runs=5, candidates=None, file=sys.stderr, blob_size=None):
+    """
+    Times every installed model (or just the `candidates`) and returns the
+    name of the most accurate one whose median forward pass fits within
+    `budget_ms` milliseconds. If none of them fit, the fastest one is
+    returned. Returns None if no models are installed. Each model is timed
+    and ranked at the blob size it would run at: `blob_size` if one was
+    asked for, or its own default.
+    """
+
+    names = [name for name in installed_models(model_dir)
+             if candidates is None or name in candidates]
+    timings = {}
+    accuracies = {}
+    for name in names:
+        size = effective_blob_size(name, blob_size)
+        try:
+            timings[name] = time_model(name, model_dir, backend, target, threads, runs,
+                                       blob_size=size)
+        except (cv2.error, ValueError) as e:
+            print(f"  => {name}: could not run ({e})", file=file)
+            continue
+        accuracies[name] = accuracy_at(name, size)
+        print(f"  => {name}: {timings[name]:.1f}ms per image at {size[0]}x{size[1]}, "
+              f"{accuracies[name]:.1f} mAP", file=file)
+
+    if not timings:
+        return None
+    fits = [name for name in timings if timings[name] <= budget_ms]
+    if fits:
+        return max(fits, key=accuracies.get)
+    print(f"Warning: no model runs within {budget_ms:.0f}ms; using the fastest", file=file)
+    return min(timings, key=timings.get)
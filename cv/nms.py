@@ -0,0 +1,190 @@
+
+# Prof Tallman
+# Non-Maxima Suppression (NMS) on NumPy arrays.
+#
+# Object detectors tend to find the same object several times in slightly
+# different, overlapping boxes. Non-Maxima Suppression keeps the best box and
+# throws away the other boxes that overlap it too much:
+#
+#   1. Sort the boxes from the highest score to the lowest
+#   2. Keep the best remaining box
+#   3. Remove every remaining box that overlaps it by more than a threshold
+#   4. Repeat from step 2 until no boxes remain
+#
+# Step 3 compares one box against all the others at once with NumPy, so the
+# only Python loop is over the boxes that are kept.
+#
+# Per-class NMS: a person box should never suppress a dog box just because
+# they overlap. Rather than running NMS once per class, every box is shifted
+# by an offset based on its class, far enough that boxes from two different
+# classes can never overlap. Then a single NMS pass handles all the classes.
+#
+# Soft-NMS: regular NMS throws away a box that overlaps a better one, which
+# loses one of two people standing close together. Soft-NMS lowers the score
+# of the overlapping box instead (more overlap, lower score) and only drops
+# boxes whose score falls below a threshold.
+#
+# All boxes are (x, y, w, h) like the rest of the detectors.
+#
+# References:
+#  - https://pyimagesearch.com/2014/11/17/non-maximum-suppression-object-detection-python/
+#  - https://arxiv.org/abs/1704.04503 (Soft-NMS)
+#  - https://pytorch.org/vision/stable/generated/torchvision.ops.batched_nms.html
+
+import numpy as np
+
+
+def _corners(boxes):
+    """ Converts an array of (x, y, w, h) boxes into x1, y1, x2, y2, area. """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+    return x1, y1, x2, y2, boxes[:, 2] * boxes[:, 3]
+
+
+def _offset_by_label(boxes, labels):
+    """
+    Shifts each box by an amount based on its label so that boxes with
+    different labels can never overlap. Labels can be numbers or strings.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if labels is None or len(boxes) == 0:
+        return boxes
+    classes = np.unique(np.asarray(labels), return_inverse=True)[1].reshape(-1)
+    span = (boxes[:, :2] + boxes[:, 2:]).max() + 1
+    shifted = boxes.copy()
+    shifted[:, :2] += (classes * span)[:, np.newaxis]
+    return shifted
+
+
+def _overlap(i, rest, x1, y1, x2, y2, areas, metric):
+    """
+    Overlap between box `i` and the boxes in `rest`, either the Intersection
+    over Union ('iou') or the intersection over the smaller box ('min').
+    """
+    w = np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])
+    h = np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])
+    intersection = np.clip(w, 0, None) * np.clip(h, 0, None)
+    if metric == 'min':
+        denominator = np.minimum(areas[i], areas[rest])
+    else:
+        denominator = areas[i] + areas[rest] - intersection
+    return intersection / np.maximum(denominator, 1e-9)
+
+
+def box_iou(box, boxes):
+    """
+    Intersection over Union between one (x, y, w, h) box and each box in an
+    N x 4 array (or list) of boxes. Returns an array of N IoUs.
+    """
+    x1, y1, x2, y2, areas = _corners(np.vstack([np.reshape(box, (1, 4)),
+                                                np.reshape(boxes, (-1, 4))]))
+    return _overlap(0, np.arange(1, len(areas)), x1, y1, x2, y2, areas, 'iou')
+
+
+def nms(boxes, scores, iou_threshold=0.5, labels=None, top_k=None, metric='iou'):
+    """
+    Greedy Non-Maxima Suppression.
+
+    Args:
+     - boxes: N x 4 array of (x, y, w, h) boxes
+     - scores: N scores, higher is better
+     - iou_threshold: boxes that overlap a kept box by more than this are
+       removed
+     - labels: optional N labels; boxes only suppress boxes with the same
+       label
+     - top_k: keep at most this many boxes (None = no limit)
+     - metric: 'iou' for Intersection over Union, or 'min' for intersection
+       over the smaller box, which also removes a small box inside a big one
+
+    Returns an array with the indexes of the kept boxes, best score first.
+    """
+
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    if len(scores) == 0:
+        return np.zeros(0, dtype=int)
+    x1, y1, x2, y2, areas = _corners(_offset_by_label(boxes, labels))
+
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(best)
+        if top_k is not None and len(keep) >= top_k:
+            break
+        rest = order[1:]
+        overlap = _overlap(best, rest, x1, y1, x2, y2, areas, metric)
+        order = rest[overlap <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+def soft_nms(boxes, scores, iou_threshold=0.3, sigma=0.5, score_threshold=0.001,
+             labels=None, top_k=None, method='gaussian'):
+    """
+    Soft Non-Maxima Suppression. Instead of removing the boxes that overlap a
+    kept box, their scores are lowered:
+
+      gaussian --> score * exp(-iou^2 / sigma)
+      linear   --> score * (1 - iou), only when iou > iou_threshold
+
+    Boxes are dropped once their score falls below `score_threshold`. The
+    other arguments are the same as for `nms`.
+
+    Returns a tuple of the kept indexes (best score first) and an array of
+    their lowered scores.
+    """
+
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1).copy()
+    if len(scores) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    x1, y1, x2, y2, areas = _corners(_offset_by_label(boxes, labels))
+
+    remaining = np.arange(len(scores))
+    keep = []
+    kept_scores = []
+    while len(remaining) > 0:
+        best_pos = np.argmax(scores[remaining])
+        best = remaining[best_pos]
+        if scores[best] < score_threshold:
+            break
+        keep.append(best)
+        kept_scores.append(scores[best])
+        if top_k is not None and len(keep) >= top_k:
+            break
+        remaining = np.delete(remaining, best_pos)
+        iou = _overlap(best, remaining, x1, y1, x2, y2, areas, 'iou')
+        if method == 'linear':
+            decay = np.where(iou > iou_threshold, 1 - iou, 1.0)
+        else:
+            decay = np.exp(-(iou * iou) / sigma)
+        scores[remaining] *= decay
+        remaining = remaining[scores[remaining] >= score_threshold]
+    return np.array(keep, dtype=int), np.array(kept_scores)
+
+
+def suppress(objects, iou_threshold=0.5, per_class=True, top_k=None, soft=False,
+             metric='iou'):
+    """
+    Runs NMS over a list of detector objects, each a tuple of (label, score,
+    [x, y, w, h]). Objects without a score (HAAR) are ranked by the area of
+    their box. With `soft`, Soft-NMS is used and the scores in the returned
+    objects are the lowered scores.
+
+    Returns the objects that remain, best score first.
+    """
+
+    if len(objects) == 0:
+        return []
+    boxes = np.array([box for label, score, box in objects], dtype=np.float64)
+    scores = np.array([box[2] * box[3] if score is None else score
+                       for label, score, box in objects], dtype=np.float64)
+    labels = [str(label) for label, score, box in objects] if per_class else None
+
+    if not soft:
+        return [objects[i] for i in nms(boxes, scores, iou_threshold, labels, top_k, metric)]
+
+    keep, new_scores = soft_nms(boxes, scores, iou_threshold, labels=labels, top_k=top_k)
+    return [(objects[i][0], None if objects[i][1] is None else float(s), objects[i][2])
+            for i, s in zip(keep, new_scores)]
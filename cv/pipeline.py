@@ -0,0 +1,594 @@
+
+# Prof Tallman
+# Headless pipeline that runs an object detector over a directory of images.
+#
+# The detector scripts normally handle one image at a time: read the file,
+# shrink it, detect objects, draw the boxes, and then wait for the user to
+# close the window. The CPU sits idle during the slow parts that have nothing
+# to do with the detector, such as JPEG decoding and PNG encoding.
+#
+# This module splits the work into three stages that run at the same time and
+# pass images to each other through bounded queues:
+#
+#   decode  --> a pool of threads that read and shrink the image files
+#   detect  --> a single thread that runs the detector on each image
+#   write   --> a single thread that draws the boxes, saves the annotated
+#               image, and writes the detections as a line of JSON
+#
+# OpenCV releases the Python GIL while it decodes, encodes, and detects, so
+# these threads really do run in parallel. The queues are bounded so that a
+# fast decoder cannot fill up memory with images that the detector has not
+# gotten to yet.
+#
+# Even with the threads, most of OpenCV's detectors only keep one CPU core
+# busy when called from Python. The process pool mode (--workers) starts one
+# Python process per core instead. Each worker loads its own copy of the model
+# once, when it starts, and then handles a share of the image files from start
+# to finish. The results are handed back to the main process in the same order
+# as the input files. Watch the memory: every worker holds a full copy of the
+# model (about 250 MB each for YOLOv3).
+#
+# Both modes can use a ResultCache (--cache, see cache.py). Each image file's
+# bytes are hashed before they are decoded, and images that were processed
+# by an earlier run skip the decode and detect steps entirely. Their records
+# come straight from the cache, marked with "cached": true. Annotated images
+# are only written for images that were actually processed.
+#
+# Saving the annotated images (--output) is often slower than detecting the
+# objects, especially as PNG files. The write stage draws the boxes and then
+# hands each image to a cv2util.AsyncImageWriter, whose own pool of threads
+# (--writers) encodes and saves the images in the background. The images are
+# saved under the same subdirectories as the input files (day1/0000.jpg -->
+# OUTPUT/day1/0000.png), so images with the same name in different
+# directories are all kept.
+#
+# Tiled mode (--tile, see tiling.py) skips the usual shrink to 640x480. The
+# image is only reduced to fit in --tile-image-size and is then searched one
+# overlapping tile at a time, which finds small and distant objects that
+# disappear when the whole image is shrunk.
+#
+# References:
+#  - https://docs.python.org/3/library/concurrent.futures.html
+#  - https://docs.python.org/3/library/multiprocessing.html
+#  - https://jsonlines.org/
+
+import concurrent.futures
+import multiprocessing
+import threading
+import queue
+import json
+import time
+import cv2
+import sys
+import os
+import functools
+import cv2util
+import tiling
+import cache
+import profiler
+
+
+class StageTimer:
+    """
+    Thread-safe stopwatch that adds up how long a pipeline stage spent doing
+    useful work (as opposed to waiting on a queue).
+    """
+
+    def __init__(self, name, threads=1):
+        self.name = name
+        self.threads = threads
+        self.busy_seconds = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.busy_seconds += seconds
+            self.count += 1
+
+    def utilization(self, wall_seconds):
+        """
+        Returns the fraction of the wall clock time that this stage's threads
+        spent working, from 0.0 (always idle) to 1.0 (always busy).
+        """
+        if wall_seconds <= 0:
+            return 0.0
+        return self.busy_seconds / (wall_seconds * self.threads)
+
+
+def size_arg(text):
+    """ Converts a WIDTHxHEIGHT command line value to a (width, height) tuple. """
+    width, height = text.lower().split('x')
+    return (int(width), int(height))
+
+
+def add_arguments(parser):
+    """
+    Adds the command line options for the headless pipeline to an argparse
+    parser so that every detector script offers the same options.
+    """
+    group = parser.add_argument_group('headless pipeline')
+    group.add_argument('--headless', action='store_true',
+                       help='process the images without opening any windows')
+    group.add_argument('--output', metavar='DIR',
+                       help='save the annotated images to this directory')
+    group.add_argument('--writers', type=int, default=2, metavar='N',
+                       help='number of threads that encode the annotated images (default: 2)')
+    group.add_argument('--image-format', choices=['png', 'jpg'], default='png',
+                       help='file format for the annotated images (default: png)')
+    group.add_argument('--jsonl', metavar='FILE',
+                       help='write detections to this file (default: stdout)')
+    group.add_argument('--decoders', type=int, default=2, metavar='N',
+                       help='number of image decoding threads (default: 2)')
+    group.add_argument('--queue-size', type=int, default=8, metavar='N',
+                       help='max images waiting between stages (default: 8)')
+    group.add_argument('--workers', type=int, default=0, metavar='N',
+                       help='run headless with N worker processes, each with '
+                            'its own copy of the model (default: 0 = off)')
+    group.add_argument('--threads', type=int, metavar='N',
+                       help='size of the OpenCV thread pool (cv2.setNumThreads) that '
+                            'the DNN, HAAR, and HOG detectors use, in each worker '
+                            'with --workers (default: OpenCV decides)')
+    group.add_argument('--cache', metavar='DIR',
+                       help='reuse detection results stored in this directory')
+    group.add_argument('--cache-size', type=float, default=256, metavar='MB',
+                       help='size limit for the result cache (default: 256 MB)')
+    group.add_argument('--tile', type=size_arg, metavar='WxH',
+                       help='search the image in overlapping tiles of this size')
+    group.add_argument('--tile-overlap', type=float, default=0.2, metavar='F',
+                       help='fraction of each tile that overlaps its neighbors (default: 0.2)')
+    group.add_argument('--tile-image-size', type=size_arg, default=(2048, 1536), metavar='WxH',
+                       help='shrink images to fit this size before tiling (default: 2048x1536)')
+
+
+def detect_image(img, detector):
+    """ Detects the objects in one image with a loaded detector. """
+    return detector.detect([img])[0]
+
+
+def detect_image_tiled(img, detector, tile_size=(640, 640), overlap=0.2):
+    """ Detects the objects in one large image one tile at a time. """
+    return tiling.detect_tiled(img, detector.detect_tiles, tile_size, overlap)
+
+
+def run_from_args(args, image_files, detector, bbox=(640, 480), done=None):
+    """
+    Runs the headless pipeline using the options that were added to the
+    command line by `add_arguments`. `detector` is a Detector (see
+    detector.py). It is loaded here, or by each worker process in process
+    pool mode. The detector's identity is used for the result cache.
+    `done` is called with each filename once its record has been written
+    (see `run_pipeline`). The annotated images mirror the subdirectories of
+    the input directory, `args.file`.
+    """
+    root = getattr(args, 'file', None)
+    detect = detect_image
+    tiles = None
+    if args.tile is not None:
+        detect = functools.partial(detect_image_tiled, tile_size=args.tile,
+                                   overlap=args.tile_overlap)
+        bbox = args.tile_image_size
+        tiles = [list(args.tile), args.tile_overlap]
+
+    result_cache = None
+    if args.cache:
+        identity = {'detector': detector.identity(), 'bbox': list(bbox), 'tiles': tiles}
+        result_cache = cache.ResultCache(args.cache, identity,
+                                         int(args.cache_size * 1024 * 1024))
+
+    jsonl_file = open(args.jsonl, 'w') if args.jsonl else sys.stdout
+    try:
+        ext = f'.{args.image_format}'
+        if args.workers > 0:
+            return run_process_pool(image_files, detector, args.output, jsonl_file,
+                                    args.workers, args.threads, bbox,
+                                    result_cache=result_cache, detect=detect, ext=ext,
+                                    done=done, root=root)
+        if args.threads is not None:
+            cv2.setNumThreads(args.threads)
+        with detector:
+            return run_pipeline(image_files, lambda img: detect(img, detector),
+                                detector.annotate, args.output, jsonl_file,
+                                args.decoders, args.queue_size, bbox, result_cache,
+                                args.writers, ext, done, root)
+    finally:
+        if jsonl_file is not sys.stdout:
+            jsonl_file.close()
+
+
+def _read_image(filename, bbox, result_cache=None):
+    """
+    Reads an image file and shrinks it to fit in the bounding box (JPEGs are
+    decoded at a reduced size, see cv2util.imread_fit). With a result cache,
+    the file's bytes are hashed first and a cached result means that the
+    image does not need to be decoded at all.
+
+    Returns a tuple containing:
+      0. Shrunken image, or None if it could not be read or was cached
+      1. Cache key, or None without a cache
+      2. Cached record, or None if the image was not in the cache
+    """
+    if result_cache is None:
+        return cv2util.imread_fit(filename, bbox), None, None
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None, None, None
+    key = result_cache.key(data)
+    cached = result_cache.get(key, len(data))
+    if cached is not None:
+        return None, key, cached
+    return cv2util.imdecode_fit(data, bbox), key, None
+
+
+def _cached_record(filename, cached):
+    """ Creates the JSON record for an image whose result was cached. """
+    record = {'file': filename}
+    record.update(cached)
+    record['cached'] = True
+    return record
+
+
+def _cache_record(result_cache, key, record):
+    """ Saves the parts of a record that do not depend on the filename. """
+    if result_cache is not None and key is not None and 'error' not in record:
+        result_cache.put(key, {name: record[name] for name in
+                               ('width', 'height', 'detect_seconds', 'objects')})
+
+
+def _make_record(filename, img, objects, duration, annotate, image_writer, root=None):
+    """
+    Creates the JSON record for one image. If `image_writer` is not None, the
+    objects are drawn on the image and it is handed to the writer to save
+    under its path relative to `root` (see `output_name`).
+    """
+    record = {'file': filename}
+    if img is None:
+        record['error'] = 'could not open image file'
+        return record
+    record['width'] = img.shape[1]
+    record['height'] = img.shape[0]
+    record['detect_seconds'] = round(duration, 6)
+    record['objects'] = [
+        {'label': label, 'score': score, 'box': [int(v) for v in box]}
+        for label, score, box in objects]
+    if image_writer is not None:
+        with profiler.stage('annotate'):
+            annotate(img, objects)
+        record['output'] = image_writer.write(output_name(filename, root), img)
+    return record
+
+
+def output_name(filename, root=None):
+    """
+    Returns the name for an image's annotated copy: its path relative to the
+    input directory `root`, without the extension. Without a root directory
+    (a single image file) the name is just the file's base name.
+    """
+    if root is None or not os.path.isdir(root):
+        name = os.path.basename(filename)
+    else:
+        name = os.path.relpath(filename, root)
+    return os.path.splitext(name)[0]
+
+
+def run_pipeline(image_files, detect, annotate, output_dir=None,
+                 jsonl_file=sys.stdout, decoders=2, queue_size=8,
+                 bbox=(640, 480), result_cache=None, writers=2, ext='.png',
+                 done=None, root=None):
+    """
+    Runs a detector over a list of image files using separate decode, detect,
+    and write stages. Detections are written to `jsonl_file` as one line of
+    JSON per image, in the same order as `image_files`.
+
+    Args:
+     - image_files: list (or generator) of image filenames
+     - detect: function that takes an image and returns a list of objects,
+       each a tuple of (label, score, [x, y, w, h])
+     - annotate: function that takes an image and the list of objects and
+       draws the objects onto the image
+     - output_dir: directory for the annotated images, or None to skip them
+     - jsonl_file: open text file that receives the detections
+     - decoders: number of threads that read image files
+     - queue_size: max number of images waiting between two stages
+     - bbox: images are shrunk to fit in this box before detection
+     - result_cache: optional ResultCache for skipping images that were
+       processed by an earlier run
+     - writers: number of threads that encode the annotated images
+     - ext: file extension for the annotated images ('.png' or '.jpg')
+     - done: optional function that is called with each filename once its
+       record has been written, such as dataset.Manifest.done
+     - root: input directory; the annotated images are saved under the
+       same subdirectories of `output_dir` as the image files are under it
+
+    Returns a dictionary summarizing the throughput of the run.
+    """
+
+    image_writer = None
+    if output_dir is not None:
+        image_writer = cv2util.AsyncImageWriter(output_dir, writers, queue_size, ext)
+
+    decode_timer = StageTimer('decode', decoders)
+    detect_timer = StageTimer('detect')
+    write_timer = StageTimer('write')
+
+    # The decode stage is a thread pool. A feeder thread hands out the files
+    #   in order and places the futures in a bounded queue. Since the detect
+    #   stage takes the futures off the queue in the same order, the results
+    #   stay in order even when the decoder threads finish out of order.
+
+    def decode(filename):
+        time_start = time.perf_counter()
+        result = _read_image(filename, bbox, result_cache)
+        decode_timer.add(time.perf_counter() - time_start)
+        return result
+
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+
+    def feed(pool):
+        for filename in image_files:
+            if stop_event.is_set():
+                break
+            decode_queue.put((filename, pool.submit(decode, filename)))
+        decode_queue.put(None)
+
+    # The write stage draws the boxes, queues the annotated image for the
+    #   image writer, and then writes a JSON record. It is the only thread
+    #   that touches jsonl_file.
+
+    def write():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            filename, img, objects, duration, key, cached = item
+            time_start = time.perf_counter()
+            if cached is not None:
+                record = _cached_record(filename, cached)
+            else:
+                record = _make_record(filename, img, objects, duration,
+                                      annotate, image_writer, root)
+                _cache_record(result_cache, key, record)
+            jsonl_file.write(json.dumps(record) + '\n')
+            if done is not None:
+                done(filename)
+            write_timer.add(time.perf_counter() - time_start)
+
+    # The detect stage runs on the calling thread
+
+    time_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=decoders) as pool:
+        feeder = threading.Thread(target=feed, args=(pool,), daemon=True)
+        writer = threading.Thread(target=write, daemon=True)
+        feeder.start()
+        writer.start()
+        try:
+            while True:
+                item = decode_queue.get()
+                if item is None:
+                    break
+                filename, future = item
+                img, key, cached = future.result()
+                objects = []
+                duration = 0.0
+                if img is not None:
+                    detect_start = time.perf_counter()
+                    objects = detect(img)
+                    duration = time.perf_counter() - detect_start
+                    detect_timer.add(duration)
+                write_queue.put((filename, img, objects, duration, key, cached))
+        finally:
+            # Unblock the feeder if we are quitting early (e.g. <CTRL+C>)
+            stop_event.set()
+            while feeder.is_alive():
+                try:
+                    decode_queue.get_nowait()
+                except queue.Empty:
+                    feeder.join(0.01)
+            write_queue.put(None)
+            writer.join()
+            if image_writer is not None:
+                image_writer.close()
+    wall_seconds = time.perf_counter() - time_start
+    jsonl_file.flush()
+
+    # Throughput summary goes to stderr so it never mixes with the JSON lines
+
+    summary = {
+        'images': detect_timer.count,
+        'files': decode_timer.count,
+        'wall_seconds': wall_seconds,
+        'images_per_second': detect_timer.count / wall_seconds if wall_seconds > 0 else 0.0,
+        'utilization': {timer.name: timer.utilization(wall_seconds)
+                        for timer in (decode_timer, detect_timer, write_timer)},
+    }
+    if image_writer is not None and wall_seconds > 0:
+        summary['utilization']['encode'] = (
+            image_writer.busy_seconds / (wall_seconds * max(1, image_writer.workers)))
+        summary['images_written'] = image_writer.written
+        summary['write_errors'] = image_writer.errors
+    if result_cache is not None:
+        summary['cache'] = result_cache.stats()
+    print_summary(summary)
+    return summary
+
+
+def print_summary(summary, file=sys.stderr):
+    """ Prints a throughput summary produced by `run_pipeline`. """
+    print(f"Processed {summary['images']} of {summary['files']} images in "
+          f"{summary['wall_seconds']:.3f}s ({summary['images_per_second']:.2f} images/s)",
+          file=file)
+    if 'load_seconds' in summary:
+        print(f"  => {summary['workers']} workers loaded their models in "
+              f"{summary['load_seconds']:.3f}s (not counted above)", file=file)
+    for name, value in summary['utilization'].items():
+        print(f"  => {name} stage {100*value:.1f}% busy", file=file)
+    if summary.get('write_errors'):
+        print(f"  => {summary['write_errors']} annotated images could not be saved", file=file)
+    if 'cache' in summary:
+        cache.print_stats(summary['cache'], file)
+
+
+# Each worker process keeps its model and settings in this global so that the
+# model is only loaded once per worker instead of once per image
+_worker = None
+
+
+def _init_worker(detector, detect, output_dir, ext, threads, bbox, cache_args, root, ready):
+    """
+    Process pool initializer that loads the model into the worker. If the
+    model fails to load, the error is saved and raised by the first task so
+    that it reaches the main process. (An initializer that raises just gets
+    restarted by the pool, over and over.) The `ready` semaphore is released
+    once the worker is set up, whether or not the model loaded.
+    """
+    try:
+        _setup_worker(detector, detect, output_dir, ext, threads, bbox, cache_args, root)
+    finally:
+        ready.release()
+
+
+def _setup_worker(detector, detect, output_dir, ext, threads, bbox, cache_args, root):
+    global _worker
+    if threads is not None:
+        cv2.setNumThreads(threads)
+    error = None
+    try:
+        detector.load()
+    except Exception as e:
+        error = e
+    # Each worker opens the cache without a size limit. The main process
+    # owns the limit and evicts old results at the end of the run.
+    result_cache = None
+    if cache_args is not None:
+        cache_dir, identity = cache_args
+        result_cache = cache.ResultCache(cache_dir, identity, max_bytes=None)
+    # Workers save their images before moving on because a worker process
+    # can exit before a background writer thread would finish
+    image_writer = None
+    if output_dir is not None:
+        image_writer = cv2util.AsyncImageWriter(output_dir, workers=0, ext=ext)
+    _worker = {
+        'detector': detector,
+        'cache': result_cache,
+        'error': error,
+        'detect': detect,
+        'image_writer': image_writer,
+        'bbox': bbox,
+        'root': root,
+    }
+
+
+def _process_file(filename):
+    """
+    Process pool task that reads, shrinks, detects, and saves one image.
+    Returns a tuple of the image's JSON record and the size of the image
+    file if the record came from the cache (or None).
+    """
+    if _worker['error'] is not None:
+        raise _worker['error']
+    result_cache = _worker['cache']
+    img, key, cached = _read_image(filename, _worker['bbox'], result_cache)
+    if cached is not None:
+        return _cached_record(filename, cached), os.path.getsize(filename)
+    objects = []
+    duration = 0.0
+    if img is not None:
+        time_start = time.perf_counter()
+        objects = _worker['detect'](img, _worker['detector'])
+        duration = time.perf_counter() - time_start
+    record = _make_record(filename, img, objects, duration,
+                          _worker['detector'].annotate, _worker['image_writer'],
+                          _worker['root'])
+    _cache_record(result_cache, key, record)
+    return record, None
+
+
+def run_process_pool(image_files, detector, output_dir=None,
+                     jsonl_file=sys.stdout, workers=4, threads=None,
+                     bbox=(640, 480), chunksize=1, result_cache=None,
+                     detect=detect_image, ext='.png', done=None, root=None):
+    """
+    Runs a detector over a list of image files with a pool of worker
+    processes. Every worker receives its own copy of the (unloaded) detector,
+    loads it exactly once when it starts, and then calls
+    `detect(img, detector)` for each of its images. Detections are written to
+    `jsonl_file` in the same order as `image_files`.
+
+    Args:
+     - image_files: list (or generator) of image filenames
+     - detector: Detector to run (see detector.py)
+     - output_dir: directory for the annotated images, or None to skip them
+     - jsonl_file: open text file that receives the detections
+     - workers: number of worker processes
+     - threads: value for cv2.setNumThreads in each worker (None = default)
+     - bbox: images are shrunk to fit in this box before detection
+     - chunksize: number of files handed to a worker at a time
+     - result_cache: optional ResultCache for skipping images that were
+       processed by an earlier run
+     - detect: top-level function that takes an image and the detector and
+       returns a list of objects, such as `detect_image_tiled`
+     - ext: file extension for the annotated images ('.png' or '.jpg')
+     - done: optional function that is called with each filename once its
+       record has been written, such as dataset.Manifest.done
+     - root: input directory; the annotated images are saved under the
+       same subdirectories of `output_dir` as the image files are under it
+
+    Returns a dictionary summarizing the throughput of the run.
+    """
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # imap hands out the files in chunks but returns the results in order.
+    #   Every worker releases the `ready` semaphore once its model is loaded,
+    #   and the clock only starts after all of them have, so the summary
+    #   measures the throughput of a warm pool without any load time.
+
+    cache_args = None
+    if result_cache is not None:
+        cache_args = (result_cache.cache_dir, result_cache.identity)
+    ready = multiprocessing.Semaphore(0)
+    initargs = (detector, detect, output_dir, ext, threads, bbox, cache_args, root, ready)
+    with multiprocessing.Pool(workers, _init_worker, initargs) as pool:
+        time_start = time.perf_counter()
+        for i in range(workers):
+            ready.acquire()
+        load_seconds = time.perf_counter() - time_start
+        time_start = time.perf_counter()
+        files = 0
+        images = 0
+        detect_seconds = 0.0
+        for record, cached_size in pool.imap(_process_file, image_files, chunksize):
+            files += 1
+            if result_cache is not None:
+                result_cache.count(cached_size is not None, cached_size or 0)
+            if 'error' not in record and cached_size is None:
+                images += 1
+                detect_seconds += record['detect_seconds']
+            jsonl_file.write(json.dumps(record) + '\n')
+            if done is not None:
+                done(record['file'])
+        wall_seconds = time.perf_counter() - time_start
+    jsonl_file.flush()
+
+    summary = {
+        'images': images,
+        'files': files,
+        'wall_seconds': wall_seconds,
+        'images_per_second': images / wall_seconds if wall_seconds > 0 else 0.0,
+        'utilization': {
+            'detect': detect_seconds / (wall_seconds * workers) if wall_seconds > 0 else 0.0,
+        },
+        'workers': workers,
+        'threads': threads,
+        'load_seconds': load_seconds,
+    }
+    if result_cache is not None:
+        result_cache.evict()
+        summary['cache'] = result_cache.stats()
+    print_summary(summary)
+    return summary
@@ -0,0 +1,287 @@
+
+# Prof Tallman
+# Lightweight stage timers for finding out where the time goes.
+#
+# The detector scripts print one number per image, but that number covers a
+# lot of different steps: reading the file, shrinking the image, building the
+# blob, the forward pass, decoding the outputs, NMS, and drawing the boxes.
+# Which of those is the slow one changes from one Raspberry Pi model to the
+# next (a Pi 3 spends its time in the forward pass, a Pi 5 with a slow SD card
+# may spend it in imread), so before optimizing anything, measure each stage.
+#
+# Code marks a stage with a `with` block or a decorator:
+#
+#   with profiler.stage('yolo.forward'):
+#       outputs = net.forward(layers)
+#
+#   @profiler.timed('yolo.decode')
+#   def decode_yolo_outputs(...):
+#
+# Profiling is off unless a script is run with --profile, and when it is off
+# `stage` hands back the same do-nothing object every time, so the timers can
+# stay in the code for good. When it is on, every stage records its start
+# time, duration, and thread. At the end of the run the script prints a table
+# and a histogram of the times for each stage, and can save:
+#
+#   --profile-trace FILE     --> a Chrome trace (JSON) that shows every stage
+#                                on a timeline, one row per thread. Open it at
+#                                https://ui.perfetto.dev or chrome://tracing
+#   --profile-cprofile FILE  --> Python's cProfile statistics for the main
+#                                thread, for `python -m pstats FILE`
+#
+# Stages can be nested (yolo.detect contains yolo.blob, yolo.forward, ...), so
+# the totals of all the stages add up to more than the run time. Worker
+# processes (--workers) keep their own timers, which are not collected; use
+# threads or a single process when profiling.
+#
+# References:
+#  - https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+#    (Trace Event Format)
+#  - https://docs.python.org/3/library/profile.html
+
+import contextlib
+import functools
+import threading
+import cProfile
+import json
+import time
+import sys
+import os
+
+enabled = False
+
+# Most events to keep for the trace file (the histograms keep every time)
+MAX_EVENTS = 500000
+
+_events = []        # (name, start_ns, duration_ns, thread id)
+_durations = {}     # stage name --> list of durations in nanoseconds
+_threads = {}       # thread id --> thread name
+_origin_ns = time.perf_counter_ns()
+
+
+class _Stage:
+    """ Times one run of a stage. Created by `stage` when profiling is on. """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.perf_counter_ns() - self.start)
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enable():
+    """ Turns the stage timers on. """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """ Turns the stage timers off; the times recorded so far are kept. """
+    global enabled
+    enabled = False
+
+
+def reset():
+    """ Forgets every time recorded so far. """
+    global _origin_ns
+    _events.clear()
+    _durations.clear()
+    _threads.clear()
+    _origin_ns = time.perf_counter_ns()
+
+
+def stage(name):
+    """ Returns a context manager that times the code in its `with` block. """
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """ Decorator that times every call of a function as a stage. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, start, time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+def record(name, start_ns, duration_ns):
+    """
+    Records one run of a stage that was timed some other way. Times are from
+    time.perf_counter_ns(). Appending to a list is atomic in CPython, so the
+    stages can be recorded from any thread without a lock.
+    """
+    tid = threading.get_ident()
+    if tid not in _threads:
+        _threads[tid] = threading.current_thread().name
+    if len(_events) < MAX_EVENTS:
+        _events.append((name, start_ns, duration_ns, tid))
+    times = _durations.get(name)
+    if times is None:
+        times = _durations.setdefault(name, [])
+    times.append(duration_ns)
+
+
+def _percentile(sorted_times, fraction):
+    index = min(len(sorted_times) - 1, int(round(fraction * (len(sorted_times) - 1))))
+    return sorted_times[index]
+
+
+def histogram(name):
+    """
+    Returns the histogram of a stage's times as a list of (upper bound in
+    milliseconds, count). The buckets double in size, starting at 1/64 ms.
+    """
+    counts = {}
+    for ns in _durations.get(name, []):
+        upper = 1 / 64
+        while upper * 1e6 < ns:
+            upper *= 2
+        counts[upper] = counts.get(upper, 0) + 1
+    return sorted(counts.items())
+
+
+def summary():
+    """
+    Returns a dictionary with the statistics of every stage: count, total_ms,
+    mean_ms, p50_ms, p90_ms, p99_ms, max_ms, and histogram. The stages are
+    sorted from the largest total time to the smallest.
+    """
+    stages = {}
+    for name, times in _durations.items():
+        times = sorted(times)
+        if not times:
+            continue
+        stages[name] = {
+            'count': len(times),
+            'total_ms': sum(times) / 1e6,
+            'mean_ms': sum(times) / len(times) / 1e6,
+            'p50_ms': _percentile(times, 0.50) / 1e6,
+            'p90_ms': _percentile(times, 0.90) / 1e6,
+            'p99_ms': _percentile(times, 0.99) / 1e6,
+            'max_ms': times[-1] / 1e6,
+            'histogram': histogram(name),
+        }
+    return dict(sorted(stages.items(), key=lambda item: -item[1]['total_ms']))
+
+
+def print_summary(file=sys.stderr, histograms=True):
+    """ Prints a table of the stage times and, optionally, their histograms. """
+    stages = summary()
+    if not stages:
+        print('Profile: no stages were timed', file=file)
+        return
+    print(f"{'stage':<20} {'count':>7} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} "
+          f"{'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}", file=file)
+    for name, s in stages.items():
+        print(f"{name:<20} {s['count']:>7} {s['total_ms']/1000:>9.3f} {s['mean_ms']:>9.3f} "
+              f"{s['p50_ms']:>9.3f} {s['p90_ms']:>9.3f} {s['p99_ms']:>9.3f} "
+              f"{s['max_ms']:>9.3f}", file=file)
+    if not histograms:
+        return
+
+    # One bar per bucket, scaled so the biggest bucket of each stage is 40
+    #   characters wide
+    for name, s in stages.items():
+        print(f'\n{name}', file=file)
+        biggest = max(count for upper, count in s['histogram'])
+        for upper, count in s['histogram']:
+            bar = '#' * max(1, round(40 * count / biggest))
+            print(f'  <= {upper:>9.3f} ms {count:>7} {bar}', file=file)
+
+
+def trace_events():
+    """ Returns the recorded stages in the Chrome Trace Event format. """
+    pid = os.getpid()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+               'args': {'name': thread_name}}
+              for tid, thread_name in _threads.items()]
+    for name, start_ns, duration_ns, tid in list(_events):
+        events.append({
+            'name': name,
+            'cat': name.split('.')[0],
+            'ph': 'X',
+            'ts': (start_ns - _origin_ns) / 1000,
+            'dur': duration_ns / 1000,
+            'pid': pid,
+            'tid': tid,
+        })
+    return events
+
+
+def write_trace(filename):
+    """
+    Saves the recorded stages as a Chrome trace JSON file, which Perfetto
+    and chrome://tracing can open. The stage statistics are saved in the
+    file's `otherData` so the histograms travel with the trace.
+    """
+    trace = {
+        'traceEvents': trace_events(),
+        'displayTimeUnit': 'ms',
+        'otherData': {'stages': summary(), 'dropped_events': _dropped_events()},
+    }
+    with open(filename, 'w') as f:
+        json.dump(trace, f)
+
+
+def _dropped_events():
+    return sum(len(times) for times in _durations.values()) - len(_events)
+
+
+def add_arguments(parser):
+    """ Adds the command line options for profiling to an argparse parser. """
+    group = parser.add_argument_group('profiling')
+    group.add_argument('--profile', action='store_true',
+                       help='time each stage and print a histogram of the times at the end')
+    group.add_argument('--profile-trace', metavar='FILE',
+                       help='with --profile, save a Chrome trace for ui.perfetto.dev')
+    group.add_argument('--profile-cprofile', metavar='FILE',
+                       help='with --profile, also save cProfile statistics of the main thread')
+
+
+@contextlib.contextmanager
+def session(args, file=sys.stderr):
+    """
+    Context manager that profiles the code in its `with` block when the
+    command line has --profile, then prints the summary and saves the
+    files that were asked for. Does nothing without --profile.
+    """
+    if not getattr(args, 'profile', False):
+        yield
+        return
+
+    reset()
+    enable()
+    profile = cProfile.Profile() if args.profile_cprofile else None
+    if profile is not None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile_cprofile)
+        disable()
+        print_summary(file)
+        if args.profile_trace:
+            write_trace(args.profile_trace)
+            print(f'Saved trace to {args.profile_trace}', file=file)
+        if args.profile_cprofile:
+            print(f'Saved cProfile statistics to {args.profile_cprofile}', file=file)
@@ -0,0 +1,302 @@
+
+# Prof Tallman
+# Accuracy vs. latency sweep for the detector parameters.
+#
+# Each detector script uses a handful of fixed numbers that were picked after
+# some limited testing: the 224x224 blob and 0.90/0.3 confidence/NMS values in
+# yolo.py, the 1.1 scale factor and 4 neighbors in haar.py, and the (1,1)
+# window stride and 1.1 scale in hog.py. Each of these numbers trades accuracy
+# for speed. This script measures that trade-off on a set of labeled images
+# so that each deployment can pick its settings based on evidence.
+#
+# The labels are a JSON file that maps image files (relative to the labels
+# file) to the list of objects that a person marked in the image. Each object
+# is an [x, y, w, h] box in the original, full-size image:
+#
+#   {
+#     "front_door_001.jpg": [[412, 220, 180, 470]],
+#     "front_door_002.jpg": [],
+#     "driveway/car_and_person.jpg": [[80, 95, 60, 150], [700, 310, 90, 210]]
+#   }
+#
+# A detection counts as a true positive when it overlaps a labeled box that
+# has not already been matched by at least the IoU threshold (default 0.5).
+# For every combination of parameters the script reports:
+#
+#   precision --> what fraction of the detections were real objects
+#   recall    --> what fraction of the real objects were detected
+#   latency   --> mean and 95th percentile detection time per image
+#
+# The Pareto front is the set of settings where no other setting is both more
+# accurate (higher F1 score) and faster (lower mean latency). Settings that
+# are not on the front can be ignored.
+#
+# Example:
+#   python sweep.py haar labels.json --scale-factors 1.05,1.1,1.2 --min-neighbors 3,4,5
+#   python sweep.py yolo labels.json --blob-sizes 224,320,416 --json results.json
+#
+# References:
+#  - https://en.wikipedia.org/wiki/Precision_and_recall
+#  - https://en.wikipedia.org/wiki/Pareto_front
+
+import numpy as np
+import itertools
+import argparse
+import json
+import time
+import cv2
+import sys
+import os
+import cv2util
+import yolo
+import haar
+import hog
+import nms
+
+
+def load_labeled_images(labels_file, bbox=(640, 480)):
+    """
+    Reads the labels file and all of its images. The images are shrunk to fit
+    the bounding box just like the detector scripts do, and the labeled boxes
+    are scaled down to match.
+
+    Returns a list of tuples, each containing:
+      0. Image filename
+      1. Shrunken image
+      2. Array of labeled boxes (x, y, w, h) in the shrunken image
+    """
+
+    with open(labels_file, 'r') as f:
+        labels = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(labels_file))
+
+    dataset = []
+    for name, boxes in sorted(labels.items()):
+        filename = os.path.join(base_dir, name)
+        img = cv2.imread(filename)
+        if img is None:
+            print(f"Error: cv2 could not open image file '{filename}'", file=sys.stderr)
+            continue
+        small = cv2util.shrink_to_fit(img, bbox)
+        factor = small.shape[1] / img.shape[1]
+        truth = np.array(boxes, dtype=float).reshape(-1, 4) * factor
+        dataset.append((filename, small, truth))
+    return dataset
+
+
+def match_detections(objects, truth, iou_threshold=0.5):
+    """
+    Greedily matches detections to labeled boxes, most confident detection
+    first. Returns the number of true positives and false positives.
+    """
+
+    matched = np.zeros(len(truth), dtype=bool)
+    true_pos = 0
+    false_pos = 0
+    ordered = sorted(objects, key=lambda obj: -(obj[1] or 0.0))
+    for label, score, box in ordered:
+        if len(truth) > 0:
+            ious = nms.box_iou(box, truth)
+            ious[matched] = 0.0
+            best = np.argmax(ious)
+            if ious[best] >= iou_threshold:
+                matched[best] = True
+                true_pos += 1
+                continue
+        false_pos += 1
+    return true_pos, false_pos
+
+
+def score_setting(params, per_image, dataset, iou_threshold):
+    """
+    Computes the accuracy and latency of one parameter setting from a list of
+    (objects, seconds) tuples, one per image in the dataset.
+    """
+
+    true_pos = false_pos = total_truth = 0
+    for (objects, seconds), (filename, img, truth) in zip(per_image, dataset):
+        tp, fp = match_detections(objects, truth, iou_threshold)
+        true_pos += tp
+        false_pos += fp
+        total_truth += len(truth)
+    latencies = [seconds for objects, seconds in per_image]
+    return summarize_setting(params, true_pos, false_pos, total_truth, latencies)
+
+
+def summarize_setting(params, true_pos, false_pos, total_truth, latencies):
+    """
+    Computes the accuracy and latency of one parameter setting from its
+    match counts over the whole dataset and its time for each image.
+    """
+
+    latencies = np.array(latencies)
+    precision = true_pos / (true_pos + false_pos) if true_pos + false_pos else 1.0
+    recall = true_pos / total_truth if total_truth else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        'params': params,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'mean_seconds': float(latencies.mean()),
+        'p95_seconds': float(np.percentile(latencies, 95)),
+    }
+
+
+def sweep_yolo(dataset, blob_sizes, confidences, thresholds, iou_threshold):
+    """
+    Sweeps the YOLO blob size, confidence, and NMS threshold. The forward pass
+    only depends on the blob size, so it runs once per image and blob size.
+    The confidence and NMS threshold are swept over that image's outputs
+    right away, and each setting's latency is the forward time plus its own
+    decode time. Only the match counts are kept, not the outputs (several
+    MB per image at the larger blob sizes), so memory does not grow with
+    the number of images.
+    """
+
+    dnn_classifier, dnn_layers, label_names = yolo.load_yolo_deep_neural_network()
+    dnn_object = (dnn_classifier, dnn_layers)
+    results = []
+    for size in blob_sizes:
+        blob_size = (size, size)
+
+        # The first pass at a new blob size reshapes the network, so it is
+        # run once before timing anything
+        yolo.run_yolo_network(dataset[0][1], dnn_object, blob_size)
+
+        # Each setting's running [true positives, false positives, seconds
+        #   for each image]
+        settings = list(itertools.product(confidences, thresholds))
+        tallies = {setting: [0, 0, []] for setting in settings}
+        total_truth = 0
+        for filename, img, truth in dataset:
+            img_h, img_w = img.shape[:2]
+            time_start = time.perf_counter()
+            outputs = yolo.run_yolo_network(img, dnn_object, blob_size)
+            forward_seconds = time.perf_counter() - time_start
+            total_truth += len(truth)
+            for confidence, threshold in settings:
+                time_start = time.perf_counter()
+                objects = yolo.decode_yolo_outputs(outputs, img_w, img_h,
+                                                   confidence, threshold)
+                seconds = forward_seconds + time.perf_counter() - time_start
+                tp, fp = match_detections(objects, truth, iou_threshold)
+                tally = tallies[(confidence, threshold)]
+                tally[0] += tp
+                tally[1] += fp
+                tally[2].append(seconds)
+
+        for (confidence, threshold), (tp, fp, latencies) in tallies.items():
+            params = {'blob_size': size, 'confidence': confidence, 'threshold': threshold}
+            results.append(summarize_setting(params, tp, fp, total_truth, latencies))
+            print_result(results[-1])
+    return results
+
+
+def sweep_detector(dataset, detect, model, grid, iou_threshold):
+    """
+    Sweeps every combination of the keyword arguments in `grid` for a
+    detector that is called as `detect(img, model, **params)`.
+    """
+
+    results = []
+    names = list(grid.keys())
+    for values in itertools.product(*grid.values()):
+        params = dict(zip(names, values))
+        per_image = []
+        for filename, img, truth in dataset:
+            time_start = time.perf_counter()
+            objects = detect(img, model, **params)
+            per_image.append((objects, time.perf_counter() - time_start))
+        results.append(score_setting(params, per_image, dataset, iou_threshold))
+        print_result(results[-1])
+    return results
+
+
+def pareto_front(results):
+    """
+    Returns the results that are not dominated by any other result, sorted
+    from fastest to slowest. One result dominates another when it is at least
+    as accurate (F1) and at least as fast (mean latency), and better in one.
+    """
+
+    front = []
+    for r in results:
+        dominated = any(
+            o['f1'] >= r['f1'] and o['mean_seconds'] <= r['mean_seconds'] and
+            (o['f1'] > r['f1'] or o['mean_seconds'] < r['mean_seconds'])
+            for o in results)
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: r['mean_seconds'])
+
+
+def print_result(result, file=sys.stderr):
+    params = ' '.join(f'{k}={v}' for k, v in result['params'].items())
+    print(f"{params}: precision {result['precision']:.3f} recall {result['recall']:.3f}"
+          f" F1 {result['f1']:.3f} latency mean {1000*result['mean_seconds']:.1f}ms"
+          f" p95 {1000*result['p95_seconds']:.1f}ms", file=file)
+
+
+def parse_list(text, kind=float):
+    """ Converts a comma separated command line value into a list. """
+    return [kind(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy vs. latency sweep for the detectors')
+    parser.add_argument('detector', choices=['yolo', 'haar', 'hog'])
+    parser.add_argument('labels', help='JSON file of labeled boxes for each image')
+    parser.add_argument('--iou', type=float, default=0.5,
+                        help='IoU needed to match a labeled box (default: 0.5)')
+    parser.add_argument('--json', metavar='FILE', help='save all of the results to a JSON file')
+    parser.add_argument('--blob-sizes', default='160,224,320,416', help='YOLO blob sizes')
+    parser.add_argument('--confidences', default='0.5,0.7,0.9', help='YOLO confidence values')
+    parser.add_argument('--thresholds', default='0.3,0.45', help='YOLO NMS thresholds')
+    parser.add_argument('--scale-factors', default='1.05,1.1,1.2,1.3', help='HAAR scale factors')
+    parser.add_argument('--min-neighbors', default='3,4,5,6', help='HAAR min neighbors')
+    parser.add_argument('--win-strides', default='1,2,4,8', help='HOG window strides')
+    parser.add_argument('--scales', default='1.05,1.1,1.2', help='HOG scales')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.labels):
+        print(f"Error: '{args.labels}' does not exist")
+        exit()
+    dataset = load_labeled_images(args.labels)
+    if len(dataset) == 0:
+        print(f"Error: no images could be loaded from '{args.labels}'")
+        exit()
+    print(f"Loaded {len(dataset)} labeled images", file=sys.stderr)
+
+    if args.detector == 'yolo':
+        results = sweep_yolo(dataset, parse_list(args.blob_sizes, int),
+                             parse_list(args.confidences),
+                             parse_list(args.thresholds), args.iou)
+    elif args.detector == 'haar':
+        grid = {
+            'scale_factor': parse_list(args.scale_factors),
+            'min_neighbors': parse_list(args.min_neighbors, int),
+        }
+        results = sweep_detector(dataset, haar.detect_faces, haar.load_haar_cascade(),
+                                 grid, args.iou)
+    else:
+        grid = {
+            'win_stride': [(s, s) for s in parse_list(args.win_strides, int)],
+            'scale': parse_list(args.scales),
+        }
+        results = sweep_detector(dataset, hog.detect_people, hog.load_hog_people_detector(),
+                                 grid, args.iou)
+
+    front = pareto_front(results)
+    print(f"\nPareto front ({len(front)} of {len(results)} settings):")
+    for result in front:
+        print_result(result, sys.stdout)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'detector': args.detector, 'images': len(dataset),
+                       'results': results, 'pareto_front': front}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+
+# Prof Tallman
+# Tests for the image walker and its manifest (dataset.py).
+#
+# Run from the cv directory with: python -m pytest test_dataset.py
+
+import os
+import dataset
+
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 16
+
+
+def _walk(root, manifest_path):
+    with dataset.Manifest(manifest_path) as manifest:
+        files = list(dataset.walk_images(root, manifest=manifest, new_only=True))
+        for filename in files:
+            manifest.done(filename)
+    return [os.path.basename(filename) for filename in files]
+
+
+def test_new_only_trailing_slash_root(tmp_path):
+    root = tmp_path / 'cap'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.jpg').write_bytes(JPEG)
+    manifest_path = str(tmp_path / 'manifest.db')
+    assert _walk(str(root) + os.sep, manifest_path) == ['a.jpg']
+
+    # A new file in a subdirectory does not change the root's mtime, so
+    #   the walk only finds it through the subdirectories in the manifest
+    (root / 'sub' / 'b.jpg').write_bytes(JPEG)
+    assert _walk(str(root) + os.sep, manifest_path) == ['b.jpg']
+    assert _walk(str(root), manifest_path) == []
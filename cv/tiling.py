@@ -0,0 +1,106 @@
+
+# Prof Tallman
+# Tiled object detection for high resolution images.
+#
+# The detector scripts shrink every image to fit in 640x480 before they look
+# for objects, and yolo.py shrinks it again to a 224x224 blob. That is great
+# for speed but a person standing 30 meters away from a 12 MP camera might be
+# 100 pixels tall in the original photo and only 4 pixels tall in the blob.
+# Nothing is left for the detector to find.
+#
+# Tiling keeps the image at its native (or a moderately reduced) resolution
+# and cuts it into overlapping tiles, each about the size that the detector
+# expects. The tiles are run through the detector together (as one batch for
+# YOLO) and the boxes are shifted from tile coordinates back to coordinates in
+# the whole image. The tiles overlap so that an object cut in half by one tile
+# edge will be whole in the next tile over. That also means the same object is
+# often found twice, so overlapping boxes with the same label are merged.
+#
+#   +--------+--+-----+--+--------+
+#   |        |  |     |  |        |     Three 640 pixel wide tiles cover a
+#   | tile 1 |  |tile2|  | tile 3 |     1600 pixel wide image with a 20%
+#   |        |  |     |  |        |     overlap between neighbors
+#   +--------+--+-----+--+--------+
+#
+# References:
+#  - https://arxiv.org/abs/2202.06934 (Slicing Aided Hyper Inference)
+
+import numpy as np
+import nms
+
+
+def tile_positions(length, tile_length, overlap):
+    """
+    Returns the starting positions of the tiles along one side of the image.
+    The tiles are spread evenly so that the first starts at 0 and the last
+    ends exactly at the edge of the image.
+    """
+
+    if length <= tile_length:
+        return [0]
+    stride = max(1, int(tile_length * (1 - overlap)))
+    count = int(np.ceil((length - tile_length) / stride)) + 1
+    return [int(round(i * (length - tile_length) / (count - 1))) for i in range(count)]
+
+
+def make_tiles(width, height, tile_size=(640, 640), overlap=0.2):
+    """
+    Splits a `width` x `height` image into overlapping tiles.
+
+    Returns a list of (x, y, w, h) rectangles, one per tile.
+    """
+
+    tile_w, tile_h = tile_size
+    tiles = []
+    for y in tile_positions(height, tile_h, overlap):
+        for x in tile_positions(width, tile_w, overlap):
+            tiles.append((x, y, min(tile_w, width - x), min(tile_h, height - y)))
+    return tiles
+
+
+def merge_objects(objects, threshold=0.5):
+    """
+    Merges objects that were found more than once in neighboring tiles. Two
+    boxes with the same label are duplicates when their intersection covers
+    at least `threshold` of the smaller box. Comparing against the smaller box
+    (instead of the usual Intersection over Union) also catches the partial
+    box that a detector often reports for an object cut off by a tile edge.
+    The object with the higher score (or larger box when there are no
+    scores) is kept.
+
+    Returns the list of objects that remain.
+    """
+
+    return nms.suppress(objects, threshold, metric='min')
+
+
+def detect_tiled(img, detect_batch, tile_size=(640, 640), overlap=0.2,
+                 merge_threshold=0.5):
+    """
+    Detects objects in a large image one tile at a time.
+
+    Args:
+     - img: image to search, at full or moderate resolution
+     - detect_batch: function that takes a list of images and returns a list
+       of objects for each image, such as `Detector.detect_tiles`
+     - tile_size: (width, height) of each tile
+     - overlap: fraction of a tile that overlaps its neighbors
+     - merge_threshold: see `merge_objects`
+
+    Returns a list of objects, each a tuple of (label, score, [x, y, w, h])
+    in the coordinates of the whole image.
+    """
+
+    img_h, img_w = img.shape[:2]
+    tiles = make_tiles(img_w, img_h, tile_size, overlap)
+
+    # Slicing a NumPy array creates a view, so the tiles share the image's
+    #   memory instead of copying it
+    crops = [img[y:y+h, x:x+w] for x, y, w, h in tiles]
+    results = detect_batch(crops)
+
+    objects = []
+    for (tile_x, tile_y, tile_w, tile_h), tile_objects in zip(tiles, results):
+        for label, score, (x, y, w, h) in tile_objects:
+            objects.append((label, score, [int(x) + tile_x, int(y) + tile_y, int(w), int(h)]))
+    return merge_objects(objects, merge_threshold)
@@ -1,54 +1,244 @@
 
 from picamera2 import Picamera2
+import statistics
+import argparse
 import time
 import cv2
 import sys
 import os
 import cv2util
+import camera
+import haar
+import yolo
+import tracking
+import profiler
 
 def main():
 
+    # Command line options (--profile times each stage of the loop)
+    parser = argparse.ArgumentParser(description='HAAR face (or YOLO person) tracker')
+    haar.HaarDetector.add_arguments(parser.add_argument_group('haar parameters'))
+    group = parser.add_argument_group('region of interest search')
+    group.add_argument('--roi', action='store_true',
+                       help='only search for faces near the faces in the last frame')
+    group.add_argument('--roi-margin', type=float, default=0.5, metavar='F',
+                       help='search window around each face, as a fraction of its size (default: 0.5)')
+    group.add_argument('--roi-band', type=float, nargs=2, default=(0.75, 1.33), metavar=('MIN', 'MAX'),
+                       help='face sizes to search for, relative to the last face (default: 0.75 1.33)')
+    group.add_argument('--rescan-every', type=int, default=15, metavar='N',
+                       help='search the whole frame every N frames (default: 15)')
+    group = parser.add_argument_group('detect then track')
+    group.add_argument('--detector', choices=['haar', 'yolo'], default='haar',
+                       help='detector to run: HAAR faces or YOLO persons (default: haar)')
+    group.add_argument('--hybrid', type=int, default=0, metavar='N',
+                       help='run the detector every N frames and track the objects in between')
+    group.add_argument('--track-method', choices=tracking.TRACK_METHODS, default='lk',
+                       help='tracker between detections: lk (optical flow) or an OpenCV tracker')
+    group.add_argument('--min-track-confidence', type=float, default=0.5, metavar='F',
+                       help='run the detector early when a track falls below this (default: 0.5)')
+    group = parser.add_argument_group('frame rate governor')
+    group.add_argument('--target-fps', type=float, metavar='X',
+                       help='adjust the HAAR search resolution and parameters to hold X fps')
+    group.add_argument('--governor-hold', type=int, default=30, metavar='N',
+                       help='frames to wait after each adjustment before the next (default: 30)')
+    parser.add_argument('--no-capture-thread', action='store_true',
+                        help='capture in the main loop instead of on a thread that keeps the newest frame')
+    parser.add_argument('--lores', action='store_true',
+                        help='detect on the grayscale Y plane of a 640x480 YUV420 lores stream')
+    parser.add_argument('--no-window', action='store_true',
+                        help='print the faces instead of showing them (quit with <CTRL+C>)')
+    profiler.add_arguments(parser)
+    args = parser.parse_args()
+
     # Turn off informational log messages (errors still shown)
     os.environ["LIBCAMERA_LOG_LEVELS"] = "3"
     Picamera2.set_logging(Picamera2.ERROR)
 
-    # Load the HAAR Cascade weights file for faces
-    haar_weights_file = 'haarcascade_frontalface_default.xml'
-    if not os.path.exists(haar_weights_file):
-        print(f"Error: '{haar_weights_file}' does not exist")
+    # Load the HAAR Cascade weights file for faces (or the YOLO model files)
+    if args.detector == 'yolo':
+        detector = yolo.YoloDetector()
+    else:
+        detector = haar.HaarDetector.from_args(args)
+    for filename in detector.model_files:
+        if not os.path.exists(filename):
+            print(f"Error: '{filename}' does not exist")
+            return
+    if (args.roi or args.target_fps) and args.detector != 'haar':
+        print("Error: --roi and --target-fps only work with the HAAR detector")
         return
-    haar_faces = cv2.CascadeClassifier(haar_weights_file)
+    detector.load()
+    search = None
+    if args.roi:
+        search = tracking.RoiFaceSearch(detector, args.roi_margin, args.roi_band, args.rescan_every)
+
+    # The governor picks the HAAR settings and the resolution of the image to
+    # search for each frame (see tracking.FpsGovernor). The boxes found in a
+    # smaller image are scaled back up to the 640x480 frame.
+    governor = None
+    if args.target_fps:
+        if args.hybrid > 0:
+            governor = tracking.FpsGovernor(args.target_fps, window=max(15, 3 * args.hybrid),
+                                            hold=args.governor_hold, statistic=statistics.fmean)
+        else:
+            governor = tracking.FpsGovernor(args.target_fps, hold=args.governor_hold)
+    resizers = {}
+
+    def detect_scaled(image):
+        settings = governor.settings
+        resolution = settings['resolution']
+        min_size = int(settings['min_size'] * resolution)
+        params = detector.params
+        params['scale_factor'] = settings['scale_factor']
+        params['min_neighbors'] = settings['min_neighbors']
+        params['min_size'] = (min_size, min_size)
+        if resolution < 1.0:
+            if resolution not in resizers:
+                bbox = (int(image.shape[1] * resolution), int(image.shape[0] * resolution))
+                resizers[resolution] = cv2util.Resizer(bbox, image.shape)
+            image = resizers[resolution](image)
+        objects = search.detect(image) if search is not None else detector.detect([image])[0]
+        if resolution >= 1.0:
+            return objects
+        return [(label, score, [int(v / resolution) for v in box]) for label, score, box in objects]
+
+    # YOLO wants a BGR color image while HAAR wants grayscale. With --hybrid
+    # the detector only runs every few frames (see tracking.HybridTracker).
+    def detect(image):
+        if governor is not None:
+            return detect_scaled(image)
+        if search is not None:
+            return search.detect(image)
+        return detector.detect([image])[0]
+    hybrid = None
+    if args.hybrid > 0:
+        try:
+            hybrid = tracking.HybridTracker(detect, args.hybrid, args.track_method,
+                                            args.min_track_confidence)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
     # Start the camera and display window
+    # The camera is read on its own thread, which keeps only the newest frame
+    # (see camera.py), so a slow detector never works on a stale frame
+    # In lores mode the camera itself makes the 640x480 grayscale image for
+    # the detector (see camera.picamera_lores_reader), and the color stream
+    # is only copied out when there is a window to show it in
+    window = (640, 480)
     picam = Picamera2()
+    if args.lores:
+        camera.configure_lores(picam, window)
+        with_main = not args.no_window or args.detector == 'yolo'
+        read_frame = camera.picamera_lores_reader(picam, window, with_main)
+    else:
+        read_frame = camera.picamera_reader(picam)
     picam.start()
-    cv2.namedWindow('TRACKER')
-    window = (640, 480)
-    middle = (window[0] // 2, window[1] // 2)
-
-    # Loop until the user presses <ESC>
-    while cv2.waitKey(1) & 0xFF != 27:
-        
-        # Capture a frame and convert it to 640x480 grayscale
-        frame = picam.capture_array()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB) 
-        frame = cv2util.shrink_to_fit(frame, window)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # Detect faces
-        boxes = haar_faces.detectMultiScale(gray, 1.1, 4)
-        neon = (0, 255, 204)
-        for (x, y, w, h) in boxes:
-            ctr_x = x + w // 2
-            ctr_y = y + h // 2
-            cv2.rectangle(frame, (x, y), (x+w, y+h), neon, 1)
-            cv2.line(frame, (ctr_x-5, ctr_y), (ctr_x+5, ctr_y), neon, 2)
-            cv2.line(frame, (ctr_x, ctr_y-5), (ctr_x, ctr_y+5), neon, 2)
-            #cv2.line(frame, (ctr_x, ctr_y), middle, neon, 1)
-        cv2.imshow('TRACKER', frame)
+    grabber = None
+    if not args.no_capture_thread:
+        grabber = camera.FrameGrabber(read_frame).start()
+    if not args.no_window:
+        cv2.namedWindow('TRACKER')
+
+    # The camera frames are always the same size, so the color conversion,
+    # resize, grayscale, and YOLO blob buffers are allocated once on the
+    # first frame and then reused for every frame after that. The YOLO
+    # detector gets the same context for its blob (see yolo.YoloDetector).
+    color = None
+    context = None
+    blob_size = detector.params['blob_size'] if args.detector == 'yolo' else (224, 224)
+
+    # Loop until the user presses <ESC> (or <CTRL+C> without a window)
+    count = None
+    try:
+        with profiler.session(args):
+            while True:
+                if not args.no_window:
+                    with profiler.stage('display'):
+                        if cv2.waitKey(1) & 0xFF == 27:
+                            break
+
+                # Capture a frame and convert it to 640x480 grayscale (the
+                #   lores stream is already 640x480 grayscale)
+                with profiler.stage('capture'):
+                    item = grabber.read(timeout=2.0) if grabber else read_frame(None)
+                if item is None:
+                    print("Error: the camera stopped sending frames")
+                    break
+                frame_start = time.perf_counter()
+                if args.lores:
+                    gray, frame = item
+                    if context is None and args.detector == 'yolo':
+                        context = cv2util.PreprocessContext(frame.shape, window, blob_size)
+                        detector.context = context
+                else:
+                    with profiler.stage('convert'):
+                        if context is None:
+                            color = cv2.cvtColor(item, cv2.COLOR_BGRA2RGB)
+                            context = cv2util.PreprocessContext(color.shape, window, blob_size)
+                            if args.detector == 'yolo':
+                                detector.context = context
+                        frame = cv2.cvtColor(item, cv2.COLOR_BGRA2RGB, dst=color)
+                        frame = context.shrink(frame)
+                        gray = context.to_gray(frame)
+
+                # Detect (or track) faces
+                image = gray
+                if args.detector == 'yolo':
+                    with profiler.stage('convert'):
+                        code = cv2.COLOR_BGRA2BGR if args.lores else cv2.COLOR_RGB2BGR
+                        image = cv2.cvtColor(frame, code)
+                if hybrid is not None:
+                    tracks = hybrid.update(gray, image)
+                    faces = [track.object for track in tracks]
+                else:
+                    faces = detect(image)
+                if args.no_window:
+                    if len(faces) != count:
+                        count = len(faces)
+                        print(f'{count} faces: {[box for label, score, box in faces]}')
+                else:
+                    neon = (0, 255, 204)
+                    with profiler.stage('annotate'):
+                        for label, score, (x, y, w, h) in faces:
+                            ctr_x = x + w // 2
+                            ctr_y = y + h // 2
+                            cv2.rectangle(frame, (x, y), (x+w, y+h), neon, 1)
+                            cv2.line(frame, (ctr_x-5, ctr_y), (ctr_x+5, ctr_y), neon, 2)
+                            cv2.line(frame, (ctr_x, ctr_y-5), (ctr_x, ctr_y+5), neon, 2)
+                        if hybrid is not None:
+                            for track in tracks:
+                                x, y = track.box[:2]
+                                cv2.putText(frame, f'#{track.id}', (x, max(12, y - 4)),
+                                            cv2.FONT_HERSHEY_SIMPLEX, 0.45, neon, 1)
+                    if governor is not None:
+                        cv2.putText(frame, f'{governor.fps:.1f} fps  level {governor.level}',
+                                    (8, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, neon, 1)
+                    with profiler.stage('display'):
+                        cv2.imshow('TRACKER', frame)
+
+                # The governor judges the whole loop, from grab to display,
+                #   so --target-fps is the frame rate that is actually shown
+                if governor is not None and governor.update(time.perf_counter() - frame_start):
+                    print(f'Governor: level {governor.level} {governor.settings}')
+                    if search is not None:
+                        search.faces = []   # the old faces were at the old resolution
+    except KeyboardInterrupt:
+        print(" User quit with <CTRL+C>")
 
+    if grabber is not None:
+        grabber.stop()
+        grabber.print_stats()
     picam.stop()
     picam.close()
+    detector.close()
+    if governor is not None:
+        print(f'Governor: {governor.changes} adjustments, ended at level {governor.level} '
+              f'({governor.fps:.1f} fps for a target of {governor.target_fps:.1f})')
+    if hybrid is not None:
+        print(f'Hybrid: ran the detector on {hybrid.detections} of {hybrid.frames} frames')
+    if search is not None:
+        print(f'ROI search: {search.full_scans} full frame scans, {search.roi_scans} window '
+              f'scans, {search.lost} lost faces')
 
 
 if __name__ == '__main__':
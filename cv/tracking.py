@@ -0,0 +1,525 @@
+
+# Prof Tallman
+# Helpers that make tracker.py fast enough for a live camera on a Raspberry Pi.
+#
+# Region Of Interest (ROI) search: from one frame to the next, a face only
+# moves a few pixels and stays about the same size. So instead of running the
+# HAAR cascade over the whole 640x480 frame, RoiFaceSearch only searches a
+# window around each face from the last frame, and only for faces that are
+# close to the last face's size:
+#
+#   +--------------------------------+
+#   |        +---------+             |   the outer box is the whole frame,
+#   |        |  +---+  |             |   the middle box is the search window
+#   |        |  |   |  |             |   (the old face grown by a margin on
+#   |        |  +---+  |             |   every side), and the cascade only
+#   |        +---------+             |   looks for faces between
+#   |                                |   min_size and max_size in it
+#   +--------------------------------+
+#
+# The cascade slides its window over every position at every scale of an
+# image pyramid, so its cost grows with the number of pixels and with the
+# number of scales. A window that is a quarter of the frame with a band of
+# three or four scales is several times less work than the full search.
+#
+# The catch is that a new face somewhere else in the frame is never found, so
+# the whole frame is searched again every `rescan_every` frames, and right
+# away whenever a face is lost from its window.
+#
+# Detect then track: even a fast detector is slow next to following an object
+# that has already been found. HybridTracker only runs the detector every N
+# frames (or sooner, when it is losing track of something). In between, each
+# object's box is moved along with the image by a cheap tracker:
+#
+#   lk    --> sparse Lucas-Kanade optical flow. A few dozen corners inside
+#             each box are followed from one frame to the next, and the box
+#             moves (and grows or shrinks) with the middle of the crowd.
+#             Corners that can't be followed back to where they started are
+#             thrown out, and the fraction that survive is the confidence.
+#   mil, kcf, csrt, mosse --> the OpenCV object trackers, one per object.
+#             MIL is in every OpenCV build; the others need opencv-contrib.
+#
+# Each object gets an ID number when it is first detected. When the detector
+# runs again, its boxes are matched to the tracked boxes by how much they
+# overlap, so an object keeps its ID for as long as it is followed.
+#
+# FPS governor: how long the HAAR cascade takes depends on what is in front
+# of the camera (a busy background has more places that almost look like a
+# face) and on the CPU clock, which a hot Pi turns down. FpsGovernor watches
+# how long recent frames took and steps through a ladder of settings to hold
+# a target frame rate: each step down the ladder searches a smaller image,
+# with fewer pyramid scales, fewer neighbors, and a bigger minimum face. To
+# keep it from flipping back and forth between two steps (hysteresis):
+#
+#   - it only steps down when frames are over budget by a margin, and only
+#     steps back up when they are well under budget
+#   - it waits for a number of frames after every change before judging the
+#     new settings
+#   - it remembers which steps were too slow and waits much longer before
+#     trying one of them again, doubling the wait after every failed retry
+#
+# The frame time is the whole loop, from the moment the frame is grabbed to
+# when it is shown, so the target is the frame rate that the user sees. It is
+# usually the median of the recent frames, which ignores the odd slow frame.
+# When the detector only runs every few frames (HybridTracker), the median is
+# one of the cheap tracking frames, so the mean of a longer window is used
+# instead.
+#
+# References:
+#  - https://docs.opencv.org/4.x/d1/de5/classcv_1_1CascadeClassifier.html
+#  - https://docs.opencv.org/4.x/db/d28/tutorial_cascade_classifier.html
+#  - https://docs.opencv.org/4.x/d4/dee/tutorial_optical_flow.html
+#  - https://docs.opencv.org/4.x/d0/d0a/classcv_1_1Tracker.html
+
+import numpy as np
+import statistics
+import cv2
+import haar
+import nms
+import profiler
+
+
+def grow_box(box, margin, frame_size):
+    """
+    Grows an (x, y, w, h) box by `margin` times its width and height on every
+    side and clips it to a frame that is `frame_size` (width, height).
+    """
+    x, y, w, h = box
+    frame_w, frame_h = frame_size
+    x1 = max(0, int(x - margin * w))
+    y1 = max(0, int(y - margin * h))
+    x2 = min(frame_w, int(x + w + margin * w))
+    y2 = min(frame_h, int(y + h + margin * h))
+    return [x1, y1, x2 - x1, y2 - y1]
+
+
+def merge_windows(windows):
+    """
+    Merges search windows that overlap into their bounding box so that two
+    faces close together are not searched twice. Returns a list of windows,
+    each a tuple of ([x, y, w, h], list of the indexes it was made from).
+    """
+    merged = [(list(box), [i]) for i, box in enumerate(windows)]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                (ax, ay, aw, ah), a_ids = merged[i]
+                (bx, by, bw, bh), b_ids = merged[j]
+                if ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah:
+                    x1, y1 = min(ax, bx), min(ay, by)
+                    x2, y2 = max(ax + aw, bx + bw), max(ay + ah, by + bh)
+                    merged[i] = ([x1, y1, x2 - x1, y2 - y1], a_ids + b_ids)
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+class RoiFaceSearch:
+    """
+    Searches for faces with a loaded haar.HaarDetector, only looking in a
+    window around the faces found in the previous frame. Call `detect` with
+    each grayscale frame of a video; it returns the same objects as
+    HaarDetector.detect does for one frame.
+    """
+
+    def __init__(self, detector, margin=0.5, size_band=(0.75, 1.33), rescan_every=15):
+        """
+        Args:
+         - detector: haar.HaarDetector; its scale factor, min neighbors, and
+           NMS threshold are used for every search
+         - margin: search window around a face, as a fraction of its size on
+           each side (0.5 makes the window twice as wide and tall)
+         - size_band: (smallest, largest) face to look for in a window, as
+           fractions of the size of the face from the last frame
+         - rescan_every: search the whole frame every this many frames
+        """
+        self.detector = detector
+        self.margin = margin
+        self.size_band = size_band
+        self.rescan_every = rescan_every
+        self.faces = []
+        self.full_scans = 0
+        self.roi_scans = 0
+        self.lost = 0
+        self._since_full = 0
+
+    def detect(self, gray):
+        """ Returns the faces in a grayscale frame, searching as little as possible. """
+        if not self.faces or self._since_full >= self.rescan_every:
+            return self.full_scan(gray)
+
+        self._since_full += 1
+        objects = self._roi_scan(gray)
+
+        # A face that was not found in its window may have moved too fast or
+        #   turned away, so search everything before giving up on it
+        if len(objects) < len(self.faces):
+            self.lost += 1
+            return self.full_scan(gray)
+        self.faces = objects
+        return objects
+
+    def full_scan(self, gray):
+        """ Searches the whole frame and restarts the count to the next full scan. """
+        self.full_scans += 1
+        self._since_full = 0
+        self.faces = self.detector.detect([gray])[0]
+        return self.faces
+
+    def _roi_scan(self, gray):
+        p = self.detector.params
+        frame_size = (gray.shape[1], gray.shape[0])
+        windows = [grow_box(box, self.margin, frame_size) for label, score, box in self.faces]
+
+        objects = []
+        for (x, y, w, h), ids in merge_windows(windows):
+
+            # Look for faces a little smaller than the smallest face and a
+            #   little bigger than the biggest face that made this window
+            sizes = [self.faces[i][2][2:] for i in ids]
+            min_w = int(min(fw for fw, fh in sizes) * self.size_band[0])
+            min_h = int(min(fh for fw, fh in sizes) * self.size_band[0])
+            max_w = int(max(fw for fw, fh in sizes) * self.size_band[1])
+            max_h = int(max(fh for fw, fh in sizes) * self.size_band[1])
+
+            # Slicing makes a view of the frame, not a copy
+            self.roi_scans += 1
+            with profiler.stage('haar.roi'):
+                found = haar.detect_faces(gray[y:y+h, x:x+w], self.detector.model,
+                                          p['scale_factor'], p['min_neighbors'], None,
+                                          (min_w, min_h), (max_w, max_h))
+            objects.extend((label, score, [fx + x, fy + y, fw, fh])
+                           for label, score, (fx, fy, fw, fh) in found)
+
+        if p['nms_threshold'] is None:
+            return objects
+        return nms.suppress(objects, p['nms_threshold'])
+
+
+# OpenCV tracker constructors by name. Some builds keep the older trackers in
+# cv2.legacy, so both places are checked.
+CV_TRACKERS = {
+    'mil': 'TrackerMIL_create',
+    'kcf': 'TrackerKCF_create',
+    'csrt': 'TrackerCSRT_create',
+    'mosse': 'TrackerMOSSE_create',
+}
+TRACK_METHODS = ['lk'] + list(CV_TRACKERS)
+
+
+def create_cv_tracker(method):
+    """ Creates an OpenCV object tracker by name (see CV_TRACKERS). """
+    for module in (cv2, getattr(cv2, 'legacy', None)):
+        if module is not None and hasattr(module, CV_TRACKERS[method]):
+            return getattr(module, CV_TRACKERS[method])()
+    raise ValueError(f"Tracker '{method}' is not available in this OpenCV build "
+                     f"(it may need opencv-contrib)")
+
+
+class Track:
+    """ One object that is being followed. """
+
+    def __init__(self, track_id, label, score, box):
+        self.id = track_id
+        self.label = label
+        self.score = score
+        self.rect = [float(v) for v in box]     # x, y, w, h with sub-pixel accuracy
+        self.confidence = 1.0
+        self.points = None      # corners for optical flow
+        self.start_count = 0    # number of corners when they were found
+        self.cv_tracker = None  # OpenCV tracker
+
+    @property
+    def box(self):
+        """
+        The box in whole pixels. The track keeps the unrounded box in `rect`,
+        since rounding it on every frame would add up to a drifting box.
+        """
+        return [int(round(v)) for v in self.rect]
+
+    @property
+    def object(self):
+        """ The track as a detector object: (label, score, [x, y, w, h]). """
+        return (self.label, self.score, self.box)
+
+
+class HybridTracker:
+    """
+    Runs an expensive detector every few frames and follows its objects with
+    a cheap tracker in between. Call `update` with every frame; it returns
+    the tracks, each with a stable `id`, a `box`, and a `confidence`.
+    """
+
+    def __init__(self, detect, detect_every=10, method='lk', min_confidence=0.5,
+                 match_iou=0.3, max_points=40):
+        """
+        Args:
+         - detect: function that takes a frame and returns a list of
+           (label, score, [x, y, w, h]) objects
+         - detect_every: run the detector on every Nth frame
+         - method: 'lk' for optical flow, or an OpenCV tracker (CV_TRACKERS)
+         - min_confidence: run the detector early when any track's confidence
+           drops below this
+         - match_iou: a detection takes over a track's ID when their boxes
+           overlap by at least this much
+         - max_points: most corners to follow in each box (lk)
+        """
+        if method != 'lk' and method not in CV_TRACKERS:
+            raise ValueError(f"Unknown tracking method '{method}'")
+        if method != 'lk':
+            create_cv_tracker(method)   # fail now rather than at the first object
+        self.detect = detect
+        self.detect_every = detect_every
+        self.method = method
+        self.min_confidence = min_confidence
+        self.match_iou = match_iou
+        self.max_points = max_points
+        self.tracks = []
+        self.detections = 0
+        self.frames = 0
+        self._next_id = 1
+        self._since_detect = 0
+        self._prev_gray = None
+
+    def update(self, gray, frame=None):
+        """
+        Follows the objects into a new frame and returns the tracks.
+
+        Args:
+         - gray: grayscale frame, used by the optical flow
+         - frame: the frame to hand to the detector and the OpenCV trackers
+           (defaults to `gray`); a color detector such as YOLO needs this
+        """
+        frame = gray if frame is None else frame
+        self.frames += 1
+        weak = any(track.confidence < self.min_confidence for track in self.tracks)
+        if self.frames == 1 or weak or self._since_detect + 1 >= self.detect_every:
+            self._detect(gray, frame)
+        else:
+            self._since_detect += 1
+            with profiler.stage(f'track.{self.method}'):
+                if self.method == 'lk':
+                    self._flow(gray)
+                else:
+                    self._cv_track(frame)
+        self._prev_gray = gray.copy() if self.method == 'lk' else None
+        return self.tracks
+
+    def _detect(self, gray, frame):
+        self.detections += 1
+        self._since_detect = 0
+        objects = self.detect(frame)
+
+        # Greedy matching: the most overlapping (detection, track) pairs
+        #   first, so each track is taken by at most one detection
+        rects = [track.rect for track in self.tracks]
+        pairs = sorted(((float(iou), i, j)
+                        for i, (label, score, box) in enumerate(objects)
+                        for j, iou in enumerate(nms.box_iou(box, rects))), reverse=True)
+        matched = {}
+        used = set()
+        for iou, i, j in pairs:
+            if iou < self.match_iou:
+                break
+            if i not in matched and j not in used:
+                matched[i] = self.tracks[j].id
+                used.add(j)
+
+        tracks = []
+        for i, (label, score, box) in enumerate(objects):
+            track_id = matched.get(i)
+            if track_id is None:
+                track_id = self._next_id
+                self._next_id += 1
+            track = Track(track_id, label, score, box)
+            self._start(track, gray, frame)
+            tracks.append(track)
+        self.tracks = tracks
+
+    def _start(self, track, gray, frame):
+        """ Gets the tracker of a freshly detected object ready. """
+        x, y, w, h = track.box
+        if self.method != 'lk':
+            track.cv_tracker = create_cv_tracker(self.method)
+            track.cv_tracker.init(frame, (x, y, w, h))
+            return
+
+        # Corners inside the middle of the box, where the object is (the
+        #   edges of the box are often background)
+        x1, y1 = max(0, x + w // 8), max(0, y + h // 8)
+        x2, y2 = x + w - w // 8, y + h - h // 8
+        corners = None
+        if x2 - x1 > 2 and y2 - y1 > 2:
+            corners = cv2.goodFeaturesToTrack(gray[y1:y2, x1:x2], self.max_points, 0.01, 3)
+        if corners is None:
+            track.points = np.zeros((0, 1, 2), dtype=np.float32)
+        else:
+            track.points = corners.astype(np.float32) + np.array([x1, y1], dtype=np.float32)
+        track.start_count = len(track.points)
+
+    def _flow(self, gray):
+        """ Moves every box with its corners, using one optical flow call. """
+        counts = [len(track.points) for track in self.tracks]
+        if sum(counts) == 0:
+            for track in self.tracks:
+                track.confidence = 0.0
+            return
+        old = np.concatenate([track.points for track in self.tracks])
+
+        # Follow the corners forward, then back again. A corner that does
+        #   not come back to where it started was followed by mistake.
+        lk = dict(winSize=(15, 15), maxLevel=2,
+                  criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        new, status, err = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, old, None, **lk)
+        back, status_back, err = cv2.calcOpticalFlowPyrLK(gray, self._prev_gray, new, None, **lk)
+        distance = np.abs(old - back).reshape(-1, 2).max(axis=1)
+        good = (status.ravel() == 1) & (status_back.ravel() == 1) & (distance < 1.0)
+
+        start = 0
+        for track, count in zip(self.tracks, counts):
+            keep = good[start:start+count]
+            before = old[start:start+count][keep].reshape(-1, 2)
+            after = new[start:start+count][keep].reshape(-1, 2)
+            start += count
+            track.points = after.reshape(-1, 1, 2)
+            track.confidence = len(after) / track.start_count if track.start_count else 0.0
+            if len(after) < 3:
+                track.confidence = 0.0
+                continue
+
+            # The box moves with the median corner and grows or shrinks with
+            #   the median change in distance from the middle of the corners
+            dx, dy = np.median(after - before, axis=0)
+            spread_before = np.linalg.norm(before - before.mean(axis=0), axis=1)
+            spread_after = np.linalg.norm(after - after.mean(axis=0), axis=1)
+            ok = spread_before > 1e-3
+            scale = float(np.median(spread_after[ok] / spread_before[ok])) if ok.any() else 1.0
+            x, y, w, h = track.rect
+            cx, cy = x + w / 2 + dx, y + h / 2 + dy
+            w, h = w * scale, h * scale
+            track.rect = [float(cx - w / 2), float(cy - h / 2), float(w), float(h)]
+
+    def _cv_track(self, frame):
+        for track in self.tracks:
+            ok, box = track.cv_tracker.update(frame)
+            if ok:
+                track.rect = [float(v) for v in box]
+                track.confidence = 1.0
+            else:
+                track.confidence = 0.0
+
+
+
+# Settings ladder for FpsGovernor, from the best (and slowest) to the fastest:
+#   resolution    --> fraction of the 640x480 frame that is searched
+#   scale_factor  --> HAAR image pyramid step (bigger = fewer scales)
+#   min_neighbors --> HAAR detections needed to keep a face
+#   min_size      --> smallest face to look for, in pixels of the full frame
+GOVERNOR_LEVELS = [
+    {'resolution': 1.0, 'scale_factor': 1.1, 'min_neighbors': 4, 'min_size': 30},
+    {'resolution': 1.0, 'scale_factor': 1.2, 'min_neighbors': 4, 'min_size': 36},
+    {'resolution': 0.75, 'scale_factor': 1.2, 'min_neighbors': 3, 'min_size': 40},
+    {'resolution': 0.75, 'scale_factor': 1.3, 'min_neighbors': 3, 'min_size': 48},
+    {'resolution': 0.5, 'scale_factor': 1.3, 'min_neighbors': 3, 'min_size': 56},
+    {'resolution': 0.5, 'scale_factor': 1.4, 'min_neighbors': 2, 'min_size': 64},
+]
+
+
+class FpsGovernor:
+    """
+    Feedback controller that picks settings from GOVERNOR_LEVELS to hold a
+    target frame rate. Call `update` with the time each frame took; read
+    `settings` for the settings to use on the next frame.
+    """
+
+    def __init__(self, target_fps, levels=GOVERNOR_LEVELS, window=15, slow_margin=1.1,
+                 fast_margin=0.7, hold=30, level=0, statistic=statistics.median):
+        """
+        Args:
+         - target_fps: frame rate to hold
+         - levels: settings ladder, best first
+         - window: number of recent frames whose typical time is used
+         - slow_margin: step down when frames take more than this times
+           the frame budget (1 / target_fps)
+         - fast_margin: step up when frames take less than this times the
+           budget
+         - hold: frames to wait after a change before changing again
+         - level: starting level
+         - statistic: function that turns the window of frame times into the
+           typical frame time, such as statistics.median or statistics.fmean
+        """
+        self.target_fps = target_fps
+        self.levels = levels
+        self.window = window
+        self.slow_margin = slow_margin
+        self.fast_margin = fast_margin
+        self.hold = hold
+        self.level = level
+        self.statistic = statistic
+        self.changes = 0
+        self.frames = 0
+        self.level_seconds = {}     # level --> typical frame time last seen
+        self._times = []
+        self._since_change = 0
+        self._retries = {}          # level --> failed retries in a row
+
+    @property
+    def settings(self):
+        return self.levels[self.level]
+
+    @property
+    def budget(self):
+        """ Seconds per frame at the target frame rate. """
+        return 1.0 / self.target_fps
+
+    def update(self, seconds):
+        """
+        Records how long a frame took, from grab to display. Returns True if
+        the settings changed.
+        """
+        self.frames += 1
+        self._since_change += 1
+        self._times.append(seconds)
+        if len(self._times) > self.window:
+            del self._times[0]
+        if len(self._times) < self.window or self._since_change < self.hold:
+            return False
+
+        recent = self.statistic(self._times)
+        self.level_seconds[self.level] = recent
+        if recent <= self.budget:
+            self._retries.pop(self.level, None)
+        level = self.level
+        if recent > self.budget * self.slow_margin and level < len(self.levels) - 1:
+            level += 1
+        elif recent < self.budget * self.fast_margin and level > 0:
+
+            # A better level that was too slow the last time it was tried is
+            #   only tried again after waiting several times as long, and
+            #   twice as long again after every retry that fails
+            known = self.level_seconds.get(level - 1)
+            if known is None or known <= self.budget:
+                level -= 1
+            else:
+                retries = self._retries.get(level - 1, 0)
+                if self._since_change >= 4 * self.hold * 2 ** min(retries, 6):
+                    self._retries[level - 1] = retries + 1
+                    level -= 1
+        if level == self.level:
+            return False
+
+        self.level = level
+        self.changes += 1
+        self._times.clear()
+        self._since_change = 0
+        return True
+
+    @property
+    def fps(self):
+        """ Frame rate of the recent frames, or 0 before there are any. """
+        return 1.0 / self.statistic(self._times) if self._times else 0.0
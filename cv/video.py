@@ -0,0 +1,300 @@
+
+# Prof Tallman
+# Runs an object detector over a video file, such as the recordings that
+# movie.py makes.
+#
+# A video is just a long list of images, but there are a lot of them: ten
+# minutes at 30 fps is 18,000 frames. Running the detector on every one of
+# them would take hours on a Raspberry Pi, and most neighboring frames look
+# almost exactly the same anyway. So this module only runs the detector on
+# some of the frames:
+#
+#   --every N        --> detect on every Nth frame
+#   --sample-fps X   --> detect on X frames per second of video
+#
+# Skipped frames are still read from the file (a video can't be read out of
+# order cheaply) but with `grab()` instead of `read()`, which skips the work of
+# converting the frame into an image.
+#
+# Like pipeline.py, the work is split into threads that pass frames through
+# bounded queues so that decoding the video overlaps with the detector:
+#
+#   decode  --> a thread that reads the video file and skips frames
+#   detect  --> the calling thread, which runs the detector
+#   write   --> a thread that draws the boxes, adds the frame to the output
+#               video, and writes one line of JSON per detected frame
+#
+# The output video holds only the detected frames, played back at the sample
+# rate, unless --video-all-frames is given. Then every frame is decoded and
+# written, each with the boxes from the most recent detection. The output
+# video is opened before any thread starts, so a bad path or a codec that
+# this OpenCV build can't write is an error right away. If the decode or
+# write thread fails later, it sets the stop event so the other stages quit
+# instead of waiting on a full queue, and the error is raised at the end.
+#
+# Example:
+#   python yolo.py test.h264 --sample-fps 2 --video-output test_boxes.mp4 --jsonl test.jsonl
+#
+# References:
+#  - https://docs.opencv.org/4.x/d8/dfe/classcv_1_1VideoCapture.html
+#  - https://docs.opencv.org/4.x/dd/d9e/classcv_1_1VideoWriter.html
+
+import threading
+import queue
+import json
+import time
+import cv2
+import sys
+import os
+import cv2util
+import profiler
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.h264', '.mjpeg', '.mjpg')
+
+
+def is_video_file(filename):
+    """ Returns True if a file looks like a video based on its extension. """
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+
+def add_arguments(parser):
+    """ Adds the command line options for video files to an argparse parser. """
+    group = parser.add_argument_group('video input')
+    group.add_argument('--every', type=int, default=1, metavar='N',
+                       help='detect on every Nth frame of a video (default: 1)')
+    group.add_argument('--sample-fps', type=float, metavar='X',
+                       help='detect on X frames per second of video (overrides --every)')
+    group.add_argument('--video-output', metavar='FILE',
+                       help='save the annotated frames to this video file')
+    group.add_argument('--video-all-frames', action='store_true',
+                       help='write every frame to --video-output, not just the detected ones')
+    group.add_argument('--video-fps', type=float, metavar='X',
+                       help='frame rate of the input, for files that do not record one '
+                            '(such as raw .h264 from movie.py)')
+    group.add_argument('--codec', default='mp4v', metavar='FOURCC',
+                       help='four character code for the output video (default: mp4v)')
+
+
+def frame_step(video_fps, every=1, sample_fps=None):
+    """
+    Returns how many frames to advance between detections: `every`, or the
+    step that comes closest to `sample_fps` detections per second of video.
+    """
+    if sample_fps is not None and sample_fps > 0:
+        return max(1, int(round(video_fps / sample_fps)))
+    return max(1, every)
+
+
+def run_from_args(args, video_file, detector, bbox=(640, 480)):
+    """
+    Runs a detector over a video file using the options that were added to
+    the command line by `add_arguments` and pipeline.add_arguments.
+    """
+    jsonl_file = open(args.jsonl, 'w') if args.jsonl else sys.stdout
+    try:
+        if args.threads is not None:
+            cv2.setNumThreads(args.threads)
+        with detector:
+            return run_video(video_file, lambda img: detector.detect([img])[0],
+                             detector.annotate, args.video_output, jsonl_file,
+                             args.every, args.sample_fps, args.video_fps,
+                             args.video_all_frames, args.codec, args.queue_size, bbox)
+    except IOError as e:
+        print(f"Error: {e}")
+    finally:
+        if jsonl_file is not sys.stdout:
+            jsonl_file.close()
+
+
+def run_video(video_file, detect, annotate, output_file=None, jsonl_file=sys.stdout,
+              every=1, sample_fps=None, video_fps=None, all_frames=False,
+              codec='mp4v', queue_size=8, bbox=(640, 480)):
+    """
+    Runs a detector over the frames of a video file.
+
+    Args:
+     - video_file: video to read
+     - detect: function that takes an image and returns a list of objects,
+       each a tuple of (label, score, [x, y, w, h])
+     - annotate: function that draws the objects onto an image
+     - output_file: annotated video to write, or None to skip it
+     - jsonl_file: open text file that receives one JSON line per detected
+       frame
+     - every, sample_fps: which frames to detect on (see `frame_step`)
+     - video_fps: frame rate to assume if the file does not record one
+     - all_frames: write every frame to the output video instead of only
+       the detected frames
+     - codec: FOURCC code for the output video
+     - queue_size: max number of frames waiting between two threads
+     - bbox: frames are shrunk to fit in this box before detection
+
+    Returns a dictionary summarizing the run.
+    """
+
+    capture = cv2.VideoCapture(video_file)
+    if not capture.isOpened():
+        raise IOError(f"cv2 could not open video file '{video_file}'")
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not fps or fps > 1000:
+        fps = video_fps or 30.0
+    step = frame_step(fps, every, sample_fps)
+
+    # The frames are shrunk the same way as shrink_to_fit, so the size of
+    #   the output video is known before the first frame is read
+    video_writer = None
+    if output_file is not None:
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width <= 0 or height <= 0:
+            capture.release()
+            raise IOError(f"cv2 could not read the frame size of '{video_file}'")
+        size = cv2util.Resizer(bbox).plan((height, width, 3)) or (width, height)
+        out_fps = fps if all_frames else fps / step
+        video_writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*codec), out_fps, size)
+        if not video_writer.isOpened():
+            capture.release()
+            raise IOError(f"cv2 could not open '{output_file}' for writing with codec '{codec}'")
+
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    counts = {'read': 0, 'detected': 0}
+    errors = []
+
+    # A stage that fails saves its error and sets the stop event, and the
+    #   other stages check the stop event instead of blocking on a queue
+    #   that nobody is emptying any more
+
+    def put(q, item):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # The decode stage reads every frame but only converts the ones that are
+    #   needed. Each queue item is (frame number, image, detect?).
+
+    def decode():
+        index = 0
+        try:
+            while not stop_event.is_set():
+                wanted = index % step == 0
+                if wanted or all_frames:
+                    with profiler.stage('video.read'):
+                        ok, frame = capture.read()
+                    if ok:
+                        frame = cv2util.shrink_to_fit(frame, bbox)
+                else:
+                    with profiler.stage('video.grab'):
+                        ok, frame = capture.grab(), None
+                if not ok:
+                    break
+                if frame is not None and not put(decode_queue, (index, frame, wanted)):
+                    break
+                index += 1
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            counts['read'] = index
+            decode_queue.put(None)
+
+    def write():
+        objects = []
+        try:
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                index, frame, detected, frame_objects, duration = item
+                if detected:
+                    objects = frame_objects
+                    record = {
+                        'frame': index,
+                        'time': round(index / fps, 3),
+                        'detect_seconds': round(duration, 6),
+                        'objects': [{'label': label, 'score': score, 'box': [int(v) for v in box]}
+                                    for label, score, box in objects],
+                    }
+                    jsonl_file.write(json.dumps(record) + '\n')
+                if video_writer is not None:
+                    with profiler.stage('annotate'):
+                        annotate(frame, objects)
+                    with profiler.stage('video.write'):
+                        video_writer.write(frame)
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    time_start = time.perf_counter()
+    detect_seconds = 0.0
+    decoder = threading.Thread(target=decode, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    decoder.start()
+    writer.start()
+    try:
+        while True:
+            item = decode_queue.get()
+            if item is None:
+                break
+            index, frame, wanted = item
+            objects = []
+            duration = 0.0
+            if wanted:
+                detect_start = time.perf_counter()
+                objects = detect(frame)
+                duration = time.perf_counter() - detect_start
+                detect_seconds += duration
+                counts['detected'] += 1
+            if not put(write_queue, (index, frame, wanted, objects, duration)):
+                break
+    finally:
+        # Unblock the decoder if we are quitting early (e.g. <CTRL+C>)
+        stop_event.set()
+        while decoder.is_alive():
+            try:
+                decode_queue.get_nowait()
+            except queue.Empty:
+                decoder.join(0.01)
+
+        # The writer finishes the frames it already has, unless it failed
+        while writer.is_alive():
+            try:
+                write_queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        writer.join()
+        capture.release()
+        if video_writer is not None:
+            video_writer.release()
+    if errors:
+        raise errors[0]
+    wall_seconds = time.perf_counter() - time_start
+    jsonl_file.flush()
+
+    video_seconds = counts['read'] / fps
+    summary = {
+        'frames': counts['read'],
+        'detected': counts['detected'],
+        'step': step,
+        'fps': fps,
+        'video_seconds': video_seconds,
+        'wall_seconds': wall_seconds,
+        'speed': video_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+        'detect_utilization': detect_seconds / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+    print_summary(summary)
+    return summary
+
+
+def print_summary(summary, file=sys.stderr):
+    """ Prints a summary produced by `run_video`. """
+    print(f"Read {summary['frames']} frames ({summary['video_seconds']:.1f}s of video at "
+          f"{summary['fps']:.1f} fps) and detected on {summary['detected']} "
+          f"(every {summary['step']}) in {summary['wall_seconds']:.3f}s", file=file)
+    print(f"  => {summary['speed']:.2f}x real time", file=file)
+    print(f"  => detect stage {100*summary['detect_utilization']:.1f}% busy", file=file)
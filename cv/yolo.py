@@ -43,19 +43,34 @@
 
 
 import numpy as np
-import time
 import cv2
 import sys
-import os
-import cv2util
+import detector
+import models
+import nms
+import profiler
 
 
-def load_yolo_deep_neural_network():
+# COCO labels that detect_persons keeps by default (label #0 is 'person')
+PERSON_CLASSES = (0,)
+
+# Default size of the DNN's input blob (see detect_persons)
+BLOB_SIZE = (224, 224)
+
+# Blob size used for each tile in tiled mode (see YoloDetector.detect_tiles)
+TILE_BLOB_SIZE = (416, 416)
+
+def load_yolo_deep_neural_network(model='yolov3', model_dir='.', backend='default',
+                                  target='cpu', threads=None):
     """
     Loads the YOLOv3 object detection algorithm that has been trained with the
     Microsoft Common Objects in Context Dataset (COCO) to identify 80 objects.
-    The three YOLOv3-COCO data files must be located in the same directory as
-    this python script. See https://arxiv.org/abs/1405.0312.
+    The three YOLOv3-COCO data files must be located in `model_dir`, which is
+    the current directory by default. See https://arxiv.org/abs/1405.0312.
+
+    Lighter models such as yolov3-tiny and the ONNX YOLOv5/v8 networks can be
+    loaded by name instead, and the DNN can be moved to a different backend
+    and target device. See models.py for the list.
 
     Returns a tuple containing 3 objects:
       0. Fully trained YOLO Deep Neurel Network Object classifier
@@ -63,25 +78,25 @@ def load_yolo_deep_neural_network():
       2. List of the classification labels for the 80 known COCO objects
     """
 
-    labels_path = f'coco.names'
-    config_path = f'yolov3.cfg'
-    weights_path = f'yolov3.weights'
-
-    with open(labels_path, 'r') as f:
-        dnn_labels = [line.strip('\n') for line in f]
+    return models.load_model(model, model_dir, backend, target, threads)
 
-    dnn_object = cv2.dnn.readNetFromDarknet(config_path, weights_path)
-    dnn_layers = dnn_object.getUnconnectedOutLayersNames()
 
-    return (dnn_object, dnn_layers, dnn_labels)
 
 
-
-
-def detect_persons(img, dnn_object, obj_confidence, nms_threshold):
+def detect_persons(img, dnn_object, obj_confidence, nms_threshold,
+                   target_classes=PERSON_CLASSES, blob_size=BLOB_SIZE,
+                   context=None, top_k=None, soft_nms=False):
     """
     Detects COCO objects in an image with an OpenCV Deep Neural Network using
-    Non-Maxima Supression to reduce the number of duplicate objects.
+    Non-Maxima Supression to reduce the number of duplicate objects. Only the
+    COCO labels listed in `target_classes` are kept; pass `None` to keep all
+    80 of the COCO objects.
+
+    Frames from a camera can pass a cv2util.PreprocessContext as `context` to
+    reuse its preallocated blob instead of creating a new blob for every
+    frame. The context letterboxes the frame and uses its own blob size.
+
+    `top_k` and `soft_nms` are passed on to `decode_yolo_outputs`.
 
     Returns a list of detected objects, each defined as a tuple:
       0. COCO label, as an index number
@@ -89,67 +104,184 @@ def detect_persons(img, dnn_object, obj_confidence, nms_threshold):
       2. Bounding box for the object
     """
 
+    img_h, img_w = img.shape[:2]
+    if context is None:
+        outputs = run_yolo_network(img, dnn_object, blob_size)
+        return decode_yolo_outputs(outputs, img_w, img_h, obj_confidence,
+                                   nms_threshold, target_classes, None,
+                                   top_k, soft_nms)
+
+    dnn_classifier, dnn_outputlayers = dnn_object
+    with profiler.stage('yolo.blob'):
+        blob = context.make_blob(img)
+    with profiler.stage('yolo.forward'):
+        dnn_classifier.setInput(blob)
+        outputs = dnn_classifier.forward(dnn_outputlayers)
+    return decode_yolo_outputs(outputs, img_w, img_h, obj_confidence,
+                               nms_threshold, target_classes, context.letterbox,
+                               top_k, soft_nms)
+
+
+
+
+def run_yolo_network(img, dnn_object, blob_size=BLOB_SIZE):
+    """
+    Runs an image through the YOLO Deep Neural Network. Returns the raw
+    output layers, which can be turned into objects by `decode_yolo_outputs`.
+    """
+
     # Process raw image through the neural network to obtain potential objects
     #  => 1/255 is the scaling factor --> RGB value to a percentage
-    #  => (224, 224) is the size of the output blob with smaller sizees being
-    #     faster but potentially less accurate. The number came from this
+    #  => (224, 224) is the default size of the output blob with smaller sizees
+    #     being faster but potentially less accurate. The number came from this
     #     article by Adrian Rosebrock on PyImageSearch and produced fairly
-    #     accurate results during some limited testing.
+    #     accurate results during some limited testing. YOLOv3 accepts any
+    #     size that is a multiple of 32.
 
-    blob = cv2.dnn.blobFromImage(img, 1/255.0, (224, 224), swapRB=True, crop=False)
+    with profiler.stage('yolo.blob'):
+        blob = cv2.dnn.blobFromImage(img, 1/255.0, blob_size, swapRB=True, crop=False)
     
     # Run the DNN object detection algorithm
 
     dnn_classifier, dnn_outputlayers = dnn_object
-    dnn_classifier.setInput(blob)
-    outputs = dnn_classifier.forward(dnn_outputlayers)
-    flattened_outputs = [result for layer in outputs for result in layer]
+    with profiler.stage('yolo.forward'):
+        dnn_classifier.setInput(blob)
+        return dnn_classifier.forward(dnn_outputlayers)
 
-    # We will identify objects by their location (the bounding box), the
-    #   confidence score, and then the COCO label assigned by the DNN.
-    # We need the image width x height to create the bounding boxes
 
-    boxes = []
-    scores = []
-    labels = []
-    img_h, img_w = img.shape[:2]
 
-    # Each result is a nested list of all the detected objects. At the top
-    #   level, we have a list of objects. Within each object, we are given a
-    #   list containing the 4 coordinates of a bounding box followed by 80
-    #   classification scores. There are 80 scores because our DNN was trained
-    #   with 80 objects from the COCO dataset. We need to extract the bounding
-    #   box and then identify the highest scoring object.
-    # DNN bounding boxes identified by center, width, and height. We'll convert
-    #   these to the upper-left coordinates of the box and the width & height.
-    # Filter down to only the highest scoring people objects (label #0)
-
-    for result in flattened_outputs:
-        bbox = result[:4]
-        all_scores = result[5:]
-        best_label = np.argmax(all_scores)
-        best_score = all_scores[best_label]
-        
-        if best_score > obj_confidence and best_label == 0:
-            cx, cy, w, h = bbox * np.array([img_w, img_h, img_w, img_h])
-            x = cx - w / 2
-            y = cy - h / 2
-            labels.append(best_label)
-            scores.append(float(best_score))
-            boxes.append([int(x), int(y), int(w), int(h)])
+
+def detect_persons_batch(images, dnn_object, obj_confidence, nms_threshold,
+                         target_classes=PERSON_CLASSES, blob_size=BLOB_SIZE,
+                         top_k=None, soft_nms=False):
+    """
+    Detects COCO objects in a list of images with a single pass through the
+    Deep Neural Network. All of the images are packed into one 4D blob so that
+    OpenCV only has to run its forward pass once. The images do not need to
+    be the same size.
+
+    Returns a list with one entry per image, in the same order as `images`.
+    Each entry is a list of detected objects just like `detect_persons`.
+    """
+
+    if len(images) == 0:
+        return []
+
+    # blobFromImages resizes every image to the blob size (224x224 by default)
+    #   and stacks them into a single blob with the shape (N, 3, 224, 224)
+
+    with profiler.stage('yolo.blob'):
+        blob = cv2.dnn.blobFromImages(images, 1/255.0, blob_size, swapRB=True, crop=False)
+
+    dnn_classifier, dnn_outputlayers = dnn_object
+    with profiler.stage('yolo.forward'):
+        dnn_classifier.setInput(blob)
+        outputs = dnn_classifier.forward(dnn_outputlayers)
+
+    # Each output layer holds the rows for every image in the batch, grouped
+    #   by image. Reshaping to (N, rows, 85) lets us slice out the rows that
+    #   belong to a single image. The bounding boxes are fractions of the
+    #   image size so each image is scaled back up by its own width & height.
+
+    batch_size = len(images)
+    outputs = [layer.reshape(batch_size, -1, layer.shape[-1]) for layer in outputs]
+
+    detections = []
+    for i, img in enumerate(images):
+        img_h, img_w = img.shape[:2]
+        image_outputs = [layer[i] for layer in outputs]
+        detections.append(decode_yolo_outputs(image_outputs, img_w, img_h,
+                                              obj_confidence, nms_threshold,
+                                              target_classes, None, top_k, soft_nms))
+    return detections
+
+
+
+
+@profiler.timed('yolo.decode')
+def decode_yolo_outputs(outputs, img_w, img_h, obj_confidence, nms_threshold,
+                        target_classes=PERSON_CLASSES, letterbox=None,
+                        top_k=None, soft_nms=False):
+    """
+    Converts the raw output layers of the YOLO DNN into a list of objects for
+    an image that is `img_w` x `img_h` pixels. Every step is done on whole
+    NumPy arrays rather than looping over the candidate rows in Python.
+
+    If the image was letterboxed into the blob (see cv2util.PreprocessContext)
+    then `letterbox` is the tuple (blob_w, blob_h, scale, pad_x, pad_y) that
+    describes where the image sits inside the blob.
+
+    Non-Maxima Suppression is done per class (see nms.py), keeps at most
+    `top_k` objects, and uses Soft-NMS when `soft_nms` is True. Soft-NMS
+    lowers the scores of overlapping objects rather than removing them and
+    then drops the ones that fall below `obj_confidence`.
+
+    Returns a list of detected objects, each defined as a tuple:
+      0. COCO label, as an index number
+      1. DNN confidence score
+      2. Bounding box for the object
+    """
+
+    # Each output layer is a 2D array of all the detected objects. Each row
+    #   contains the 4 coordinates of a bounding box, an objectness score, and
+    #   then 80 classification scores. There are 80 scores because our DNN was
+    #   trained with 80 objects from the COCO dataset. Stacking the layers
+    #   gives us one big array that we can filter all at once.
+    # OpenCV has already multiplied the class scores by the objectness score,
+    #   so no class score can beat its row's objectness. Dropping the rows with
+    #   a low objectness first is a cheap way to throw away most of the rows
+    #   before we do the more expensive argmax over 80 columns.
+
+    results = np.concatenate([layer.reshape(-1, layer.shape[-1]) for layer in outputs])
+    results = results[results[:, 4] > obj_confidence]
+
+    all_scores = results[:, 5:]
+    best_labels = np.argmax(all_scores, axis=1)
+    best_scores = all_scores[np.arange(len(results)), best_labels]
+
+    # Filter down to only the highest scoring objects that we care about (by
+    #   default this is just people, label #0)
+
+    keep = best_scores > obj_confidence
+    if target_classes is not None:
+        keep &= np.isin(best_labels, target_classes)
+    labels = best_labels[keep]
+    scores = best_scores[keep]
+
+    # DNN bounding boxes identified by center, width, and height as fractions
+    #   of the image size. We'll convert these to the upper-left coordinates
+    #   of the box and the width & height in pixels.
+    # A letterboxed image only fills part of the blob, so the fractions are
+    #   of the blob size and the border has to be subtracted.
+
+    if letterbox is None:
+        bbox = results[keep, :4] * np.array([img_w, img_h, img_w, img_h])
+    else:
+        blob_w, blob_h, scale, pad_x, pad_y = letterbox
+        bbox = results[keep, :4] * (np.array([blob_w, blob_h, blob_w, blob_h]) / scale)
+        bbox[:, :2] -= np.array([pad_x, pad_y]) / scale
+    bbox[:, :2] -= bbox[:, 2:] / 2
+    boxes = bbox.astype(int)
 
     # The DNN is likely to have identfied the same object multiple times, with
     #   each repeat found in a slightly different, overlapped, region of the
     #   image. We use the Non-Maxima Supression algorithm to detect redundant
     #   objects and return the best fitting bounding box from amongst all of
-    #   the candidates.  
-
-    best_idx = cv2.dnn.NMSBoxes(boxes, scores, obj_confidence, nms_threshold)
-    if len(best_idx) > 0:
-        objects = [(labels[i], scores[i], boxes[i]) for i in best_idx.flatten()]
+    #   the candidates. Each class is suppressed separately so that a person
+    #   never hides the bicycle that they are riding.
+
+    if len(boxes) == 0:
+        return []
+    if soft_nms:
+        best_idx, scores = nms.soft_nms(boxes, scores, nms_threshold, labels=labels,
+                                        score_threshold=obj_confidence, top_k=top_k)
+        objects = [(int(labels[i]), float(score), boxes[i].tolist())
+                   for i, score in zip(best_idx, scores)]
     else:
-        objects = []
-    
+        best_idx = nms.nms(boxes, scores, nms_threshold, labels, top_k)
+        objects = [(int(labels[i]), float(scores[i]), boxes[i].tolist())
+                   for i in best_idx]
+
     return objects
 
 
@@ -173,26 +305,36 @@ def process_image(img, dnn_object, confidence, threshold):
     objects = detect_persons(img, dnn_object, confidence, threshold)
 
     # Place a visual bounding box around each object detected in the image
+    draw_objects(img, objects)
+
+    return img, objects
+
+
+
+
+def draw_objects(img, objects):
+    """
+    Draws a neon bounding box around each object that was detected in the
+    image. The image is modified in place.
+    """
+
     neon = (0, 255, 204)
     for label, score, (x, y, w, h) in objects:
         cv2.rectangle(img, (x, y), (x+w, y+h), neon, 2)
 
-    return img, objects
-
 
 
 
 
-def main():
-    # Load a pre-trained Deep Neural Network to detect persons (and some 79 
-    # other) contained in an image.
+class YoloDetector(detector.Detector):
+    """
+    Detector engine backend for the YOLO Deep Neural Networks in models.py.
+    The model is the tuple returned by `load_yolo_deep_neural_network`.
+    """
 
-    time_start = time.time()
-    dnn_classifier, dnn_layers, label_names = load_yolo_deep_neural_network()
-    dnn_object = (dnn_classifier, dnn_layers)
-    time_end = time.time()
-    duration = time_end - time_start
-    print(f'YOLO DNN load time {duration:.3f}s')
+    name = 'yolo'
+    title = 'YOLO DNN'
+    noun = 'people objects'
 
     # Confidence is a Machine Learning classification score and it has to with
     #   the accuracy of the object detector--how likely is it that this object
@@ -200,55 +342,133 @@ def main():
     # Threshold is a Non-Maxima Suppression value that helps us to minimize the
     #   number of duplicate objects detected in the image. Without it, we are
     #   likely to identify the same object multiple times. 
+    # The blob sizes default to the model's own size (see models.py), except
+    #   that tiles of the full YOLOv3 get TILE_BLOB_SIZE.
+    # A camera loop can hand over its cv2util.PreprocessContext as `context`
+    #   (it is not a model parameter, so it can also be set later). Frames
+    #   of the context's size then reuse its blob instead of allocating a new
+    #   one for every frame (Darknet models only).
+
+    def __init__(self, confidence=0.90, threshold=0.3, blob_size=None,
+                 classes=PERSON_CLASSES, tile_blob_size=None, top_k=None,
+                 soft_nms=False, model='yolov3', model_dir='.', backend='default',
+                 target='cpu', threads=None, context=None):
+        if tile_blob_size is None and model == 'yolov3':
+            tile_blob_size = TILE_BLOB_SIZE
+        blob_size = models.effective_blob_size(model, blob_size)
+        tile_blob_size = models.effective_blob_size(model, tile_blob_size)
+        super().__init__(confidence=confidence, threshold=threshold,
+                         blob_size=tuple(blob_size), classes=classes,
+                         tile_blob_size=tuple(tile_blob_size),
+                         top_k=top_k, soft_nms=soft_nms, model=model,
+                         model_dir=model_dir, backend=backend, target=target,
+                         threads=threads)
+        self.context = context
+
+    @property
+    def model_files(self):
+        return models.model_files(self.params['model'], self.params['model_dir'])
+
+    def _load(self):
+        p = self.params
+        return load_yolo_deep_neural_network(p['model'], p['model_dir'], p['backend'],
+                                             p['target'], p['threads'])
+
+    def _detect(self, frames, blob_size=None):
+        dnn_classifier, dnn_layers, label_names = self.model
+        dnn_object = (dnn_classifier, dnn_layers)
+        p = self.params
+        blob_size = blob_size or p['blob_size']
+        layout = models.MODELS[p['model']]['layout']
+
+        # A single image skips the extra work of splitting up a batch. The
+        #   ONNX models are exported for one image at a time and their outputs
+        #   have to be converted to the Darknet layout before decoding.
+        if layout != 'darknet':
+            results = []
+            for img in frames:
+                img_h, img_w = img.shape[:2]
+                outputs = run_yolo_network(img, dnn_object, blob_size)
+                outputs = models.to_darknet_rows(outputs, layout, blob_size)
+                results.append(decode_yolo_outputs(outputs, img_w, img_h,
+                                                   p['confidence'], p['threshold'],
+                                                   p['classes'], None,
+                                                   p['top_k'], p['soft_nms']))
+        elif len(frames) == 1:
+            context = self.context
+            if context is not None and (tuple(blob_size) != tuple(context.blob_size) or
+                                        frames[0].shape[1::-1] != tuple(context.size)):
+                context = None
+            results = [detect_persons(frames[0], dnn_object,
+                                      p['confidence'], p['threshold'],
+                                      p['classes'], blob_size, context,
+                                      p['top_k'], p['soft_nms'])]
+        else:
+            results = detect_persons_batch(frames, dnn_object,
+                                           p['confidence'], p['threshold'],
+                                           p['classes'], blob_size,
+                                           p['top_k'], p['soft_nms'])
+        return [[(label_names[label], score, box) for label, score, box in objects]
+                for objects in results]
+
+    def detect_tiles(self, tiles):
+        # Tiles are about the size of a whole shrunken image, so they get a
+        # bigger blob to see the small objects that tiling is meant to find
+        if self.model is None:
+            self.load()
+        return self._detect(tiles, self.params['tile_blob_size'])
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument('--confidence', type=float, default=0.90,
+                            help='minimum DNN confidence score (default: 0.90)')
+        parser.add_argument('--threshold', type=float, default=0.3,
+                            help='Non-Maxima Suppression threshold (default: 0.3)')
+        parser.add_argument('--blob-size', type=int, metavar='N',
+                            help='DNN blob width and height, a multiple of 32 (default: set by the model)')
+        parser.add_argument('--top-k', type=int, metavar='N',
+                            help='keep at most N objects per image')
+        parser.add_argument('--soft-nms', action='store_true',
+                            help='lower the scores of overlapping objects instead of removing them')
+        parser.add_argument('--model', choices=list(models.MODELS) + ['auto'], default='yolov3',
+                            help='network to load, or auto to pick one that fits --latency-budget')
+        parser.add_argument('--model-dir', default='.', metavar='DIR',
+                            help='directory that holds the model files (default: .)')
+        parser.add_argument('--latency-budget', type=float, default=500, metavar='MS',
+                            help='per-image time allowed by --model auto (default: 500)')
+        parser.add_argument('--dnn-backend', choices=list(models.BACKENDS), default='default',
+                            help='OpenCV DNN backend (default: default)')
+        parser.add_argument('--dnn-target', choices=list(models.TARGETS), default='cpu',
+                            help='OpenCV DNN target device (default: cpu)')
+
+    # The size of OpenCV's thread pool is the pipeline's --threads option,
+    #   which applies to every detector (see pipeline.add_arguments)
+    @classmethod
+    def from_args(cls, args):
+        model = args.model
+        blob_size = None if args.blob_size is None else (args.blob_size, args.blob_size)
+        if model == 'auto':
+            print(f'Timing the installed models for a {args.latency_budget:.0f}ms budget',
+                  file=sys.stderr)
+            model = models.select_model(args.latency_budget, args.model_dir,
+                                        args.dnn_backend, args.dnn_target, args.threads,
+                                        blob_size=blob_size)
+            if model is None:
+                print(f"Error: no models are installed in '{args.model_dir}'")
+                exit()
+            print(f'Selected model {model}', file=sys.stderr)
+        return cls(args.confidence, args.threshold, blob_size, top_k=args.top_k,
+                   soft_nms=args.soft_nms, model=model, model_dir=args.model_dir,
+                   backend=args.dnn_backend, target=args.dnn_target,
+                   threads=args.threads)
 
-    confidence = 0.90
-    threshold = 0.3
-
-    # Command line parameters must be an image file or a dir containing images
-
-    if len(sys.argv) < 2:
-        print(f"Error: missing filename")
-        print(f"Usage: python {sys.argv[0]} <file>")
-        exit()
-    file_arg = sys.argv[1]
-    if not os.path.exists(file_arg):
-        print(f"Error: '{file_arg}' does not exist")
-        exit()
-    if os.path.isfile(file_arg):
-        image_files = [file_arg]
-    else:
-        image_files = [f"{file_arg}/{name}" for name in os.listdir(file_arg)]
-
-    # Run through each image file one a time:
-    #  1. Detect the person objects in the image
-    #  2. Print the results to the console window
-    #  3. Draw the image with bounding boxes in a GUI window
-    #  4. Wait for the current GUI window to close
-    # Unfortunately, cv2.moveWindow is not working on Chromebooks and so the
-    # windows are being drawn in the center of the screen, which often means
-    # the user has to drag them to a better location (annoying)
-
-    for filename in image_files:
-    
-        time_start = time.time()
-        img = cv2.imread(filename)
-        if img is None:
-            print(f"Error: cv2 could not open image file '{filename}'")
-            continue    
-        img = cv2util.shrink_to_fit(img, (640, 480))        
-        img, objs = process_image(img, dnn_object, confidence, threshold)
-        time_end = time.time()
-        duration = time_end - time_start
-
-        print(f'{filename}: detected {len(objs)} people objects in {duration:.3f}s')
-        for label, score, (x, y, w, h) in objs:
-            print(f'  => {label_names[label]}: {100*score:.1f} at ({x},{y})->({x+w},{y+h})')
-
-        cv2.namedWindow(filename)
-        cv2.imshow(filename, img)
-        cv2.moveWindow(filename, 50, 50)
-        cv2util.wait_for_window_to_close(filename)
+
+
+
+
+def main():
+    detector.main(YoloDetector, 'YOLO persons detection')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,350 @@
+
+# Prof Tallman
+# YOLO persons detection as a long-running service with a thin client.
+#
+# Loading YOLOv3 is slow. The weights file is about 240 MB and the load time
+# that yolo.py prints is often several seconds, which is much longer than it
+# takes to process a single 640x480 image. Scripts that run from cron or that
+# react to events (motion sensor, doorbell button, etc.) usually have only
+# one or two images to check, so they spend almost all of their time loading
+# the model.
+#
+# This script keeps the model loaded in a background service (a "daemon")
+# that listens on a Unix domain socket. The client side of the script sends
+# image paths or raw image bytes to the service and prints the results, just
+# like yolo.py but without the load time.
+#
+#   python yolod.py serve &                 # start the service once
+#   python yolod.py detect photo.jpg        # ask the service for detections
+#   python yolod.py detect --bytes dir/     # send the image bytes instead
+#
+# The protocol is simple so that other programs can talk to the service too.
+# Each request is one line of JSON, optionally followed by raw bytes, and each
+# reply is one line of JSON. A connection can send any number of requests.
+#
+#   {"path": "/home/pi/photo.jpg"}\n
+#   {"size": 52113}\n<52113 bytes of JPEG/PNG data>
+#
+#   {"width": 640, "height": 480, "detect_seconds": 0.41,
+#    "objects": [{"label": "person", "score": 0.97, "box": [x, y, w, h]}]}\n
+#   {"error": "could not open image"}\n
+#
+# Requests may also include "confidence" and "threshold" to override the
+# service's defaults.
+#
+# Every connection gets its own thread, so a client that keeps a connection
+# open does not hold up the others. The images are read and decoded on the
+# connection threads, but only one thread at a time runs the detector because
+# the OpenCV DNN object is not thread-safe. A connection that sits idle for
+# IDLE_TIMEOUT seconds is closed.
+#
+# References:
+#  - https://docs.python.org/3/library/socketserver.html
+#  - https://man7.org/linux/man-pages/man7/unix.7.html
+
+import numpy as np
+import socketserver
+import threading
+import argparse
+import socket
+import signal
+import json
+import time
+import sys
+import os
+import cv2util
+import dataset
+import yolo
+
+
+DEFAULT_SOCKET = '/tmp/yolod.sock'
+
+# Refuse to read raw images bigger than this, so that a bad request can not
+# make the service run out of memory
+MAX_IMAGE_BYTES = 64 * 1024 * 1024
+
+# Seconds that a client connection may sit idle before the service closes it
+IDLE_TIMEOUT = 300
+
+
+class DetectorHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one client connection. Reads requests until the client closes
+    the connection (or leaves it idle for IDLE_TIMEOUT seconds) and answers
+    each one with a line of JSON. A request that fails gets an error reply
+    and the connection stays open for the next one.
+    """
+
+    timeout = IDLE_TIMEOUT
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                reply = self.server.process_request_message(request, self.rfile)
+            except OSError:
+                break
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': f'bad request: {e}'}
+            except Exception as e:
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            try:
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+                self.wfile.flush()
+            except OSError:
+                break
+
+
+class DetectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix domain socket server that owns a warm YOLO DNN. Each connection is
+    handled on its own thread, and a lock makes the threads take turns with
+    the detector because the OpenCV DNN object is not thread-safe.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, confidence=0.90, threshold=0.3,
+                 bbox=(640, 480)):
+        remove_stale_socket(socket_path)
+        self.confidence = confidence
+        self.threshold = threshold
+        self.bbox = bbox
+        self._detector_lock = threading.Lock()
+
+        time_start = time.time()
+        self.detector = yolo.YoloDetector(confidence, threshold).load()
+        time_end = time.time()
+        print(f'YOLO DNN load time {time_end - time_start:.3f}s')
+
+        # The first forward pass is much slower than the rest because OpenCV
+        # sets up its layers and memory lazily. Run it now with a blank image
+        # rather than making the first client wait for it.
+
+        time_start = time.time()
+        blank = np.zeros((bbox[1], bbox[0], 3), dtype=np.uint8)
+        self.detector.detect([blank])
+        time_end = time.time()
+        print(f'YOLO DNN warm-up time {time_end - time_start:.3f}s')
+
+        # The socket file is created by bind() with the umask's permissions,
+        # so the umask is narrowed first rather than fixing the permissions
+        # afterwards, when other users could already have connected
+        old_umask = os.umask(0o117)
+        try:
+            super().__init__(socket_path, DetectorHandler)
+        finally:
+            os.umask(old_umask)
+        self.socket_path = socket_path
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def process_request_message(self, request, rfile):
+        """
+        Runs the detector for one request. Returns the reply as a dictionary.
+        """
+
+        if 'path' in request:
+            # (open() would take a number as a file descriptor, such as the
+            #   client's own socket)
+            if not isinstance(request['path'], str):
+                return {'error': 'bad request: path must be a string'}
+            img = cv2util.imread_fit(request['path'], self.bbox)
+        else:
+            size = int(request['size'])
+            if size < 0 or size > MAX_IMAGE_BYTES:
+                return {'error': f'image size {size} is out of range'}
+            data = rfile.read(size)
+            if len(data) != size:
+                return {'error': 'connection closed before the image was received'}
+            img = cv2util.imdecode_fit(data, self.bbox)
+        if img is None:
+            return {'error': 'could not open image'}
+
+        # Only one request at a time holds the detector, so each one can
+        # safely set the detector's parameters for itself
+        confidence = float(request.get('confidence', self.confidence))
+        threshold = float(request.get('threshold', self.threshold))
+        with self._detector_lock:
+            params = self.detector.params
+            params['confidence'] = confidence
+            params['threshold'] = threshold
+            time_start = time.time()
+            objects = self.detector.detect([img])[0]
+            time_end = time.time()
+
+        return {
+            'width': img.shape[1],
+            'height': img.shape[0],
+            'detect_seconds': round(time_end - time_start, 6),
+            'objects': [{'label': label, 'score': score, 'box': box}
+                        for label, score, box in objects],
+        }
+
+
+def remove_stale_socket(socket_path):
+    """
+    Removes a socket file left behind by a service that crashed. Raises
+    FileExistsError if a running service still answers on the socket.
+    """
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise FileExistsError(f"a detector service is already running on '{socket_path}'")
+
+
+def serve(socket_path, confidence=0.90, threshold=0.3):
+    """
+    Loads the model and answers requests until the process is stopped with
+    <CTRL+C> or SIGTERM.
+    """
+
+    # serve_forever only checks for shutdown between requests, so SIGTERM is
+    # turned into a KeyboardInterrupt to stop it the same way as <CTRL+C>
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        server = DetectorServer(socket_path, confidence, threshold)
+    except FileExistsError as e:
+        print(f"Error: {e}")
+        return
+    with server:
+        print(f'Listening on {socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(" Stopping the detector service")
+
+
+class DetectorClient:
+    """
+    Client for the detector service. One connection is reused for all of the
+    requests.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(socket_path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._rfile = self._sock.makefile('rb')
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, header, payload=b''):
+        self._sock.sendall(json.dumps(header).encode() + b'\n' + payload)
+        line = self._rfile.readline()
+        if not line:
+            raise ConnectionError('detector service closed the connection')
+        return json.loads(line)
+
+    def detect_path(self, path, **options):
+        """
+        Asks the service to read and process an image file. The path must be
+        readable by the service, so it is sent as an absolute path.
+        """
+        return self._request(dict(options, path=os.path.abspath(path)))
+
+    def detect_bytes(self, data, **options):
+        """ Sends encoded image bytes (JPEG, PNG, etc.) to the service. """
+        return self._request(dict(options, size=len(data)), data)
+
+
+def detect(file_arg, client, send_bytes=False, as_json=False):
+    """
+    Sends an image file, or each file in a directory, to the detector
+    service and prints the results.
+    """
+
+    if os.path.isfile(file_arg):
+        image_files = [file_arg]
+    else:
+        image_files = dataset.walk_images(file_arg, recursive=False)
+
+    for filename in image_files:
+        time_start = time.time()
+        if send_bytes:
+            with open(filename, 'rb') as f:
+                reply = client.detect_bytes(f.read())
+        else:
+            reply = client.detect_path(filename)
+        time_end = time.time()
+        duration = time_end - time_start
+
+        if as_json:
+            print(json.dumps(dict(reply, file=filename)))
+        elif 'error' in reply:
+            print(f"Error: '{filename}': {reply['error']}")
+        else:
+            objs = reply['objects']
+            print(f'{filename}: detected {len(objs)} people objects in {duration:.3f}s')
+            for obj in objs:
+                x, y, w, h = obj['box']
+                print(f"  => {obj['label']}: {100*obj['score']:.1f} at ({x},{y})->({x+w},{y+h})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YOLO persons detection service')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help=f'Unix domain socket path (default: {DEFAULT_SOCKET})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_cmd = commands.add_parser('serve', help='load the model and wait for requests')
+    serve_cmd.add_argument('--confidence', type=float, default=0.90)
+    serve_cmd.add_argument('--threshold', type=float, default=0.3)
+    detect_cmd = commands.add_parser('detect', help='send images to the service')
+    detect_cmd.add_argument('file', help='an image file or a directory of images')
+    detect_cmd.add_argument('--bytes', action='store_true',
+                            help='send the image bytes instead of the file path')
+    detect_cmd.add_argument('--json', action='store_true',
+                            help='print the raw JSON replies')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, args.confidence, args.threshold)
+        return
+
+    if not os.path.exists(args.file):
+        print(f"Error: '{args.file}' does not exist")
+        exit()
+    try:
+        client = DetectorClient(args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"Error: detector service is not running on '{args.socket}'")
+        print(f"Start it with: python {sys.argv[0]} serve")
+        return
+    with client:
+        detect(args.file, client, args.bytes, args.json)
+
+
+if __name__ == '__main__':
+    main()